@@ -0,0 +1,205 @@
+import time
+import math
+import asyncio
+from collections import OrderedDict, defaultdict, deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+import app.settings as settings
+from app.scheduler import scheduler
+
+class TokenBucket:
+    """令牌桶: rate_per_min 同时作为桶容量，按秒平滑补充"""
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """距离可以扣除 cost 还需等待的秒数 (0 表示立即可用)。超过容量的请求等桶满即可放行"""
+        self._refill(now)
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost: return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= min(cost, self.capacity)
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+class Ticket:
+    """准入凭证，请求结束 (包括流式结束) 时调用 release()"""
+    __slots__ = ("_controller", "user_id", "client_key", "_released")
+
+    def __init__(self, controller: "AdmissionController", user_id: str, client_key: Optional[str]):
+        self._controller = controller
+        self.user_id = user_id
+        self.client_key = client_key
+        self._released = False
+
+    def release(self):
+        if self._released: return
+        self._released = True
+        self._controller._release(self.user_id, self.client_key)
+
+class _Waiter:
+    __slots__ = ("user_id", "client_key", "tokens", "future", "enqueued")
+
+    def __init__(self, user_id: str, client_key: Optional[str], tokens: float):
+        self.user_id = user_id
+        self.client_key = client_key
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+
+class AdmissionController:
+    """并发 / RPM / TPM 限制 + 按用户轮转的公平排队"""
+
+    def __init__(self, key_count: Optional[Callable[[str], Optional[int]]] = None):
+        self._key_count = key_count  # 返回用户上游 Key 数量，用于按 Key 并发上限推算用户容量
+        self._inflight = 0
+        self._inflight_user: Dict[str, int] = defaultdict(int)
+        self._inflight_client: Dict[str, int] = defaultdict(int)
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.queued_total = 0
+        self._waits: Deque[float] = deque(maxlen=1000)
+
+    def _bucket(self, kind: str, ident: str, rate: int) -> TokenBucket:
+        bucket = self._buckets.get((kind, ident))
+        if bucket is None: bucket = self._buckets[(kind, ident)] = TokenBucket(rate)
+        return bucket
+
+    def _rate_buckets(self, user_id: str, client_key: Optional[str], tokens: float):
+        s = settings
+        if s.ADMISSION_USER_RPM > 0: yield self._bucket("user_rpm", user_id, s.ADMISSION_USER_RPM), 1
+        if s.ADMISSION_USER_TPM > 0: yield self._bucket("user_tpm", user_id, s.ADMISSION_USER_TPM), tokens
+        if client_key:
+            if s.ADMISSION_CLIENT_KEY_RPM > 0: yield self._bucket("key_rpm", client_key, s.ADMISSION_CLIENT_KEY_RPM), 1
+            if s.ADMISSION_CLIENT_KEY_TPM > 0: yield self._bucket("key_tpm", client_key, s.ADMISSION_CLIENT_KEY_TPM), tokens
+
+    def _user_limit(self, user_id: str) -> int:
+        limit = settings.ADMISSION_USER_CONCURRENCY or 0
+        per_key = settings.ADMISSION_UPSTREAM_KEY_CONCURRENCY
+        if per_key > 0 and self._key_count:
+            n = self._key_count(user_id)
+            if n: limit = min(limit, n * per_key) if limit else n * per_key
+        return limit
+
+    def _check(self, user_id: str, client_key: Optional[str], tokens: float, now: float) -> Optional[float]:
+        """可以放行返回 None；并发受限返回 0 (等待释放)；速率受限返回需要等待的秒数"""
+        s = settings
+        if s.ADMISSION_GLOBAL_CONCURRENCY > 0 and self._inflight >= s.ADMISSION_GLOBAL_CONCURRENCY: return 0.0
+        limit = self._user_limit(user_id)
+        if limit > 0 and self._inflight_user.get(user_id, 0) >= limit: return 0.0
+        if client_key and s.ADMISSION_CLIENT_KEY_CONCURRENCY > 0 and self._inflight_client.get(client_key, 0) >= s.ADMISSION_CLIENT_KEY_CONCURRENCY: return 0.0
+        wait = 0.0
+        for bucket, cost in self._rate_buckets(user_id, client_key, tokens):
+            wait = max(wait, bucket.wait_time(cost, now))
+        return wait if wait > 0 else None
+
+    def _take(self, user_id: str, client_key: Optional[str], tokens: float):
+        for bucket, cost in self._rate_buckets(user_id, client_key, tokens): bucket.take(cost)
+        self._inflight += 1
+        self._inflight_user[user_id] += 1
+        if client_key: self._inflight_client[client_key] += 1
+        self.admitted += 1
+
+    def _release(self, user_id: str, client_key: Optional[str]):
+        self._inflight = max(0, self._inflight - 1)
+        self._inflight_user[user_id] -= 1
+        if self._inflight_user[user_id] <= 0: del self._inflight_user[user_id]
+        if client_key:
+            self._inflight_client[client_key] -= 1
+            if self._inflight_client[client_key] <= 0: del self._inflight_client[client_key]
+        if self._queues: self._dispatch()
+
+    async def admit(self, user_id: str, client_key: Optional[str] = None, tokens: float = 0) -> Ticket:
+        """申请执行一次请求。受限时排队等待，超时或队列已满抛出 AdmissionRejected"""
+        now = time.monotonic()
+        if user_id not in self._queues and self._check(user_id, client_key, tokens, now) is None:
+            self._take(user_id, client_key, tokens)
+            self._waits.append(0.0)
+            return Ticket(self, user_id, client_key)
+        queue = self._queues.get(user_id)
+        if queue is not None and len(queue) >= settings.ADMISSION_MAX_QUEUE_PER_USER:
+            self.rejected += 1
+            raise AdmissionRejected("queue full", settings.ADMISSION_MAX_WAIT)
+        waiter = _Waiter(user_id, client_key, tokens)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self.queued_total += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=settings.ADMISSION_MAX_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if waiter.future.done(): self._release(user_id, client_key)
+            else: self._remove(waiter)
+            raise
+        if not waiter.future.done():
+            self._remove(waiter)
+            self.rejected += 1
+            wait = self._check(user_id, client_key, tokens, time.monotonic())
+            raise AdmissionRejected("wait timeout", wait or settings.ADMISSION_MAX_WAIT / 2)
+        self._waits.append(time.monotonic() - waiter.enqueued)
+        return Ticket(self, user_id, client_key)
+
+    def _remove(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_id)
+        if queue is None: return
+        try: queue.remove(waiter)
+        except ValueError: pass
+        if not queue: del self._queues[waiter.user_id]
+
+    def _dispatch(self):
+        """按用户轮转放行: 每一轮每个用户最多放行队首一个请求，放行后该用户移到队尾"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        next_wake = None
+        progress = True
+        while progress and self._queues:
+            progress = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                waiter = queue[0]
+                wait = self._check(waiter.user_id, waiter.client_key, waiter.tokens, now)
+                if wait is None:
+                    queue.popleft()
+                    self._take(waiter.user_id, waiter.client_key, waiter.tokens)
+                    waiter.future.set_result(True)
+                    progress = True
+                    if queue: self._queues.move_to_end(user_id)
+                    else: del self._queues[user_id]
+                elif wait > 0:
+                    next_wake = wait if next_wake is None else min(next_wake, wait)
+        # 速率限制需要等令牌补充，并发限制由 release 触发
+        if next_wake is not None and self._queues:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._dispatch)
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        def pct(p: float) -> float:
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+        return {
+            "inflight": self._inflight,
+            "queue_depth": sum(len(q) for q in self._queues.values()),
+            "queued_users": len(self._queues),
+            "admitted": self.admitted, "rejected": self.rejected, "queued_total": self.queued_total,
+            "wait_ms": {"p50": pct(0.5), "p95": pct(0.95), "max": round(waits[-1] * 1000, 1) if waits else 0.0},
+        }
+
+admission = AdmissionController(key_count=scheduler.key_count)
@@ -0,0 +1,107 @@
+import time
+from typing import Dict, Optional, Union
+import httpx
+import app.settings as settings
+
+class CircuitOpen(Exception):
+    """上游 Host 或用户的全部 Key 处于熔断状态，直接返回 503 而不再请求上游"""
+    def __init__(self, target: str, retry_after: float):
+        self.target = target
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+class CircuitBreaker:
+    """熔断器: closed 时连续失败 BREAKER_FAILURE_THRESHOLD 次进入 open，open 期间直接拒绝；
+    BREAKER_OPEN_SECONDS 后进入 half_open，每 BREAKER_PROBE_INTERVAL 秒只放行一个探测请求，
+    探测成功回到 closed，失败则重新 open 且时长加倍 (不超过 BREAKER_OPEN_MAX_SECONDS)"""
+    __slots__ = ("name", "state", "consecutive_failures", "open_until", "open_seconds", "next_probe", "trips", "rejected")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_seconds = 0.0
+        self.next_probe = 0.0
+        self.trips = 0
+        self.rejected = 0
+
+    def _refresh(self, now: float):
+        if self.state == "open" and now >= self.open_until:
+            self.state = "half_open"
+            self.next_probe = now
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """是否可以发送请求 (不占用探测名额，用于排序 / 过滤)"""
+        if not settings.BREAKER_ENABLED or self.state == "closed": return True
+        now = time.monotonic() if now is None else now
+        self._refresh(now)
+        return self.state == "half_open" and now >= self.next_probe
+
+    def attempt(self):
+        """发送请求前调用: half_open 时这次请求即为探测，推迟下一次探测"""
+        if self.state == "half_open": self.next_probe = time.monotonic() + settings.BREAKER_PROBE_INTERVAL
+
+    def allow(self) -> bool:
+        if not self.available():
+            self.rejected += 1
+            return False
+        self.attempt()
+        return True
+
+    def retry_after(self) -> float:
+        now = time.monotonic()
+        if self.state == "open": return self.open_until - now
+        if self.state == "half_open": return self.next_probe - now
+        return 0.0
+
+    def record(self, ok: bool):
+        if ok:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.open_seconds = 0.0
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.consecutive_failures >= settings.BREAKER_FAILURE_THRESHOLD):
+            self.open_seconds = min(self.open_seconds * 2 or settings.BREAKER_OPEN_SECONDS, settings.BREAKER_OPEN_MAX_SECONDS)
+            self.open_until = time.monotonic() + self.open_seconds
+            self.state = "open"
+            self.trips += 1
+
+    def snapshot(self) -> dict:
+        if self.state != "closed": self._refresh(time.monotonic())
+        return {
+            "state": self.state, "consecutive_failures": self.consecutive_failures,
+            "retry_after": max(0, int(self.retry_after() + 0.999)), "trips": self.trips, "rejected": self.rejected,
+        }
+
+def host_of(url: Union[str, httpx.URL]) -> str:
+    # 与 httpx 的规范化一致 (小写、省略默认端口)，传输层与入口处得到相同的 Host
+    return httpx.URL(url).netloc.decode("ascii")
+
+class HostBreakers:
+    """按上游 Host (ollama_host 的 host:port) 的熔断器。结果由 upstream 的传输层统一记录:
+    连接错误 / 超时与 502 / 503 / 504 计为失败，其它响应说明 Host 可达"""
+
+    def __init__(self):
+        self._hosts: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        host = host_of(url)
+        breaker = self._hosts.get(host)
+        if breaker is None: breaker = self._hosts[host] = CircuitBreaker(host)
+        return breaker
+
+    def check(self, url: str):
+        """Host 熔断中时抛出 CircuitOpen"""
+        breaker = self.get(url)
+        if not breaker.allow(): raise CircuitOpen(breaker.name, breaker.retry_after())
+
+    def record(self, host: str, ok: bool):
+        # 只记录已通过 get() 登记的 Host (ollama_host)，不为图片下载等其它地址创建熔断器
+        breaker = self._hosts.get(host)
+        if breaker is not None: breaker.record(ok)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {host: b.snapshot() for host, b in self._hosts.items()}
+
+hosts = HostBreakers()
@@ -0,0 +1,114 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+import app.settings as settings
+
+MISS = object()
+
+_named: Dict[str, "TTLCache"] = {}
+# 具名缓存失效时的回调 (name, key)，key 为 None 表示清空；多 worker 模式下用于广播失效
+invalidation_listeners: List[Callable[[str, object], None]] = []
+# 具名缓存 get_or_load 的命中回调 (name, hit)，由 metrics 注册以导出命中 / 未命中计数
+lookup_listeners: List[Callable[[str, bool], None]] = []
+
+def named(name: str) -> Optional["TTLCache"]:
+    return _named.get(name)
+
+def fingerprint(secret: str) -> str:
+    """Key / 令牌的稳定短哈希，用于指标标签与跨 worker 消息，不暴露原文"""
+    return hashlib.sha256(secret.encode()).hexdigest()[:12]
+
+class TTLCache:
+    """有界 LRU + TTL 缓存 (线程安全)。值为 None 时视为负缓存，使用较短的 negative_ttl"""
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float = 0, name: Optional[str] = None):
+        self.name = name
+        if name: _named[name] = self
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= now:
+                if item is not None: del self._data[key]
+                self.misses += 1
+                return MISS
+            self._data.move_to_end(key)
+            if item[0] is None: self.negative_hits += 1
+            else: self.hits += 1
+            return item[0]
+
+    def set(self, key, value, version: int = None, ttl: Optional[float] = None):
+        """ttl 为本条目的有效期上限 (如会话剩余时长)，不超过缓存的 ttl"""
+        ttl = (self.ttl if ttl is None else min(self.ttl, ttl)) if value is not None else self.negative_ttl
+        if ttl <= 0 or self.maxsize <= 0: return
+        with self._lock:
+            # 加载期间发生过失效则丢弃结果，防止把已删除的 key 重新写回缓存
+            if version is not None and version != self._version: return
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    async def get_or_load(self, key, loader, ttl_of: Optional[Callable[[object], float]] = None):
+        """命中直接返回，否则 await loader() 并写入缓存 (结果为 None 时写入负缓存)。
+        ttl_of(value) 返回该条目自身的剩余有效期"""
+        value = self.get(key)
+        if self.name:
+            for listener in lookup_listeners: listener(self.name, value is not MISS)
+        if value is not MISS: return value
+        version = self._version
+        value = await loader()
+        self.set(key, value, version, ttl_of(value) if ttl_of is not None and value is not None else None)
+        return value
+
+    def invalidate(self, key, broadcast: bool = True):
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+        if broadcast: self._notify(key)
+
+    def invalidate_fingerprint(self, fp: str):
+        """按 fingerprint 失效 (其它 worker 广播的失效事件不携带 Key / 令牌原文)，只在本 worker 生效"""
+        with self._lock:
+            matched = [k for k in self._data if fingerprint(str(k)) == fp]
+            self._version += 1
+            for k in matched: del self._data[k]
+
+    def clear(self, broadcast: bool = True):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+        if broadcast: self._notify(None)
+
+    def _notify(self, key):
+        if self.name is None: return
+        for listener in invalidation_listeners: listener(self.name, key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._data), "maxsize": self.maxsize,
+            "hits": self.hits, "negative_hits": self.negative_hits, "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+# 热路径鉴权缓存: client key -> user_id, session token -> username
+client_keys = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL, settings.AUTH_CACHE_NEGATIVE_TTL, name="client_keys")
+sessions = TTLCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL, settings.AUTH_CACHE_NEGATIVE_TTL, name="sessions")
+# 全局配置 (ollama_host 等)，修改时显式失效，因此未设置的项也按同样的 TTL 缓存
+config = TTLCache(64, settings.AUTH_CACHE_TTL, settings.AUTH_CACHE_TTL, name="config")
@@ -0,0 +1,78 @@
+import time
+import json
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+import app.settings as settings
+
+class CatalogEntry:
+    __slots__ = ("models", "etag", "fetched_at")
+
+    def __init__(self, models: List[dict]):
+        self.models = models
+        self.fetched_at = time.monotonic()
+        digest = hashlib.sha1(json.dumps([m["id"] for m in models]).encode()).hexdigest()[:16]
+        self.etag = f'W/"{digest}"'
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+class ModelCatalog:
+    """模型列表缓存: TTL 内直接命中，过期后在 stale 窗口内先返回旧值并在后台刷新 (stale-while-revalidate)"""
+
+    def __init__(self, ttl: float, stale_ttl: float):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries: Dict[Hashable, CatalogEntry] = {}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    async def get(self, cache_key: Hashable, fetch: Callable[[], Awaitable[Optional[List[dict]]]], force: bool = False) -> Optional[CatalogEntry]:
+        entry = self._entries.get(cache_key)
+        if entry is not None and not force:
+            age = entry.age()
+            if age < self.ttl:
+                self.hits += 1
+                return entry
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self._refresh(cache_key, fetch)
+                return entry
+        self.misses += 1
+        # shield: 某个等待者断开不应取消其它请求共享的刷新任务
+        fresh = await asyncio.shield(self._refresh(cache_key, fetch))
+        # 上游全部失败时退回旧值 (强制刷新除外，调用方需要知道真实的连通结果)
+        if fresh is None and not force: return self._entries.get(cache_key)
+        return fresh
+
+    def _refresh(self, cache_key: Hashable, fetch) -> asyncio.Future:
+        # 同一 key 的并发刷新合并为一次上游请求
+        fut = self._inflight.get(cache_key)
+        if fut is None:
+            fut = asyncio.ensure_future(self._load(cache_key, fetch))
+            self._inflight[cache_key] = fut
+        return fut
+
+    async def _load(self, cache_key: Hashable, fetch) -> Optional[CatalogEntry]:
+        try:
+            models = await fetch()
+            if not models: return None
+            entry = self._entries[cache_key] = CatalogEntry(models)
+            return entry
+        finally:
+            self._inflight.pop(cache_key, None)
+
+    def invalidate(self, cache_key: Hashable = None):
+        if cache_key is None: self._entries.clear()
+        else: self._entries.pop(cache_key, None)
+
+    def invalidate_user(self, user_id: str):
+        """用户增删上游 Key 后丢弃其模型列表 (缓存键为 (host, user_id))"""
+        for cache_key in [k for k in self._entries if isinstance(k, tuple) and k[-1] == user_id]: del self._entries[cache_key]
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses}
+
+models_catalog = ModelCatalog(settings.MODELS_CACHE_TTL, settings.MODELS_CACHE_STALE_TTL)
@@ -0,0 +1,80 @@
+import gzip
+from typing import Optional
+from starlette.datastructures import Headers, MutableHeaders
+import app.settings as settings
+
+# 可选的 zstd 支持: 安装 zstandard 后可用于上游请求体与下游响应压缩，未安装时只使用 gzip
+try:
+    import zstandard
+
+    _zstd_compressor = zstandard.ZstdCompressor(level=3)
+    ZSTD_AVAILABLE = True
+except ImportError:
+    _zstd_compressor = None
+    ZSTD_AVAILABLE = False
+
+GZIP_LEVEL = 5
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd": return _zstd_compressor.compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+def upstream_encoding() -> Optional[str]:
+    """UPSTREAM_COMPRESSION 配置的请求体压缩方式 (zstd 不可用时回退为 gzip)"""
+    enc = settings.UPSTREAM_COMPRESSION
+    if enc == "zstd" and not ZSTD_AVAILABLE: return "gzip"
+    return enc if enc in ("gzip", "zstd") else None
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """按客户端的 Accept-Encoding 选择响应压缩方式，优先 zstd"""
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"): continue
+        accepted.add(name.strip())
+    if ZSTD_AVAILABLE and "zstd" in accepted: return "zstd"
+    if "gzip" in accepted or "*" in accepted: return "gzip"
+    return None
+
+_STREAMING_TYPES = ("text/event-stream", "application/x-ndjson")
+_COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript")
+
+class CompressionMiddleware:
+    """只压缩声明了 Content-Length 的一次性响应 (非流式 JSON / 页面)。SSE 与 NDJSON 流以及未声明长度的流式响应原样透传，
+    避免压缩缓冲增加逐 token 的延迟"""
+
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None: return await self.app(scope, receive, send)
+        start = None
+        chunks = []
+
+        async def wrapped_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "")
+                # 外层的 BaseHTTPMiddleware 会把响应体拆成多条消息，因此按 Content-Length 判断是否为一次性响应
+                if (content_type.startswith(_STREAMING_TYPES) or not content_type.startswith(_COMPRESSIBLE_TYPES)
+                        or "content-encoding" in headers or int(headers.get("content-length") or 0) < self.minimum_size):
+                    return await send(message)
+                start = message  # 收齐响应体后再压缩
+                return
+            if message["type"] != "http.response.body" or start is None: return await send(message)
+            chunks.append(message.get("body", b""))
+            if message.get("more_body"): return
+            head, start = start, None
+            compressed = compress(b"".join(chunks), encoding)
+            headers = MutableHeaders(raw=head["headers"])
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(head)
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, wrapped_send)
@@ -2,12 +2,66 @@ import sqlite3
 import hashlib
 import uuid
 import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
+import app.settings as settings
+import app.cache as cache
+import app.metrics as metrics
 
 DB_FILE = "data/proxy.db"
 
+# 每个线程持有一个长连接 (sqlite3 连接不能跨线程并发使用)，避免每次调用重新 connect
+_local = threading.local()
+_conns: List[sqlite3.Connection] = []
+_conns_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=10000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+)
+
 def get_connection():
-    return sqlite3.connect(DB_FILE, timeout=10)
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False)
+        for pragma in PRAGMAS: conn.execute(pragma)
+        _local.conn = conn
+        with _conns_lock: _conns.append(conn)
+    return conn
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.DB_POOL_SIZE, thread_name_prefix="proxy-db")
+    return _executor
+
+async def run(fn, *args, **kwargs):
+    """在专用线程池中执行同步数据库函数，避免阻塞事件循环: await db.run(db.get_config, "ollama_host")"""
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try: return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+    finally: metrics.db_seconds.observe(time.monotonic() - started, fn.__name__)
+
+def close():
+    """关闭线程池及所有线程持有的连接 (应用退出时调用)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    with _conns_lock:
+        for conn in _conns:
+            try: conn.close()
+            except sqlite3.Error: pass
+        _conns.clear()
+    _local.__dict__.clear()
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -38,24 +92,54 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
 
+    # 用量统计: 按 (用户, 小时, Client Key, 上游 Key, 模型) 汇总，以及逐请求日志
+    c.execute('''CREATE TABLE IF NOT EXISTS usage_hourly (
+        user_id TEXT,
+        hour INTEGER,
+        client_key TEXT,
+        upstream_key TEXT,
+        model TEXT,
+        requests INTEGER DEFAULT 0,
+        errors INTEGER DEFAULT 0,
+        prompt_tokens INTEGER DEFAULT 0,
+        completion_tokens INTEGER DEFAULT 0,
+        PRIMARY KEY (user_id, hour, client_key, upstream_key, model)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS request_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL,
+        user_id TEXT,
+        client_key TEXT,
+        upstream_key TEXT,
+        model TEXT,
+        stream INTEGER,
+        status INTEGER,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        duration_ms INTEGER
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_request_log_user_ts ON request_log (user_id, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_reg_ip ON users (reg_ip)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_api_keys_user_id ON api_keys (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_upstream_keys_user_id ON upstream_keys (user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+
     # 默认配置
     c.execute("INSERT OR IGNORE INTO config (key, value) VALUES (?, ?)", ("ollama_host", "https://ollama.com/api/chat"))
     
-    # 默认管理员
+    # 默认管理员 (多 worker 同时初始化时用 OR IGNORE 避免主键冲突)
     c.execute("SELECT count(*) FROM users")
     if c.fetchone()[0] == 0:
         default_pass = hash_password("admin")
-        c.execute("INSERT INTO users (username, password_hash, email, reg_ip) VALUES (?, ?, ?, ?)", 
+        c.execute("INSERT OR IGNORE INTO users (username, password_hash, email, reg_ip) VALUES (?, ?, ?, ?)", 
                   ("admin", default_pass, "admin@local", "127.0.0.1"))
     conn.commit()
-    conn.close()
 
 def get_config(key: str) -> Optional[str]:
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT value FROM config WHERE key=?", (key,))
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
 def set_config(key: str, value: str):
@@ -63,7 +147,7 @@ def set_config(key: str, value: str):
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
     conn.commit()
-    conn.close()
+    cache.config.invalidate(key)
 
 # --- Upstream Keys Management [V4: User Isolated] ---
 def add_upstream_key(key: str, remarks: str, user_id: str):
@@ -73,8 +157,9 @@ def add_upstream_key(key: str, remarks: str, user_id: str):
         c.execute("INSERT INTO upstream_keys (key, remarks, user_id) VALUES (?, ?, ?)", (key, remarks, user_id))
         conn.commit()
         return True
-    except: return False
-    finally: conn.close()
+    except:
+        conn.rollback()
+        return False
 
 def delete_upstream_key(key: str, user_id: str):
     conn = get_connection()
@@ -82,7 +167,6 @@ def delete_upstream_key(key: str, user_id: str):
     # 只能删除自己的 key
     c.execute("DELETE FROM upstream_keys WHERE key=? AND user_id=?", (key, user_id))
     conn.commit()
-    conn.close()
 
 def get_user_upstream_keys(user_id: str):
     """获取特定用户的上游 Key 池"""
@@ -90,16 +174,22 @@ def get_user_upstream_keys(user_id: str):
     c = conn.cursor()
     c.execute("SELECT key, remarks, created_at FROM upstream_keys WHERE user_id=? ORDER BY created_at DESC", (user_id,))
     rows = c.fetchall()
-    conn.close()
     return [{"key": r[0], "remarks": r[1], "created_at": r[2]} for r in rows]
 
-# --- Security Functions (No Change) ---
+# --- Security Functions ---
+# IP 封锁的判断在内存中进行 (app/security.py)，这里只负责持久化
+def get_blocked_ips(now: float):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT ip, blocked_until FROM blocked_ips WHERE blocked_until > ?", (now,))
+    return c.fetchall()
+
 def is_ip_blocked(ip: str) -> bool:
+    # 兼容旧接口 (直接查询数据库)；请求路径使用 LoginGuard 的内存封锁表
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT blocked_until FROM blocked_ips WHERE ip=?", (ip,))
     row = c.fetchone()
-    conn.close()
     if row:
         if time.time() < row[0]: return True
         else: unblock_ip(ip)
@@ -111,22 +201,29 @@ def block_ip(ip: str, duration: int = 1800, reason: str = "Login Failed"):
     blocked_until = time.time() + duration
     c.execute("INSERT OR REPLACE INTO blocked_ips (ip, blocked_until, reason) VALUES (?, ?, ?)", (ip, blocked_until, reason))
     conn.commit()
-    conn.close()
 
 def unblock_ip(ip: str):
     conn = get_connection()
     c = conn.cursor()
     c.execute("DELETE FROM blocked_ips WHERE ip=?", (ip,))
     conn.commit()
-    conn.close()
 
 def check_registration_limit(ip: str) -> bool:
+    # 兼容旧接口 (直接查询数据库)；/register 使用 LoginGuard 中的内存计数
+    limit = settings.REGISTER_IP_MAX_ACCOUNTS
+    if limit <= 0: return True
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT count(*) FROM users WHERE reg_ip=?", (ip,))
     count = c.fetchone()[0]
-    conn.close()
-    return count < 5
+    return count < limit
+
+def get_registration_counts():
+    """各 IP 已注册的账号数，启动时加载到内存 (注册限制在 LoginGuard 中检查)"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT reg_ip, count(*) FROM users WHERE reg_ip IS NOT NULL GROUP BY reg_ip")
+    return c.fetchall()
 
 def create_user(username, password, email, ip):
     conn = get_connection()
@@ -137,41 +234,43 @@ def create_user(username, password, email, ip):
         conn.commit()
         return True, "注册成功"
     except sqlite3.IntegrityError as e:
+        conn.rollback()
         if "email" in str(e): return False, "该邮箱已被注册"
         return False, "用户名已存在"
-    finally: conn.close()
 
 def verify_login_security(username, password, ip):
+    """兼容旧接口: 返回 (是否成功, 提示信息)，失败次数过多时直接写入 IP 封锁"""
+    success, msg, lock_ip = verify_login(username, password)
+    if lock_ip: block_ip(ip, duration=1800, reason="Too many login failures")
+    return success, msg
+
+def verify_login(username, password):
+    """返回 (是否成功, 提示信息, 是否需要封锁 IP)。IP 封锁由调用方 (LoginGuard) 在内存中处理并异步写入"""
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT password_hash, failed_attempts, locked_until FROM users WHERE username=?", (username,))
     row = c.fetchone()
-    if not row:
-        conn.close()
-        return False, "用户名或密码错误"
+    if not row: return False, "用户名或密码错误", False
     real_hash, failed_attempts, locked_until = row
     if time.time() < locked_until:
-        conn.close()
-        return False, f"账号锁定中，请等待 {int(locked_until - time.time())} 秒"
+        return False, f"账号锁定中，请等待 {int(locked_until - time.time())} 秒", False
     if real_hash == hash_password(password):
-        c.execute("UPDATE users SET failed_attempts=0, locked_until=0 WHERE username=?", (username,))
-        conn.commit()
-        conn.close()
-        return True, "success"
+        # 只有存在失败记录时才需要写入
+        if failed_attempts or locked_until:
+            c.execute("UPDATE users SET failed_attempts=0, locked_until=0 WHERE username=?", (username,))
+            conn.commit()
+        return True, "success", False
     else:
         new_attempts = failed_attempts + 1
         if new_attempts >= 5:
             lock_time = time.time() + 1800 
             c.execute("UPDATE users SET failed_attempts=?, locked_until=? WHERE username=?", (new_attempts, lock_time, username))
             conn.commit()
-            conn.close()
-            block_ip(ip, duration=1800, reason="Too many login failures")
-            return False, "错误次数过多，账号及IP已被封锁 30 分钟"
+            return False, "错误次数过多，账号及IP已被封锁 30 分钟", True
         else:
             c.execute("UPDATE users SET failed_attempts=? WHERE username=?", (new_attempts, username))
             conn.commit()
-            conn.close()
-            return False, f"密码错误 (剩余次数: {5 - new_attempts})"
+            return False, f"密码错误 (剩余次数: {5 - new_attempts})", False
 
 def change_user_password(username, old_password, new_password):
     conn = get_connection()
@@ -182,7 +281,6 @@ def change_user_password(username, old_password, new_password):
     if row[0] != hash_password(old_password): return False, "旧密码错误"
     c.execute("UPDATE users SET password_hash=? WHERE username=?", (hash_password(new_password), username))
     conn.commit()
-    conn.close()
     return True, "密码修改成功"
 
 def create_session(username):
@@ -192,23 +290,26 @@ def create_session(username):
     c = conn.cursor()
     c.execute("INSERT INTO sessions (token, username, expires_at) VALUES (?, ?, ?)", (token, username, expires))
     conn.commit()
-    conn.close()
     return token
 
 def get_session_user(token):
+    session = get_session(token)
+    return session[0] if session else None
+
+def get_session(token):
+    """返回 (username, expires_at)，会话缓存按 expires_at 限制条目的有效期"""
     conn = get_connection()
     c = conn.cursor()
-    c.execute("SELECT username FROM sessions WHERE token=? AND expires_at > ?", (token, time.time()))
+    c.execute("SELECT username, expires_at FROM sessions WHERE token=? AND expires_at > ?", (token, time.time()))
     row = c.fetchone()
-    conn.close()
-    return row[0] if row else None
+    return (row[0], row[1]) if row else None
 
 def delete_session(token):
     conn = get_connection()
     c = conn.cursor()
     c.execute("DELETE FROM sessions WHERE token=?", (token,))
     conn.commit()
-    conn.close()
+    cache.sessions.invalidate(token)
 
 def create_api_key(key, name, user_id):
     conn = get_connection()
@@ -216,16 +317,17 @@ def create_api_key(key, name, user_id):
     try:
         c.execute("INSERT INTO api_keys (key, name, user_id) VALUES (?, ?, ?)", (key, name, user_id))
         conn.commit()
+        cache.client_keys.invalidate(key)
         return True
-    except: return False
-    finally: conn.close()
+    except:
+        conn.rollback()
+        return False
 
 def list_api_keys(user_id):
     conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT key, name, created_at FROM api_keys WHERE user_id=? ORDER BY created_at DESC", (user_id,))
     rows = c.fetchall()
-    conn.close()
     return [{"key": r[0], "name": r[1], "created_at": r[2]} for r in rows]
 
 # [V4 变更] 验证 Client Key 并返回所属 User ID
@@ -234,7 +336,6 @@ def verify_client_key_and_get_user(key):
     c = conn.cursor()
     c.execute("SELECT user_id FROM api_keys WHERE key=?", (key,))
     row = c.fetchone()
-    conn.close()
     return row[0] if row else None
 
 def verify_api_key(key):
@@ -246,4 +347,61 @@ def delete_api_key(key, user_id):
     c = conn.cursor()
     c.execute("DELETE FROM api_keys WHERE key=? AND user_id=?", (key, user_id))
     conn.commit()
-    conn.close()
+    cache.client_keys.invalidate(key)
+
+# --- 用量统计 ---
+USAGE_GROUP_COLUMNS = ("model", "client_key", "upstream_key", "hour")
+
+def record_usage_batch(records, write_log: bool = True):
+    """批量写入用量: records 为 (ts, user_id, client_key, upstream_key, model, stream, status, prompt_tokens, completion_tokens, duration_ms)，
+    先在内存中按小时汇总再 UPSERT，整批在一个事务中提交"""
+    rollup = {}
+    for ts, user_id, client_key, upstream_key, model, _, status, prompt_tokens, completion_tokens, _ in records:
+        row = rollup.setdefault((user_id, int(ts // 3600) * 3600, client_key, upstream_key, model), [0, 0, 0, 0])
+        row[0] += 1
+        if status >= 400: row[1] += 1
+        row[2] += prompt_tokens
+        row[3] += completion_tokens
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        if write_log:
+            c.executemany("""INSERT INTO request_log (ts, user_id, client_key, upstream_key, model, stream, status, prompt_tokens, completion_tokens, duration_ms)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", records)
+        c.executemany("""INSERT INTO usage_hourly (user_id, hour, client_key, upstream_key, model, requests, errors, prompt_tokens, completion_tokens)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (user_id, hour, client_key, upstream_key, model) DO UPDATE SET
+                         requests = requests + excluded.requests, errors = errors + excluded.errors,
+                         prompt_tokens = prompt_tokens + excluded.prompt_tokens, completion_tokens = completion_tokens + excluded.completion_tokens""",
+                      [k + tuple(v) for k, v in rollup.items()])
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def get_usage(user_id, since: float, group_by=("model",)):
+    cols = ", ".join(col for col in group_by if col in USAGE_GROUP_COLUMNS) or "model"
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(f"""SELECT {cols}, SUM(requests), SUM(errors), SUM(prompt_tokens), SUM(completion_tokens) FROM usage_hourly
+                  WHERE user_id=? AND hour >= ? GROUP BY {cols} ORDER BY SUM(prompt_tokens) + SUM(completion_tokens) DESC""",
+              (user_id, int(since // 3600) * 3600))
+    names = cols.split(", ") + ["requests", "errors", "prompt_tokens", "completion_tokens"]
+    rows = [dict(zip(names, r)) for r in c.fetchall()]
+    for r in rows: r["total_tokens"] = r["prompt_tokens"] + r["completion_tokens"]
+    return rows
+
+def prune_expired(now: float):
+    """删除过期的会话与 IP 封锁记录，返回 (会话数, 封锁数)"""
+    conn = get_connection()
+    c = conn.cursor()
+    sessions = c.execute("DELETE FROM sessions WHERE expires_at < ?", (now,)).rowcount
+    blocks = c.execute("DELETE FROM blocked_ips WHERE blocked_until < ?", (now,)).rowcount
+    conn.commit()
+    return sessions, blocks
+
+def prune_request_log(before: float):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM request_log WHERE ts < ?", (before,))
+    conn.commit()
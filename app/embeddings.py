@@ -0,0 +1,144 @@
+import sys
+import time
+import base64
+import asyncio
+from array import array
+from typing import Dict, List, Optional, Tuple
+import httpx
+import app.settings as settings
+import app.upstream as upstream
+import app.metrics as metrics
+from app.scheduler import scheduler, parse_retry_after
+
+class EmbeddingError(Exception):
+    """上游返回与 Key 无关的错误 (如模型不存在) 或所有 Key 均失败，body 原样返回给客户端"""
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.body = body
+
+class _Batch:
+    """合并窗口中等待发送的小请求: inputs 依次拼接，waiters 记录各请求在其中的起止位置"""
+    __slots__ = ("inputs", "waiters", "timer")
+
+    def __init__(self):
+        self.inputs: List[str] = []
+        self.waiters: List[Tuple[asyncio.Future, int, int]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+def encode_base64(vector: List[float]) -> str:
+    """OpenAI encoding_format=base64: float32 小端序"""
+    a = array("f", vector)
+    if sys.byteorder == "big": a.byteswap()
+    return base64.b64encode(a.tobytes()).decode("ascii")
+
+class Embedder:
+    """/v1/embeddings -> Ollama /api/embed。
+
+    - 大批量输入按 EMBED_BATCH_SIZE 拆分，各分片并发发送，每个分片独立按调度顺序选择 Key (自然分散到不同 Key)
+    - EMBED_COALESCE_MS > 0 时，窗口内同一用户、同一模型的多个小请求合并为一次上游调用，结果按位置拆回
+    输出顺序始终与输入一致。
+    """
+
+    def __init__(self):
+        self._pending: Dict[tuple, _Batch] = {}
+        self.requests = 0
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    async def embed(self, url: str, user_id: str, model: str, inputs: List[str], extra: dict) -> Tuple[List[list], int, Optional[str]]:
+        """返回 (向量列表, prompt token 数, 使用的上游 Key)"""
+        self.requests += 1
+        window = settings.EMBED_COALESCE_MS / 1000
+        if window <= 0 or len(inputs) >= settings.EMBED_BATCH_SIZE: return await self._run(url, user_id, model, inputs, extra)
+        return await self._join(window, url, user_id, model, inputs, extra)
+
+    async def _join(self, window: float, url: str, user_id: str, model: str, inputs: List[str], extra: dict):
+        group = (url, user_id, model, tuple(sorted(extra.items())))
+        batch = self._pending.get(group)
+        if batch is not None and len(batch.inputs) + len(inputs) > settings.EMBED_BATCH_SIZE:
+            self._flush(group)
+            batch = None
+        if batch is None:
+            batch = self._pending[group] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(window, self._flush, group)
+        else: self.coalesced += 1
+        fut = asyncio.get_running_loop().create_future()
+        batch.waiters.append((fut, len(batch.inputs), len(batch.inputs) + len(inputs)))
+        batch.inputs.extend(inputs)
+        if len(batch.inputs) >= settings.EMBED_BATCH_SIZE: self._flush(group)
+        # 调用方被取消时不影响同批次的其它请求
+        return await asyncio.shield(fut)
+
+    def _flush(self, group: tuple):
+        batch = self._pending.pop(group, None)
+        if batch is None: return
+        if batch.timer is not None: batch.timer.cancel()
+        url, user_id, model, extra = group
+        asyncio.ensure_future(self._dispatch(batch, url, user_id, model, dict(extra)))
+
+    async def _dispatch(self, batch: _Batch, url: str, user_id: str, model: str, extra: dict):
+        try: vectors, tokens, key = await self._run(url, user_id, model, batch.inputs, extra)
+        except BaseException as e:
+            for fut, _, _ in batch.waiters:
+                if not fut.done(): fut.set_exception(e if isinstance(e, Exception) else EmbeddingError(502, b'{"detail":"Embedding batch cancelled."}'))
+            return
+        # 上游只返回整批的 token 数，按输入字符数分摊给各请求
+        total_chars = sum(len(s) for s in batch.inputs) or 1
+        for fut, start, end in batch.waiters:
+            if fut.done(): continue
+            share = sum(len(s) for s in batch.inputs[start:end]) * tokens // total_chars
+            fut.set_result((vectors[start:end], share, key))
+
+    async def _run(self, url: str, user_id: str, model: str, inputs: List[str], extra: dict):
+        size = settings.EMBED_BATCH_SIZE
+        chunks = [inputs[i:i + size] for i in range(0, len(inputs), size)]
+        if len(chunks) == 1: return await self._post(url, user_id, model, chunks[0], extra)
+        sem = asyncio.Semaphore(max(1, settings.EMBED_CONCURRENCY))
+
+        async def one(chunk: List[str]):
+            async with sem: return await self._post(url, user_id, model, chunk, extra)
+
+        tasks = [asyncio.ensure_future(one(c)) for c in chunks]
+        try: results = await asyncio.gather(*tasks)
+        except BaseException:
+            # 任一分片失败 (或请求被取消) 时取消其余分片，不再消耗上游额度
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        vectors = [v for r in results for v in r[0]]
+        return vectors, sum(r[1] for r in results), results[0][2]
+
+    async def _post(self, url: str, user_id: str, model: str, inputs: List[str], extra: dict):
+        client = upstream.get_client()
+        body = upstream.prepare_body({"model": model, "input": inputs, **extra})
+        attempts = 0
+        try:
+            for key in await scheduler.get_keys(user_id) or [None]:
+                attempts += 1
+                self.upstream_calls += 1
+                scheduler.acquire(user_id, key)
+                started = time.monotonic()
+                body.sent()
+                try: resp = await client.post(url, content=body.content, headers={**upstream.headers(key), **body.headers})
+                except httpx.PoolTimeout: raise  # 本地连接池已满，不计为 Key 失败
+                except httpx.HTTPError:
+                    scheduler.report(user_id, key)
+                    continue
+                finally: scheduler.release(user_id, key)
+                status, data = resp.status_code, None
+                if status == 200:
+                    try: data = resp.json()
+                    except ValueError: status = None  # 响应体损坏按 Key 失败处理，换下一个 Key
+                scheduler.report(user_id, key, status, time.monotonic() - started, parse_retry_after(resp.headers.get("Retry-After")))
+                if status is None or status in (401, 403, 429) or status >= 500: continue
+                if status != 200: raise EmbeddingError(status, resp.content)
+                vectors = data.get("embeddings") or []
+                if len(vectors) != len(inputs): raise EmbeddingError(502, b'{"detail":"Upstream returned a wrong number of embeddings."}')
+                return vectors, data.get("prompt_eval_count", 0), key
+        finally: metrics.upstream_attempts.observe(attempts)
+        raise EmbeddingError(502, b'{"detail":"All keys failed."}')
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "upstream_calls": self.upstream_calls, "coalesced": self.coalesced, "pending_batches": len(self._pending)}
+
+embedder = Embedder()
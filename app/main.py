@@ -1,20 +1,57 @@
 import os
 import json
 import time
-import uuid
+import asyncio
 import secrets
 import httpx
-import random
 from pathlib import Path
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException, Depends, Form, Response
 from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+from typing import Awaitable, List, Optional
 import app.database as db
+import app.settings as settings
+import app.upstream as upstream
+import app.cache as cache
+from app.scheduler import scheduler, parse_retry_after
+from app.catalog import models_catalog
+from app.admission import admission, AdmissionRejected
+from app.response_cache import response_cache
+import app.streaming as streaming
+from app.transcode import StreamTranscoder
+from app.openai_compat import ChatCompletionRequest, ImageError, build_payload, cache_entry, completion_body, message_text, parse_request
+from app.openai_compat import EmbeddingRequest, embedding_body, embedding_inputs
+from app.embeddings import embedder, EmbeddingError, encode_base64
+import app.metrics as metrics
+import app.usage as usage
+from app.state import shared_state
+from app.security import login_guard
+from app.compression import CompressionMiddleware
+import app.breaker as breaker
+from app.breaker import CircuitOpen
+from app.timeouts import timeouts, use_idle_timeout
 
-app = FastAPI(title="Ollama Cloud Proxy", version="2.0.2")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upstream.start()
+    await usage.recorder.start()
+    await login_guard.start()
+    await shared_state.start()
+    lag_monitor = asyncio.ensure_future(metrics.monitor_loop_lag(settings.METRICS_LOOP_LAG_INTERVAL)) if settings.METRICS_ENABLED else None
+    try: yield
+    finally:
+        if lag_monitor is not None: lag_monitor.cancel()
+        await shared_state.close()
+        await login_guard.close()
+        await usage.recorder.close()
+        await upstream.close()
+        db.close()
+
+app = FastAPI(title="Ollama Cloud Proxy", version="2.0.2", lifespan=lifespan)
 
 @app.middleware("http")
 async def fix_double_slash(request: Request, call_next):
@@ -24,6 +61,18 @@ async def fix_double_slash(request: Request, call_next):
     return response
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+if settings.RESPONSE_COMPRESSION: app.add_middleware(CompressionMiddleware, minimum_size=settings.RESPONSE_COMPRESSION_MIN_BYTES)
+
+@app.exception_handler(CircuitOpen)
+async def circuit_open_handler(request: Request, exc: CircuitOpen):
+    # 熔断期间不再请求上游，直接告知客户端稍后重试
+    return JSONResponse(status_code=503, content={"detail": f"Upstream temporarily unavailable (circuit open: {exc.target})"},
+                        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(httpx.PoolTimeout)
+async def pool_timeout_handler(request: Request, exc: httpx.PoolTimeout):
+    # 本地连接池已满 (UPSTREAM_MAX_CONNECTIONS)，与上游及 Key 的健康无关
+    return JSONResponse(status_code=503, content={"detail": "Proxy is busy (upstream connection pool exhausted)"}, headers={"Retry-After": "1"})
 
 BASE_DIR = Path(__file__).resolve().parent
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
@@ -31,6 +80,9 @@ templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 if not os.path.exists("data"): os.makedirs("data")
 db.init_db()
 
+async def _config(name: str) -> Optional[str]:
+    return await cache.config.get_or_load(name, lambda: db.run(db.get_config, name))
+
 def get_client_ip(request: Request):
     forwarded = request.headers.get("X-Forwarded-For")
     if forwarded: return forwarded.split(",")[0]
@@ -41,34 +93,33 @@ SESSION_COOKIE_NAME = "proxy_session"
 async def get_current_user(request: Request):
     token = request.cookies.get(SESSION_COOKIE_NAME)
     if not token: raise HTTPException(401, "Not authenticated")
-    username = db.get_session_user(token)
-    if not username: raise HTTPException(401, "Session expired")
-    return username
+    # 缓存条目不超过会话本身的过期时间
+    session = await cache.sessions.get_or_load(token, lambda: db.run(db.get_session, token), lambda s: s[1] - time.time())
+    if not session: raise HTTPException(401, "Session expired")
+    return session[0]
+
+async def _lookup_client_key(key: str) -> Optional[str]:
+    return await cache.client_keys.get_or_load(key, lambda: db.run(db.verify_client_key_and_get_user, key))
 
 async def verify_client_key(request: Request):
     auth_header = request.headers.get("Authorization")
     if auth_header and auth_header.startswith("Bearer "):
         key = auth_header.split(" ")[1]
-        if db.verify_api_key(key): return key
+        if await _lookup_client_key(key): return key
     raise HTTPException(401, "Invalid API Key")
 
-async def get_user_from_client_key(request: Request):
+def _bearer_token(request: Request) -> Optional[str]:
     auth_header = request.headers.get("Authorization")
-    if auth_header and auth_header.startswith("Bearer "):
-        key = auth_header.split(" ")[1]
-        user_id = db.verify_client_key_and_get_user(key)
+    if auth_header and auth_header.startswith("Bearer "): return auth_header.split(" ")[1]
+    return None
+
+async def get_user_from_client_key(request: Request):
+    key = _bearer_token(request)
+    if key:
+        user_id = await _lookup_client_key(key)
         if user_id: return user_id
     raise HTTPException(401, "Invalid API Key")
 
-class ChatMessage(BaseModel):
-    role: str
-    content: str
-class ChatCompletionRequest(BaseModel):
-    model: str
-    messages: List[ChatMessage]
-    stream: Optional[bool] = False
-    temperature: Optional[float] = 0.7
-
 # --- Login & Register ---
 @app.get("/login", response_class=HTMLResponse)
 async def login_page(request: Request): return templates.TemplateResponse("login.html", {"request": request})
@@ -76,11 +127,13 @@ async def login_page(request: Request): return templates.TemplateResponse("login
 @app.post("/login")
 async def login_action(request: Request, response: Response, username: str = Form(...), password: str = Form(...)):
     client_ip = get_client_ip(request)
-    if db.is_ip_blocked(client_ip): 
+    if login_guard.is_blocked(client_ip): 
         return JSONResponse(status_code=403, content={"status": "error", "message": "您的IP已被封锁"})
-    success, msg = db.verify_login_security(username, password, client_ip)
+    success, msg, lock_ip = await db.run(db.verify_login, username, password)
+    if lock_ip: login_guard.block(client_ip, settings.LOGIN_BLOCK_SECONDS, "Too many login failures")
+    elif not success and login_guard.record_failure(client_ip): msg = "错误次数过多，IP已被封锁"
     if success:
-        token = db.create_session(username)
+        token = await db.run(db.create_session, username)
         response = JSONResponse({"status": "success"})
         response.set_cookie(key=SESSION_COOKIE_NAME, value=token, max_age=2592000, httponly=True)
         return response
@@ -92,18 +145,26 @@ async def register_page(request: Request): return templates.TemplateResponse("re
 @app.post("/register")
 async def register_action(request: Request, username: str = Form(...), password: str = Form(...), email: str = Form(...)):
     client_ip = get_client_ip(request)
-    if not db.check_registration_limit(client_ip): 
-        return JSONResponse(status_code=403, content={"status": "error", "message": "IP注册达限"})
+    if login_guard.is_blocked(client_ip): 
+        return JSONResponse(status_code=403, content={"status": "error", "message": "您的IP已被封锁"})
     if len(password) < 6: 
         return JSONResponse(status_code=400, content={"status": "error", "message": "密码太短"})
-    success, msg = db.create_user(username, password, email, client_ip)
-    if success: return JSONResponse({"status": "success", "message": "注册成功"})
+    if not login_guard.reserve_registration(client_ip): 
+        return JSONResponse(status_code=403, content={"status": "error", "message": "IP注册达限"})
+    try: success, msg = await db.run(db.create_user, username, password, email, client_ip)
+    except BaseException:
+        login_guard.release_registration(client_ip)
+        raise
+    if success:
+        login_guard.registered(client_ip)
+        return JSONResponse({"status": "success", "message": "注册成功"})
+    login_guard.release_registration(client_ip)
     return JSONResponse(status_code=400, content={"status": "error", "message": msg})
 
 @app.get("/logout")
 async def logout_action(response: Response, request: Request):
     token = request.cookies.get(SESSION_COOKIE_NAME)
-    if token: db.delete_session(token)
+    if token: await db.run(db.delete_session, token)
     resp = RedirectResponse(url="/login", status_code=302)
     resp.delete_cookie(SESSION_COOKIE_NAME)
     return resp
@@ -118,7 +179,7 @@ async def profile_page(request: Request):
 async def change_pwd_api(old_password: str = Form(...), new_password: str = Form(...), user: str = Depends(get_current_user)):
     if len(new_password) < 6: 
         return JSONResponse(status_code=400, content={"status": "error", "message": "新密码太短"})
-    success, msg = db.change_user_password(user, old_password, new_password)
+    success, msg = await db.run(db.change_user_password, user, old_password, new_password)
     if success: return JSONResponse({"status": "success", "message": msg})
     return JSONResponse(status_code=400, content={"status": "error", "message": msg})
 
@@ -126,139 +187,611 @@ async def change_pwd_api(old_password: str = Form(...), new_password: str = Form
 async def admin_page(request: Request):
     try: user = await get_current_user(request)
     except: return RedirectResponse("/login", 302)
-    ollama_host = db.get_config("ollama_host") or "https://ollama.com/api/chat"
-    upstream_keys = db.get_user_upstream_keys(user)
-    keys = db.list_api_keys(user)
-    return templates.TemplateResponse("admin.html", {"request": request, "username": user, "ollama_host": ollama_host, "upstream_keys": upstream_keys, "keys": keys})
+    ollama_host = await _config("ollama_host") or "https://ollama.com/api/chat"
+    upstream_keys = await db.run(db.get_user_upstream_keys, user)
+    health = {h["key"]: h for h in scheduler.snapshot(user)}
+    for uk in upstream_keys: uk["health"] = health.get(uk["key"])
+    keys = await db.run(db.list_api_keys, user)
+    usage_rows = await db.run(db.get_usage, user, time.time() - 86400, ("client_key", "model"))
+    return templates.TemplateResponse("admin.html", {"request": request, "username": user, "ollama_host": ollama_host, "upstream_keys": upstream_keys, "keys": keys, "usage": usage_rows,
+                                                     "host_breaker": breaker.hosts.get(ollama_host).snapshot()})
 
 @app.post("/admin/config")
 async def update_config(ollama_host: str = Form(...), _: str = Depends(get_current_user)):
-    db.set_config("ollama_host", ollama_host)
+    await db.run(db.set_config, "ollama_host", ollama_host)
     return JSONResponse({"status": "success"})
 
 @app.post("/admin/upstream_keys")
 async def add_upstream(key: str = Form(...), remarks: str = Form(...), user: str = Depends(get_current_user)):
-    if db.add_upstream_key(key, remarks, user): return JSONResponse({"status": "success"})
+    if await db.run(db.add_upstream_key, key, remarks, user):
+        await scheduler.reload(user)
+        models_catalog.invalidate_user(user)
+        shared_state.keys_changed(user)
+        return JSONResponse({"status": "success"})
     # [修复] 显式指定 status_code 参数
     return JSONResponse(status_code=400, content={"status": "error", "message": "添加失败"})
 
 @app.delete("/admin/upstream_keys")
 async def del_upstream(key: str, user: str = Depends(get_current_user)):
-    db.delete_upstream_key(key, user)
+    await db.run(db.delete_upstream_key, key, user)
+    await scheduler.reload(user)
+    models_catalog.invalidate_user(user)
+    shared_state.keys_changed(user)
     return JSONResponse({"status": "success"})
 
 @app.post("/admin/keys")
 async def generate_key(name: str = Form(...), user: str = Depends(get_current_user)):
     new_key = f"sk-prox-{secrets.token_urlsafe(24)}"
-    if db.create_api_key(new_key, name, user): return JSONResponse({"status": "success", "key": new_key})
+    if await db.run(db.create_api_key, new_key, name, user): return JSONResponse({"status": "success", "key": new_key})
     return JSONResponse(status_code=400, content={"status": "error"})
 
 @app.delete("/admin/keys/{key}")
 async def remove_key(key: str, user: str = Depends(get_current_user)):
-    db.delete_api_key(key, user)
+    await db.run(db.delete_api_key, key, user)
     return JSONResponse({"status": "success"})
 
 # --- 核心调度逻辑 ---
 async def _get_user_key_pool(user_id: str):
-    keys = db.get_user_upstream_keys(user_id)
-    random.shuffle(keys)
+    keys = await scheduler.get_keys(user_id)
     if not keys: return [{"key": None}]
-    return keys
+    return [{"key": k} for k in keys]
 
 # 列表模型逻辑
-async def _list_models_logic(user_id: Optional[str] = None):
-    ollama_host = db.get_config("ollama_host")
-    fallback = [{"id": "gpt-3.5-turbo", "object": "model", "created": 0, "owned_by": "openai"}]
-    
-    keys = []
-    if user_id: keys = await _get_user_key_pool(user_id)
-    else: keys = [{"key": db.get_config("ollama_key")}] # 兼容
+MODELS_FALLBACK = [{"id": "gpt-3.5-turbo", "object": "model", "created": 0, "owned_by": "openai"}]
 
-    target = ollama_host.replace("/api/chat", "/api/tags")
-    
-    for k_obj in keys:
-        key = k_obj["key"]
-        headers = {}
-        if key: headers["Authorization"] = f"Bearer {key}"
-        try:
-            async with httpx.AsyncClient(timeout=5, verify=False) as client:
-                resp = await client.get(target, headers=headers)
-                if resp.status_code == 200:
-                    models = [{"id": m.get("name"), "object": "model", "created": int(time.time()), "owned_by": "ollama"} for m in resp.json().get("models", [])]
-                    if models: return {"object": "list", "data": models}
-        except: pass
-    return {"object": "list", "data": fallback}
+async def _fetch_tags(target: str, key: Optional[str], user_id: Optional[str]) -> Optional[List[dict]]:
+    headers = {}
+    if key: headers["Authorization"] = f"Bearer {key}"
+    scheduler.acquire(user_id, key)
+    status = None
+    cancelled = False
+    try:
+        resp = await upstream.get_client().get(target, headers=headers, timeout=settings.UPSTREAM_MODELS_TIMEOUT)
+        status = resp.status_code
+        if resp.status_code == 200:
+            created = int(time.time())
+            return [{"id": m.get("name"), "object": "model", "created": created, "owned_by": "ollama"} for m in resp.json().get("models", [])]
+    except (asyncio.CancelledError, httpx.PoolTimeout):
+        cancelled = True  # 请求被取消或本地连接池已满，不计为 Key 失败
+        raise
+    except Exception: pass
+    finally:
+        if not cancelled: scheduler.report(user_id, key, status)
+        scheduler.release(user_id, key)
+    return None
+
+async def _first_tags(target: str, keys: List[Optional[str]], user_id: Optional[str]) -> Optional[List[dict]]:
+    """按调度顺序逐个 Key 请求 /api/tags，第一个成功即返回 (每次刷新通常只消耗一次上游请求)"""
+    for key in keys:
+        models = await _fetch_tags(target, key, user_id)
+        if models: return models
+    return None
+
+async def _load_models(target: str, user_id: Optional[str]) -> Optional[List[dict]]:
+    # 熔断期间不请求上游，按失败处理 (有旧列表时继续返回旧值)
+    if not breaker.hosts.get(target).allow(): return None
+    try:
+        if user_id: keys = [k["key"] for k in await _get_user_key_pool(user_id)]
+        else: keys = [await _config("ollama_key")] # 兼容
+    except CircuitOpen: return None
+    return await _first_tags(target, keys, user_id)
+
+async def _list_models_logic(user_id: Optional[str] = None, force: bool = False):
+    """返回缓存的模型列表条目 (catalog.CatalogEntry)，全部 Key 失败且无旧值时返回 None"""
+    started = time.monotonic()
+    try:
+        ollama_host = await _config("ollama_host")
+
+        target = ollama_host.replace("/api/chat", "/api/tags")
+        # 每个用户的 Key 池不同，缓存按 (host, 用户) 区分
+        cache_key = (target, user_id)
+        return await models_catalog.get(cache_key, lambda: _load_models(target, user_id), force=force)
+    finally: metrics.models_seconds.observe(time.monotonic() - started)
+
+async def _models_response(request: Request):
+    user_id = None
+    auth_header = request.headers.get("Authorization")
+    if auth_header and auth_header.startswith("Bearer "): user_id = await _lookup_client_key(auth_header.split(" ")[1])
+    entry = await _list_models_logic(user_id)
+    if entry is None:
+        return JSONResponse({"object": "list", "data": MODELS_FALLBACK}, headers={"Cache-Control": "no-store"})
+    headers = {"ETag": entry.etag, "Cache-Control": f"private, max-age={max(0, int(models_catalog.ttl - entry.age()))}"}
+    if entry.etag in request.headers.get("If-None-Match", ""): return Response(status_code=304, headers=headers)
+    return JSONResponse({"object": "list", "data": entry.models}, headers=headers)
 
 @app.post("/api/test-connection")
 async def test_conn(user: str = Depends(get_current_user)):
-    res = await _list_models_logic(user)
-    data = res.get("data", [])
-    models = [m["id"] for m in data if m.get("owned_by") == "ollama"]
+    entry = await _list_models_logic(user, force=True)
+    models = [m["id"] for m in entry.models] if entry else []
     
     if models:
         return JSONResponse({"status": "success", "message": f"连接成功! 发现 {len(models)} 个可用模型", "models": models})
     else:
         return JSONResponse(status_code=500, content={"status": "error", "message": "连接失败或无可用模型"})
 
-async def _chat_logic(req: ChatCompletionRequest, user_id: str):
-    ollama_host = db.get_config("ollama_host")
-    if not ollama_host: raise HTTPException(500, "Config missing")
-    keys_pool = await _get_user_key_pool(user_id)
-    
-    for k_obj in keys_pool:
-        key = k_obj["key"]
-        headers = {"Content-Type": "application/json"}
-        if key: headers["Authorization"] = f"Bearer {key}"
-        client = httpx.AsyncClient(timeout=120, verify=False)
-        
+@app.get("/api/stats")
+async def proxy_stats(user: str = Depends(get_current_user)):
+    return {
+        "upstream_pool": upstream.pool_stats(),
+        "upstream_keys": scheduler.snapshot(user),
+        "upstream_hosts": breaker.hosts.snapshot(),
+        "timeouts": timeouts.stats(),
+        "auth_cache": {"client_keys": cache.client_keys.stats(), "sessions": cache.sessions.stats()},
+        "models_cache": models_catalog.stats(),
+        "streams": streaming.metrics.snapshot(),
+        "admission": admission.stats(),
+        "response_cache": response_cache.stats(),
+        "embeddings": embedder.stats(),
+        "login_guard": login_guard.stats(),
+        "usage": usage.recorder.stats(),
+        "shared_state": shared_state.stats(),
+    }
+
+@app.get("/api/usage")
+async def usage_api(hours: int = 24, group_by: str = "model", user: str = Depends(get_current_user)):
+    """按小时汇总的用量: group_by 可组合 model / client_key / upstream_key / hour (逗号分隔)"""
+    groups = [g.strip() for g in group_by.split(",") if g.strip()] or ["model"]
+    unknown = [g for g in groups if g not in db.USAGE_GROUP_COLUMNS]
+    if unknown: raise HTTPException(400, f"Unsupported group_by: {', '.join(unknown)}")
+    # 先写入缓冲中的记录，保证刚结束的请求也能查到
+    await usage.recorder.flush()
+    rows = await db.run(db.get_usage, user, time.time() - hours * 3600, groups)
+    return {"hours": hours, "group_by": groups, "data": rows}
+
+metrics.registry.gauge("proxy_admission_inflight", "Chat requests currently admitted", lambda: admission.stats()["inflight"])
+metrics.registry.gauge("proxy_admission_queue_depth", "Chat requests waiting for admission", lambda: admission.stats()["queue_depth"])
+
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    if not settings.METRICS_ENABLED: raise HTTPException(404, "Not Found")
+    if settings.METRICS_TOKEN and not secrets.compare_digest(_bearer_token(request) or "", settings.METRICS_TOKEN):
+        raise HTTPException(401, "Invalid metrics token")
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+class _KeyFailed(Exception):
+    """当前 Key 不可用 (401/403/429/5xx/连接错误)，应切换下一个 Key"""
+
+class _UpstreamError(Exception):
+    """上游返回与 Key 无关的错误 (如模型不存在)，直接透传给客户端"""
+    def __init__(self, status: int, body: bytes):
+        self.status = status
+        self.body = body
+
+    def to_response(self) -> JSONResponse:
+        try: content = json.loads(self.body)
+        except ValueError: content = {"error": self.body.decode(errors="replace")}
+        return JSONResponse(status_code=self.status, content=content)
+
+async def _open_stream(url: str, body: upstream.RequestBody, key: Optional[str], user_id: str, model: str, raw: bool = False):
+    """建立上游流式连接并预读首行: 状态码确认正常后才交给客户端，失败时可以无感切换 Key。
+    raw=True 时返回 aiter_raw() 的字节块迭代器与首个字节块，不做逐行解码"""
+    client = upstream.get_client()
+    scheduler.acquire(user_id, key)
+    started = time.monotonic()
+    resp = None
+    ok = False
+    headers = {**upstream.headers(key), **body.headers}
+    # 原样透传字节时要求上游不压缩，客户端收到的就是明文 NDJSON
+    if raw: headers["Accept-Encoding"] = "identity"
+    body.sent()
+    try:
+        # 连接 / 首字节 / chunk 间空闲分别计时，首字节与空闲超时按该模型的历史延迟自适应
+        request = client.build_request("POST", url, headers=headers, content=body.content, timeout=timeouts.stream(model))
+        try: resp = await client.send(request, stream=True)
+        except httpx.PoolTimeout: raise  # 本地连接池已满，不是 Key 的问题
+        except httpx.TransportError:
+            scheduler.report(user_id, key)
+            raise _KeyFailed()
+        status = resp.status_code
+        if status != 200:
+            try: error_body = await resp.aread()
+            except httpx.HTTPError: error_body = b""
+            scheduler.report(user_id, key, status, retry_after=parse_retry_after(resp.headers.get("Retry-After")))
+            if status in (401, 403, 429) or status >= 500: raise _KeyFailed()
+            raise _UpstreamError(status, error_body)
+        use_idle_timeout(resp, timeouts.idle(model))
+        lines = resp.aiter_raw() if raw else resp.aiter_lines()
+        first = b"" if raw else ""
         try:
-            payload = {"model": req.model, "messages": [{"role": m.role, "content": m.content} for m in req.messages], "stream": req.stream, "options": {"temperature": req.temperature}}
+            while not first: first = await lines.__anext__()
+        except (httpx.HTTPError, StopAsyncIteration):
+            scheduler.report(user_id, key)
+            raise _KeyFailed()
+        ttfb = time.monotonic() - started
+        scheduler.report(user_id, key, status, ttfb)
+        metrics.ttfb_seconds.observe(ttfb, model)
+        timeouts.observe_ttfb(model, ttfb)
+        ok = True
+        return key, resp, lines, first
+    finally:
+        # 失败或被对冲请求取消时立即归还连接
+        if not ok:
+            if resp is not None: await resp.aclose()
+            scheduler.release(user_id, key)
+
+_NO_KEY = object()
+
+async def _open_first_stream(url: str, body: upstream.RequestBody, keys: List[Optional[str]], user_id: str, model: str, raw: bool = False):
+    """依次尝试 Key 直到建立流。开启对冲 (STREAM_HEDGE_DELAY_MS) 时，若当前请求超时未出首个 token，
+    则并发启动下一个 Key，保留先响应的一方并取消另一方"""
+    remaining = iter(keys)
+    pending = set()
+    hedges = 0
+    launched = 0
+    hedge_delay = settings.STREAM_HEDGE_DELAY_MS / 1000
+    exhausted = None
+
+    def launch() -> bool:
+        nonlocal launched
+        key = next(remaining, _NO_KEY)
+        if key is _NO_KEY: return False
+        launched += 1
+        pending.add(asyncio.ensure_future(_open_stream(url, body, key, user_id, model, raw)))
+        return True
+
+    launch()
+    try:
+        while pending:
+            can_hedge = hedge_delay > 0 and hedges < settings.STREAM_HEDGE_MAX
+            done, _ = await asyncio.wait(pending, timeout=hedge_delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                launch()
+                continue
+            for task in done:
+                pending.discard(task)
+                if task.exception() is None: return task.result()
+                if isinstance(task.exception(), _UpstreamError): raise task.exception()
+                if isinstance(task.exception(), httpx.PoolTimeout): exhausted = task.exception()
+            if pending: continue
+            # 连接池已满时换 Key 也拿不到连接，直接返回 503
+            if exhausted is not None: raise exhausted
+            launch()
+    finally:
+        metrics.upstream_attempts.observe(launched)
+        for task in pending: task.cancel()
+        # 同时完成的对冲请求也要关闭，避免连接泄漏
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, tuple):
+                await result[1].aclose()
+                scheduler.release(user_id, result[0])
+    raise HTTPException(502, "All keys failed.")
+
+async def _parse_chat_request(request: Request) -> ChatCompletionRequest:
+    # 错误信息不回显输入 (可能是整张 base64 图片)
+    body = await request.body()
+    try: return parse_request(body)
+    except ValidationError as e: raise _validation_error(e)
+    except ValueError as e: raise RequestValidationError([{"type": "json_invalid", "loc": ("body",), "msg": str(e) or "JSON decode error"}])
+
+def _validation_error(e: ValidationError) -> RequestValidationError:
+    # 与 FastAPI 自身的请求体校验错误格式一致 (loc 以 body 开头)，不回显输入
+    return RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False, include_input=False)])
+
+def _cache_policy(req: ChatCompletionRequest, request: Optional[Request]) -> Optional[str]:
+    """响应缓存策略: None 不参与缓存; "use" 读写缓存; "refresh" (no-cache) 跳过读取但写入新结果; "bypass" (no-store) 完全跳过"""
+    if not settings.RESPONSE_CACHE_ENABLED or req.temperature != 0: return None
+    cache_control = request.headers.get("Cache-Control", "").lower() if request is not None else ""
+    if "no-store" in cache_control: return "bypass"
+    if "no-cache" in cache_control: return "refresh"
+    return "use"
+
+def _include_usage(req: ChatCompletionRequest) -> bool:
+    return bool(req.stream_options and req.stream_options.get("include_usage"))
+
+def _cached_chat_response(req: ChatCompletionRequest, cached: dict) -> Response:
+    headers = {"X-Proxy-Cache": "HIT"}
+    if req.stream:
+        return StreamingResponse(streaming.replay(req.model, cached, _include_usage(req)), media_type="text/event-stream", headers=headers)
+    return JSONResponse(completion_body(req.model, cached), headers=headers)
+
+def _estimate_tokens(req: ChatCompletionRequest) -> int:
+    # 粗略估算 (约 4 字符 / token，图片按固定值计)，仅用于 TPM 准入
+    images = sum(1 for m in req.messages if isinstance(m.content, list) for p in m.content if p.type == "image_url")
+    return sum(len(message_text(m)) for m in req.messages) // 4 + images * settings.IMAGE_TOKEN_ESTIMATE + 1
+
+async def _chat_logic(req: ChatCompletionRequest, user_id: str, request: Optional[Request] = None):
+    return await _tracked(request, user_id, req.model, _serve_chat(req, user_id, request))
+
+def _error_status(e: BaseException) -> int:
+    """异常最终返回给客户端的状态码 (与异常处理器一致)"""
+    if isinstance(e, HTTPException): return e.status_code
+    if isinstance(e, (CircuitOpen, httpx.PoolTimeout)): return 503  # circuit_open_handler / pool_timeout_handler
+    return 500
+
+async def _tracked(request: Optional[Request], user_id: str, model: str, serve: Awaitable):
+    """执行一次对外接口请求并记录指标 (状态码、耗时) 与失败请求的用量"""
+    started = time.monotonic()
+    status = 500
+    try:
+        resp = await serve
+        status = resp.status_code if isinstance(resp, Response) else 200
+        return resp
+    except Exception as e:
+        status = _error_status(e)
+        raise
+    finally: _record_request(request, user_id, model, status, started)
+
+async def _admit(request: Optional[Request], user_id: str, tokens: int):
+    """申请准入，受限时转为 429 + Retry-After"""
+    try: return await admission.admit(user_id, _bearer_token(request) if request is not None else None, tokens)
+    except AdmissionRejected as e:
+        raise HTTPException(429, f"Too many requests ({e.reason})", headers={"Retry-After": str(e.retry_after)})
+
+def _record_request(request: Optional[Request], user_id: str, model: str, status: int, started: float):
+    # 成功请求的用量在拿到 token 数后记录，这里只记录失败请求
+    if status >= 400: usage.recorder.record(user_id, _bearer_token(request) if request is not None else None, None, model, status)
+    route = request.scope["path"] if request is not None else "internal"
+    metrics.requests_total.inc(route, model, status)
+    metrics.request_seconds.observe(time.monotonic() - started, route)
+
+async def _serve_chat(req: ChatCompletionRequest, user_id: str, request: Optional[Request]):
+    ollama_host = await _config("ollama_host")
+    if not ollama_host: raise HTTPException(500, "Config missing")
+    try: payload = await build_payload(req)
+    except ImageError as e: raise HTTPException(400, str(e))
+
+    policy = _cache_policy(req, request)
+    fill = None
+    if policy in ("use", "refresh"):
+        cache_key = response_cache.key_for(user_id, payload)
+        cached = await response_cache.get(cache_key) if policy == "use" else None
+        if cached is None:
+            fill, pending = response_cache.join(cache_key, refresh=policy == "refresh")
+            # 相同请求正在执行: 等待其结果 (领头请求失败或超时时自己再请求一次，不写缓存)
+            if pending is not None: cached = await _await_leader(req, user_id, request, pending)
+        if cached is not None:
+            # 缓存命中不消耗上游额度，upstream_key 留空
+            usage.recorder.record(user_id, _bearer_token(request) if request is not None else None, None, req.model, 200,
+                                  cached["prompt_tokens"], cached["completion_tokens"], stream=bool(req.stream))
+            return _cached_chat_response(req, cached)
+
+    try:
+        breaker.hosts.check(ollama_host)
+        keys_pool = await _get_user_key_pool(user_id)
+    except CircuitOpen:
+        if fill is not None: fill.abort()
+        raise
+    try: ticket = await _admit(request, user_id, _estimate_tokens(req))
+    except HTTPException:
+        if fill is not None: fill.abort()
+        raise
+    # 请求体只序列化 (及压缩) 一次，所有 Key 尝试复用
+    try: resp = await _dispatch_chat(req, user_id, request, ollama_host, keys_pool, upstream.prepare_body(payload), ticket, fill)
+    except BaseException:
+        ticket.release()
+        if fill is not None: fill.abort()
+        raise
+    # 流式响应持有 ticket 直到流结束，由 close_upstream 释放
+    if not isinstance(resp, streaming.RelayResponse):
+        ticket.release()
+        if fill is not None: fill.abort()
+    if policy is not None:
+        if not isinstance(resp, Response): resp = JSONResponse(resp)
+        resp.headers["X-Proxy-Cache"] = "BYPASS" if policy in ("bypass", "refresh") else "MISS"
+    return resp
+
+async def _await_leader(req: ChatCompletionRequest, user_id: str, request: Optional[Request], pending: asyncio.Future) -> Optional[dict]:
+    """等待正在执行的相同请求: 等待期间同样占用准入名额，最多等待 UPSTREAM_READ_TIMEOUT 秒"""
+    ticket = await _admit(request, user_id, 0)
+    try: return await asyncio.wait_for(asyncio.shield(pending), settings.UPSTREAM_READ_TIMEOUT)
+    except asyncio.TimeoutError: return None
+    finally: ticket.release()
+
+async def _dispatch_chat(req: ChatCompletionRequest, user_id: str, request: Optional[Request], ollama_host: str, keys_pool: list, body: upstream.RequestBody, ticket, fill):
+    request_started = time.monotonic()
+    if req.stream:
+        try: key, r, lines, first = await _open_first_stream(ollama_host, body, [k["key"] for k in keys_pool], user_id, req.model)
+        except _UpstreamError as e: return e.to_response()
+
+        closed = False
+        async def close_upstream():
+            nonlocal closed
+            if closed: return
+            closed = True
+            await r.aclose()
+            scheduler.release(user_id, key)
+            ticket.release()
+            if fill is not None: fill.abort()
+
+        def on_finish(transcoder, status):
+            # 流中途中断 (含 chunk 间空闲超时) 计入该 Key 的失败
+            if status == 502: scheduler.report(user_id, key)
+            last = transcoder.last or {}
+            prompt_tokens, completion_tokens = last.get("prompt_eval_count", 0), last.get("eval_count", transcoder.tokens)
+            usage.recorder.record(user_id, ticket.client_key, key, req.model, status, prompt_tokens, completion_tokens, time.monotonic() - request_started, True)
+            if fill is None: return
+            if status != 200 or not transcoder.done: return fill.abort()
+            fill.complete({"content": "".join(transcoder.captured), "reasoning": "".join(transcoder.reasoning), "tool_calls": transcoder.tool_calls,
+                           "finish_reason": transcoder.finish_reason, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+
+        transcoder = StreamTranscoder(req.model, capture=fill is not None, include_usage=_include_usage(req))
+        return streaming.RelayResponse(streaming.relay(request, transcoder, first, lines, close_upstream, on_finish), close_upstream, media_type="text/event-stream")
+
+    client = upstream.get_client()
+    attempts = 0
+    # 首个非网关类 5xx (500 等，可能由请求本身引起: 模型崩溃、上下文超长): 先不计入 Key 健康，只换一个 Key 重试一次
+    server_error = None  # (key, status, resp)
+    try:
+        for k_obj in keys_pool:
+            key = k_obj["key"]
+            attempts += 1
+            scheduler.acquire(user_id, key)
+            started = time.monotonic()
+            try:
+                body.sent()
+                try: resp = await client.post(ollama_host, content=body.content, headers={**upstream.headers(key), **body.headers})
+                # 只处理上游错误: 客户端断开时的 CancelledError 与本地连接池超时必须向上传递，不能记为 Key 失败
+                except httpx.PoolTimeout: raise
+                except (httpx.HTTPError, CircuitOpen):
+                    scheduler.report(user_id, key)
+                    continue
+                status, ollama_data = resp.status_code, None
+                if status == 200:
+                    try: ollama_data = resp.json()
+                    except ValueError: status = None  # 响应体损坏按 Key 失败处理，换下一个 Key
+                if status is not None and status >= 500 and (server_error is not None or status not in (502, 503, 504)):
+                    if server_error is None:
+                        server_error = (key, status, resp)
+                        continue
+                    # 换 Key 后仍然 5xx: 计入两个 Key 的失败，不再继续尝试
+                    scheduler.report(user_id, server_error[0], server_error[1])
+                    scheduler.report(user_id, key, status)
+                    server_error = None
+                    return _upstream_response(resp)
+                scheduler.report(user_id, key, status, time.monotonic() - started, parse_retry_after(resp.headers.get("Retry-After")))
+            
+                # 401 / 403 / 429 / 502-504 换下一个 Key；其余 4xx 是请求本身的问题，原样返回给客户端
+                if status is None or status in (401, 403, 429) or status >= 500: continue
+                if status != 200: return _upstream_response(resp)
             
-            if req.stream:
-                async def stream_gen():
-                    try:
-                        async with client.stream("POST", ollama_host, json=payload, headers=headers) as r:
-                            if r.status_code in [401, 403]:
-                                yield f"data: {json.dumps({'error': 'Quota exceeded, retrying...'})}\n\n"
-                                return
-                            async for line in r.aiter_lines():
-                                if not line: continue
-                                try:
-                                    d = json.loads(line)
-                                    if d.get("done"): yield "data: [DONE]\n\n"; break
-                                    c = d.get("message", {}).get("content", "")
-                                    yield f"data: {json.dumps({'id':'chatcmpl-1','object':'chat.completion.chunk','created':int(time.time()),'model':req.model,'choices':[{'index':0,'delta':{'content':c},'finish_reason':None}]})}\n\n"
-                                except: pass
-                    finally: await client.aclose()
-                return StreamingResponse(stream_gen(), media_type="text/event-stream")
-            else:
-                resp = await client.post(ollama_host, json=payload, headers=headers)
-                await client.aclose()
-                
-                if resp.status_code in [401, 403]: continue
-                if resp.status_code != 200: return JSONResponse(status_code=resp.status_code, content=resp.json())
-                
-                ollama_data = resp.json()
-                content = ollama_data.get("message", {}).get("content", "")
-                openai_resp = {
-                    "id": f"chatcmpl-{uuid.uuid4()}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": req.model,
-                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
-                    "usage": {"prompt_tokens": ollama_data.get("prompt_eval_count", 0), "completion_tokens": ollama_data.get("eval_count", 0), "total_tokens": 0}
-                }
-                return openai_resp
-        except: await client.aclose(); continue
+                entry = cache_entry(ollama_data.get("message") or {}, ollama_data)
+                usage.recorder.record(user_id, ticket.client_key, key, req.model, 200, entry["prompt_tokens"], entry["completion_tokens"], time.monotonic() - request_started)
+                if fill is not None: fill.complete(entry)
+                return completion_body(req.model, entry)
+            except httpx.PoolTimeout: raise
+            except (httpx.HTTPError, ValueError): continue
+            finally: scheduler.release(user_id, key)
+    finally:
+        metrics.upstream_attempts.observe(attempts)
+        # 重试的 Key 成功或没有可用 Key 时，首个 5xx 只计入指标，不影响 Key 健康
+        if server_error is not None: metrics.record_upstream(server_error[0], server_error[1])
+
+    if server_error is not None: return _upstream_response(server_error[2])
+    raise HTTPException(502, "All keys failed.")
+
+def _upstream_response(resp: httpx.Response) -> Response:
+    return Response(resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type", "application/json"))
+
+# --- Ollama 原生接口透传 ---
+def _native_url(ollama_host: str, path: str) -> str:
+    return ollama_host.replace("/api/chat", path)
+
+async def _native_logic(request: Request, user_id: str, path: str):
+    body = await request.body()
+    try: meta = json.loads(body)
+    except ValueError: meta = None
+    if not isinstance(meta, dict): raise HTTPException(400, "Invalid JSON body")
+    model = str(meta.get("model") or "")
+    return await _tracked(request, user_id, model, _native_stream(request, user_id, path, body, model, meta.get("stream", True) is not False))
+
+async def _native_stream(request: Request, user_id: str, path: str, body: bytes, model: str, stream: bool):
+    """/api/chat 与 /api/generate: 原始请求体直接转发，上游响应字节块原样透传 (仍经过 Key 调度与故障转移)"""
+    ollama_host = await _config("ollama_host")
+    if not ollama_host: raise HTTPException(500, "Config missing")
+    breaker.hosts.check(ollama_host)
+    keys_pool = await _get_user_key_pool(user_id)
+    client_key = _bearer_token(request)
+    ticket = await _admit(request, user_id, len(body) // 4 + 1)
+    started = time.monotonic()
+    try: key, r, chunks, first = await _open_first_stream(_native_url(ollama_host, path), upstream.prepare_body(body), [k["key"] for k in keys_pool], user_id, model, raw=True)
+    except _UpstreamError as e:
+        ticket.release()
+        return Response(e.body, status_code=e.status, media_type="application/json")
+    except BaseException:
+        ticket.release()
+        raise
 
+    closed = False
+    async def close_upstream():
+        nonlocal closed
+        if closed: return
+        closed = True
+        await r.aclose()
+        scheduler.release(user_id, key)
+        ticket.release()
+
+    def on_finish(done: Optional[dict], status: int):
+        if status == 502: scheduler.report(user_id, key)
+        done = done or {}
+        usage.recorder.record(user_id, client_key, key, model, status, done.get("prompt_eval_count", 0), done.get("eval_count", 0), time.monotonic() - started, stream)
+
+    return streaming.RelayResponse(streaming.relay_raw(first, chunks, close_upstream, on_finish, model), close_upstream,
+                                   media_type=r.headers.get("content-type", "application/x-ndjson"))
+
+async def _native_simple_logic(request: Request, user_id: str, method: str, path: str):
+    body = await request.body() if method == "POST" else None
+    model = ""
+    if body:
+        try: meta = json.loads(body)
+        except ValueError: meta = None
+        if isinstance(meta, dict): model = str(meta.get("model") or meta.get("name") or "")
+    return await _tracked(request, user_id, model, _native_simple(request, user_id, method, path, body, model))
+
+async def _native_simple(request: Request, user_id: str, method: str, path: str, body: Optional[bytes], model: str):
+    """/api/tags 与 /api/show: 非流式请求，按调度顺序尝试 Key"""
+    ollama_host = await _config("ollama_host")
+    if not ollama_host: raise HTTPException(500, "Config missing")
+    url = _native_url(ollama_host, path)
+    breaker.hosts.check(url)
+    keys_pool = await _get_user_key_pool(user_id)
+    ticket = await _admit(request, user_id, len(body or b"") // 4 + 1)
+    client = upstream.get_client()
+    started = time.monotonic()
+    try:
+        for k_obj in keys_pool:
+            key = k_obj["key"]
+            scheduler.acquire(user_id, key)
+            attempt_started = time.monotonic()
+            try: resp = await client.request(method, url, content=body, headers=upstream.headers(key), timeout=settings.UPSTREAM_MODELS_TIMEOUT)
+            except httpx.PoolTimeout: raise
+            except httpx.HTTPError:
+                scheduler.report(user_id, key)
+                continue
+            finally: scheduler.release(user_id, key)
+            scheduler.report(user_id, key, resp.status_code, time.monotonic() - attempt_started, parse_retry_after(resp.headers.get("Retry-After")))
+            if resp.status_code in (401, 403, 429) or resp.status_code >= 500: continue
+            if resp.status_code == 200: usage.recorder.record(user_id, ticket.client_key, key, model, 200, duration=time.monotonic() - started)
+            return _upstream_response(resp)
+    finally: ticket.release()
     raise HTTPException(502, "All keys failed.")
 
+# --- Embeddings ---
+async def _embeddings_logic(request: Request, user_id: str):
+    body = await request.body()
+    try: req = EmbeddingRequest.model_validate_json(body)
+    except ValidationError as e: raise _validation_error(e)
+    return await _tracked(request, user_id, req.model, _serve_embeddings(request, user_id, req))
+
+async def _serve_embeddings(request: Request, user_id: str, req: EmbeddingRequest):
+    try: inputs = embedding_inputs(req)
+    except ValueError as e: raise HTTPException(400, str(e))
+    if not inputs: raise HTTPException(400, "input must not be empty")
+    if len(inputs) > settings.EMBED_MAX_INPUTS: raise HTTPException(400, f"Too many inputs (max {settings.EMBED_MAX_INPUTS})")
+    if req.encoding_format not in (None, "float", "base64"): raise HTTPException(400, "encoding_format must be float or base64")
+    ollama_host = await _config("ollama_host")
+    if not ollama_host: raise HTTPException(500, "Config missing")
+    breaker.hosts.check(ollama_host)
+    client_key = _bearer_token(request)
+    ticket = await _admit(request, user_id, sum(len(s) for s in inputs) // 4 + 1)
+    started = time.monotonic()
+    extra = {"dimensions": req.dimensions} if req.dimensions else {}
+    try: vectors, prompt_tokens, key = await embedder.embed(_native_url(ollama_host, "/api/embed"), user_id, req.model, inputs, extra)
+    except EmbeddingError as e: return Response(e.body, status_code=e.status, media_type="application/json")
+    finally: ticket.release()
+    usage.recorder.record(user_id, client_key, key, req.model, 200, prompt_tokens, 0, time.monotonic() - started)
+    return JSONResponse(embedding_body(req.model, vectors, prompt_tokens, encode_base64 if req.encoding_format == "base64" else None))
+
 # --- Routes ---
 @app.get("/v1/models")
-async def list_models_v1(): return await _list_models_logic()
+async def list_models_v1(request: Request): return await _models_response(request)
 @app.post("/v1/chat/completions")
-async def chat_completions_v1(req: ChatCompletionRequest, user_id: str = Depends(get_user_from_client_key)): return await _chat_logic(req, user_id)
+async def chat_completions_v1(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _chat_logic(await _parse_chat_request(request), user_id, request)
+@app.post("/v1/embeddings")
+async def embeddings_v1(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _embeddings_logic(request, user_id)
 @app.get("/models")
-async def list_models_root(): return await _list_models_logic()
+async def list_models_root(request: Request): return await _models_response(request)
 @app.post("/chat/completions")
-async def chat_completions_root(req: ChatCompletionRequest, user_id: str = Depends(get_user_from_client_key)): return await _chat_logic(req, user_id)
+async def chat_completions_root(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _chat_logic(await _parse_chat_request(request), user_id, request)
+@app.post("/embeddings")
+async def embeddings_root(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _embeddings_logic(request, user_id)
+
+# Ollama 原生接口 (同样使用 sk-prox- Client Key 鉴权)
+@app.post("/api/chat")
+async def native_chat(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _native_logic(request, user_id, "/api/chat")
+@app.post("/api/generate")
+async def native_generate(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _native_logic(request, user_id, "/api/generate")
+@app.get("/api/tags")
+async def native_tags(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _native_simple_logic(request, user_id, "GET", "/api/tags")
+@app.post("/api/show")
+async def native_show(request: Request, user_id: str = Depends(get_user_from_client_key)): return await _native_simple_logic(request, user_id, "POST", "/api/show")
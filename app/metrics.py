@@ -0,0 +1,156 @@
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import app.settings as settings
+import app.cache as cache
+from app.cache import fingerprint
+
+# 轻量的 Prometheus 文本格式指标: 单线程事件循环内只做字典累加，不依赖 prometheus_client
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+COUNT_BUCKETS = (1, 2, 3, 4, 5, 8, 13)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra: parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._overflow = ("other",) * len(self.labels)
+
+    def _key(self, values: Tuple, series: dict) -> Tuple:
+        # 标签来自客户端 (如模型名) 时限制序列数量，超出部分归入 "other"
+        if values in series or len(series) < settings.METRICS_MAX_SERIES: return values
+        return self._overflow
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *values, amount: float = 1):
+        key = self._key(values, self._values)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for values, v in self._values.items(): lines.append(f"{self.name}{_format_labels(self.labels, values)} {v}")
+        return lines
+
+class Gauge(_Metric):
+    """取值在抓取时通过回调获得 (如队列深度)，热路径上零开销"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        super().__init__(name, help)
+        self._fn = fn
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        try: lines.append(f"{self.name} {self._fn()}")
+        except Exception: pass
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}  # values -> [各桶计数..., +Inf 计数, sum]
+
+    def observe(self, value: float, *values):
+        key = self._key(values, self._series)
+        series = self._series.get(key)
+        if series is None: series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        n = len(self.buckets)
+        for values, series in self._series.items():
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += series[i]
+                labels = _format_labels(self.labels, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            cumulative += series[n]
+            labels = _format_labels(self.labels, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, help, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics: lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+requests_total = registry.counter("proxy_requests_total", "Chat requests by route, model and status", ("route", "model", "status"))
+request_seconds = registry.histogram("proxy_request_duration_seconds", "Time until the response (or stream headers) is ready", ("route",))
+ttfb_seconds = registry.histogram("proxy_ttfb_seconds", "Upstream time to first token for streaming chats", ("model",))
+stream_seconds = registry.histogram("proxy_stream_duration_seconds", "Total duration of completed streams", ("model",))
+stream_tokens_per_second = registry.histogram("proxy_stream_tokens_per_second", "Relay throughput of completed streams", ("model",), RATE_BUCKETS)
+stream_aborts = registry.counter("proxy_stream_aborts_total", "Streams ended early by client disconnect", ("model",))
+stream_tokens_saved = registry.counter("proxy_stream_tokens_saved_total", "Estimated completion tokens not generated because the upstream stream was cancelled", ("model",))
+upstream_attempts = registry.histogram("proxy_upstream_attempts", "Upstream keys tried per chat request", (), COUNT_BUCKETS)
+upstream_results = registry.counter("proxy_upstream_results_total", "Upstream responses by status (error = connect / timeout)", ("status",))
+upstream_request_bytes = registry.counter("proxy_upstream_request_bytes_total", "Request body bytes sent upstream (after compression)", ("encoding",))
+upstream_key_errors = registry.counter("proxy_upstream_key_errors_total", "Failed upstream calls per key", ("key", "status"))
+models_seconds = registry.histogram("proxy_models_list_duration_seconds", "Model listing latency (including cache hits)")
+db_seconds = registry.histogram("proxy_db_call_duration_seconds", "Database call latency including executor queueing", ("op",))
+loop_lag_seconds = registry.histogram("proxy_event_loop_lag_seconds", "Event loop scheduling delay", (), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+auth_cache_results = registry.counter("proxy_auth_cache_total", "Session / client key / config cache lookups", ("cache", "result"))
+cache.lookup_listeners.append(lambda name, hit: auth_cache_results.inc(name, "hit" if hit else "miss"))
+
+def key_label(key: Optional[str]) -> str:
+    # 只使用哈希，/metrics 默认无需鉴权，不能泄露 Key 的任何部分 (对应 /api/stats 中 upstream_keys 的 fingerprint)
+    return fingerprint(key) if key else "none"
+
+def record_upstream(key: Optional[str], status: Optional[int]):
+    label = str(status) if status is not None else "error"
+    upstream_results.inc(label)
+    if status is None or status >= 500 or status in (401, 403, 429): upstream_key_errors.inc(key_label(key), label)
+
+async def monitor_loop_lag(interval: float):
+    """定时 sleep 并测量实际唤醒延迟"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(0.0, loop.time() - expected))
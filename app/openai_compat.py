@@ -0,0 +1,221 @@
+import json
+import time
+import uuid
+import base64
+import asyncio
+import httpx
+from typing import Any, Dict, List, Optional, Tuple, Union
+from pydantic import BaseModel
+import app.settings as settings
+import app.upstream as upstream
+
+try: from orjson import loads as _loads
+except ImportError: from json import loads as _loads
+
+# OpenAI Chat Completions <-> Ollama /api/chat 的请求与响应转换 (流式部分见 app/transcode.py)
+
+class ImageURL(BaseModel):
+    url: str
+    detail: Optional[str] = None
+
+class ContentPart(BaseModel):
+    type: str
+    text: Optional[str] = None
+    image_url: Optional[Union[ImageURL, str]] = None
+
+class ChatMessage(BaseModel):
+    role: str
+    content: Optional[Union[str, List[ContentPart]]] = None
+    name: Optional[str] = None
+    tool_calls: Optional[List[Dict[str, Any]]] = None
+    tool_call_id: Optional[str] = None
+    reasoning_content: Optional[str] = None
+
+class ChatCompletionRequest(BaseModel):
+    model: str
+    messages: List[ChatMessage]
+    stream: Optional[bool] = False
+    temperature: Optional[float] = 0.7
+    top_p: Optional[float] = None
+    max_tokens: Optional[int] = None
+    max_completion_tokens: Optional[int] = None
+    stop: Optional[Union[str, List[str]]] = None
+    seed: Optional[int] = None
+    presence_penalty: Optional[float] = None
+    frequency_penalty: Optional[float] = None
+    tools: Optional[List[Dict[str, Any]]] = None
+    tool_choice: Optional[Union[str, Dict[str, Any]]] = None
+    response_format: Optional[Dict[str, Any]] = None
+    reasoning_effort: Optional[str] = None
+    think: Optional[Union[bool, str]] = None  # Ollama 扩展字段，优先于 reasoning_effort
+    stream_options: Optional[dict] = None
+
+class EmbeddingRequest(BaseModel):
+    model: str
+    input: Union[str, List[str], List[int], List[List[int]]]
+    encoding_format: Optional[str] = "float"
+    dimensions: Optional[int] = None
+    user: Optional[str] = None
+
+def embedding_inputs(req: EmbeddingRequest) -> List[str]:
+    """OpenAI input -> 字符串列表。Ollama 不支持 token id 数组输入，抛出 ValueError"""
+    if isinstance(req.input, str): return [req.input]
+    if any(not isinstance(x, str) for x in req.input): raise ValueError("Token array inputs are not supported")
+    return req.input
+
+def embedding_body(model: str, vectors: List[list], prompt_tokens: int, encode=None) -> dict:
+    """encode 为 None 时输出浮点数组，否则用其编码每个向量 (encoding_format=base64)"""
+    return {
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": encode(v) if encode else v} for i, v in enumerate(vectors)],
+        "model": model,
+        "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+    }
+
+class ImageError(ValueError):
+    pass
+
+def parse_request(body: bytes) -> ChatCompletionRequest:
+    """解析并校验请求体。先用 (orjson 或标准库) 解析 JSON 再 model_validate: 实测对含大段 base64 图片的请求
+    比 model_validate_json 快，且校验 str 字段时不复制字符串；JSON 无效时抛出 ValueError"""
+    data = _loads(body)
+    if not isinstance(data, dict): raise ValueError("JSON body must be an object")
+    return ChatCompletionRequest.model_validate(data)
+
+def message_text(m: ChatMessage) -> str:
+    if m.content is None or isinstance(m.content, str): return m.content or ""
+    return "".join(p.text or "" for p in m.content if p.type == "text")
+
+def _image_url(part: ContentPart) -> str:
+    return part.image_url if isinstance(part.image_url, str) else part.image_url.url
+
+async def _fetch_image(url: str) -> str:
+    if not settings.IMAGE_URL_FETCH: raise ImageError("Only data: URLs are supported for image_url")
+    if not url.startswith(("http://", "https://")): raise ImageError("Unsupported image_url scheme")
+    limit = settings.IMAGE_MAX_BYTES
+    buf = bytearray()
+    client = upstream.get_client()
+    try:
+        async with client.stream("GET", url, timeout=settings.IMAGE_FETCH_TIMEOUT) as resp:
+            if resp.status_code != 200: raise ImageError(f"Failed to fetch image_url ({resp.status_code})")
+            async for chunk in resp.aiter_bytes():
+                buf += chunk
+                if len(buf) > limit: raise ImageError("Image too large")
+    except httpx.HTTPError as e: raise ImageError(f"Failed to fetch image_url ({type(e).__name__})")
+    return base64.b64encode(buf).decode("ascii")
+
+def _data_url_payload(url: str) -> str:
+    # data:image/png;base64,XXXX -> XXXX: Ollama 的 images 字段本身就是 base64，
+    # 直接切出原始 base64 文本，不解码再编码 (只有一次切片复制)
+    header, sep, data = url.partition(",")
+    if not sep or not header.endswith(";base64"): raise ImageError("image_url data URL must be base64 encoded")
+    if len(data) * 3 // 4 > settings.IMAGE_MAX_BYTES: raise ImageError("Image too large")
+    return data
+
+def _convert_message(m: ChatMessage, fetches: list) -> dict:
+    out: Dict[str, Any] = {"role": m.role}
+    if m.content is None or isinstance(m.content, str): out["content"] = m.content or ""
+    else:
+        texts, images = [], []
+        for part in m.content:
+            if part.type == "text": texts.append(part.text or "")
+            elif part.type == "image_url" and part.image_url is not None:
+                url = _image_url(part)
+                if url.startswith("data:"): images.append(_data_url_payload(url))
+                else:
+                    # 远程图片稍后并发下载，先占位保持顺序
+                    fetches.append((images, len(images), url))
+                    images.append(None)
+        out["content"] = "".join(texts)
+        if images: out["images"] = images
+    if m.reasoning_content: out["thinking"] = m.reasoning_content
+    if m.tool_calls: out["tool_calls"] = [_ollama_tool_call(c) for c in m.tool_calls]
+    if m.role == "tool" and m.name: out["tool_name"] = m.name
+    return out
+
+def _ollama_tool_call(call: dict) -> dict:
+    fn = call.get("function") or {}
+    args = fn.get("arguments")
+    if isinstance(args, str):
+        try: args = json.loads(args) if args else {}
+        except ValueError: args = {"_raw": args}
+    return {"function": {"name": fn.get("name", ""), "arguments": args or {}}}
+
+def _options(req: ChatCompletionRequest) -> dict:
+    opts = {"temperature": req.temperature}
+    max_tokens = req.max_completion_tokens if req.max_completion_tokens is not None else req.max_tokens
+    if max_tokens is not None: opts["num_predict"] = max_tokens
+    if req.top_p is not None: opts["top_p"] = req.top_p
+    if req.stop: opts["stop"] = [req.stop] if isinstance(req.stop, str) else req.stop
+    if req.seed is not None: opts["seed"] = req.seed
+    if req.presence_penalty is not None: opts["presence_penalty"] = req.presence_penalty
+    if req.frequency_penalty is not None: opts["frequency_penalty"] = req.frequency_penalty
+    return opts
+
+def _format(response_format: Optional[dict]):
+    if not response_format: return None
+    kind = response_format.get("type")
+    if kind == "json_object": return "json"
+    if kind == "json_schema": return (response_format.get("json_schema") or {}).get("schema") or "json"
+    return None
+
+async def build_payload(req: ChatCompletionRequest) -> dict:
+    """OpenAI 请求 -> Ollama /api/chat 请求体。data URL 图片直接取 base64 部分，http(s) 图片 (需开启 IMAGE_URL_FETCH) 并发下载"""
+    fetches: List[Tuple[list, int, str]] = []
+    messages = [_convert_message(m, fetches) for m in req.messages]
+    if fetches:
+        results = await asyncio.gather(*(_fetch_image(url) for _, _, url in fetches))
+        for (images, i, _), data in zip(fetches, results): images[i] = data
+    payload = {"model": req.model, "messages": messages, "stream": req.stream, "options": _options(req)}
+    # tool_choice="none" 时不把工具交给模型
+    if req.tools and req.tool_choice != "none": payload["tools"] = req.tools
+    fmt = _format(req.response_format)
+    if fmt is not None: payload["format"] = fmt
+    think = req.think if req.think is not None else req.reasoning_effort
+    if think is not None: payload["think"] = think
+    return payload
+
+def tool_call_id() -> str:
+    return f"call_{uuid.uuid4().hex[:24]}"
+
+def openai_tool_calls(calls: Optional[list], start: int = 0) -> List[dict]:
+    """Ollama tool_calls (arguments 为对象) -> OpenAI tool_calls (arguments 为 JSON 字符串)，start 为流式时的起始 index"""
+    out = []
+    for i, call in enumerate(calls or [], start):
+        fn = call.get("function") or {}
+        args = fn.get("arguments")
+        out.append({
+            "index": i, "id": call.get("id") or tool_call_id(), "type": "function",
+            "function": {"name": fn.get("name", ""), "arguments": args if isinstance(args, str) else json.dumps(args or {}, ensure_ascii=False)},
+        })
+    return out
+
+def finish_reason(done_reason: Optional[str], has_tool_calls: bool) -> str:
+    if has_tool_calls: return "tool_calls"
+    return "length" if done_reason == "length" else "stop"
+
+def cache_entry(message: dict, done: dict) -> dict:
+    """非流式 Ollama 响应 -> 响应缓存条目 (也是 completion_body 的输入)"""
+    tool_calls = openai_tool_calls(message.get("tool_calls"))
+    return {
+        "content": message.get("content") or "",
+        "reasoning": message.get("thinking") or "",
+        "tool_calls": tool_calls,
+        "finish_reason": finish_reason(done.get("done_reason"), bool(tool_calls)),
+        "prompt_tokens": done.get("prompt_eval_count", 0),
+        "completion_tokens": done.get("eval_count", 0),
+    }
+
+def completion_body(model: str, entry: dict) -> dict:
+    message: Dict[str, Any] = {"role": "assistant", "content": entry["content"]}
+    if entry.get("reasoning"): message["reasoning_content"] = entry["reasoning"]
+    if entry.get("tool_calls"): message["tool_calls"] = [{k: v for k, v in c.items() if k != "index"} for c in entry["tool_calls"]]
+    prompt_tokens, completion_tokens = entry["prompt_tokens"], entry["completion_tokens"]
+    return {
+        "id": f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": entry.get("finish_reason") or "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    }
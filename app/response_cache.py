@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Dict, Optional
+import app.settings as settings
+from app.cache import TTLCache, MISS
+
+class Fill:
+    """缓存填充句柄: 领头请求结束时写入缓存，并把结果交给合并等待的重复请求 (失败时交 None)"""
+    __slots__ = ("_cache", "key", "store", "_future")
+
+    def __init__(self, cache: "ResponseCache", key: str, store: bool, future: asyncio.Future):
+        self._cache = cache
+        self.key = key
+        self.store = store
+        self._future = future
+
+    def complete(self, value: dict):
+        if self._future.done(): return
+        if self.store: self._cache.put(self.key, value)
+        self._finish(value)
+
+    def abort(self):
+        if not self._future.done(): self._finish(None)
+
+    def _finish(self, value: Optional[dict]):
+        self._future.set_result(value)
+        if self._cache._inflight.get(self.key) is self._future: del self._cache._inflight[self.key]
+
+class ResponseCache:
+    """确定性对话 (temperature=0) 的精确匹配响应缓存: 内存 LRU + TTL，可选 data/ 下的磁盘二级缓存"""
+
+    def __init__(self, max_entries: int, ttl: float, disk_dir: Optional[str] = None, disk_max_entries: int = 0):
+        self.ttl = ttl
+        self._memory = TTLCache(max_entries, ttl)
+        self._disk_dir = disk_dir
+        self._disk_max = disk_max_entries
+        self._disk_writes = 0
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(user_id: str, payload: dict) -> str:
+        # 规范化: 除 stream 外的整个上游请求体 (含 tools / format / think 等) 都影响输出，排序键并去除空白；
+        # 流式与非流式请求共用缓存条目
+        canonical = {k: v for k, v in payload.items() if k != "stream"}
+        raw = json.dumps([user_id, canonical], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def put(self, key: str, value: dict):
+        self._memory.set(key, value)
+        if self._disk_dir: asyncio.get_running_loop().run_in_executor(None, self._disk_write, key, value)
+
+    async def get(self, key: str) -> Optional[dict]:
+        value = self._memory.get(key)
+        if value is not MISS:
+            self.hits += 1
+            return value
+        if self._disk_dir:
+            value = await asyncio.get_running_loop().run_in_executor(None, self._disk_read, key)
+            if value is not None:
+                self.disk_hits += 1
+                self._memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def join(self, key: str, refresh: bool = False):
+        """返回 (Fill, None) 表示本请求为领头请求；返回 (None, future) 表示已有相同请求在执行，等待其结果。
+        refresh=True (no-cache) 时总是自己请求并写入新结果，不等待也不取代正在执行的领头请求"""
+        future = self._inflight.get(key)
+        if future is not None and not refresh:
+            self.coalesced += 1
+            return None, future
+        own = asyncio.get_running_loop().create_future()
+        if future is None: self._inflight[key] = own
+        return Fill(self, key, True, own), None
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self._disk_dir, key[:2], key + ".json")
+
+    def _disk_read(self, key: str) -> Optional[dict]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f: record = json.load(f)
+        except (OSError, ValueError): return None
+        if time.time() - record.get("stored_at", 0) > self.ttl:
+            try: os.remove(path)
+            except OSError: pass
+            return None
+        return record.get("value")
+
+    def _disk_write(self, key: str, value: dict):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f: json.dump({"stored_at": time.time(), "value": value}, f, ensure_ascii=False)
+            os.replace(tmp, path)
+        except OSError: return
+        self._disk_writes += 1
+        if self._disk_max > 0 and self._disk_writes % 100 == 0: self._disk_prune()
+
+    def _disk_prune(self):
+        """超过条目上限时删除最旧的文件"""
+        files = []
+        for root, _, names in os.walk(self._disk_dir):
+            for name in names:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try: files.append((os.path.getmtime(path), path))
+                    except OSError: pass
+        if len(files) <= self._disk_max: return
+        files.sort()
+        for _, path in files[:len(files) - self._disk_max]:
+            try: os.remove(path)
+            except OSError: pass
+
+    def stats(self) -> dict:
+        return {
+            "enabled": settings.RESPONSE_CACHE_ENABLED,
+            "entries": self._memory.stats()["size"],
+            "hits": self.hits, "disk_hits": self.disk_hits, "coalesced": self.coalesced, "misses": self.misses,
+            "inflight": len(self._inflight),
+        }
+
+response_cache = ResponseCache(
+    settings.RESPONSE_CACHE_MAX_ENTRIES,
+    settings.RESPONSE_CACHE_TTL,
+    os.path.join("data", "response_cache") if settings.RESPONSE_CACHE_DISK else None,
+    settings.RESPONSE_CACHE_DISK_MAX_ENTRIES,
+)
@@ -0,0 +1,195 @@
+import time
+import random
+from typing import Callable, Dict, List, Optional, Tuple
+import app.settings as settings
+import app.database as db
+import app.metrics as metrics
+from app.breaker import CircuitBreaker, CircuitOpen
+from app.cache import fingerprint
+
+class KeyState:
+    """单个上游 Key 的运行时健康状态"""
+    __slots__ = ("key", "successes", "failures", "consecutive_failures", "latency_ewma", "inflight", "remote_inflight", "cooldown_until", "last_status", "breaker", "fingerprint")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency_ewma: Optional[float] = None
+        self.inflight = 0
+        self.remote_inflight = 0  # 其它 worker 上报的并发数 (多 worker 模式)
+        self.cooldown_until = 0.0
+        self.last_status: Optional[int] = None
+        self.breaker = CircuitBreaker(key)
+        self.fingerprint = fingerprint(key)  # 跨 worker 消息中代替 Key 原文
+
+    @property
+    def load(self) -> int:
+        return self.inflight + self.remote_inflight
+
+    @property
+    def success_rate(self) -> float:
+        # 拉普拉斯平滑，新 Key 初始为 0.5 而不是 0 或 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    def snapshot(self, now: float) -> dict:
+        return {
+            "key": self.key,
+            "fingerprint": self.fingerprint,
+            "successes": self.successes, "failures": self.failures,
+            "success_rate": round(self.success_rate, 4),
+            "latency_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "inflight": self.inflight,
+            "remote_inflight": self.remote_inflight,
+            "cooldown_remaining": max(0, int(self.cooldown_until - now)),
+            "last_status": self.last_status,
+            "breaker": self.breaker.snapshot(),
+        }
+
+class KeyScheduler:
+    """按用户维护上游 Key 池: 跳过冷却中的 Key，优先选择负载低 / 健康度高的 Key"""
+
+    def __init__(self):
+        self._pools: Dict[str, Dict[str, KeyState]] = {}
+        self._remote: Dict[str, Tuple[float, dict]] = {}  # worker -> (收到时间, {user: {key: inflight}})
+        self.on_cooldown: Optional[Callable[[str, str, float], None]] = None  # Key 冷却状态变化时回调 (广播给其它 worker)
+
+    async def get_keys(self, user_id: str) -> List[str]:
+        """返回本次请求的 Key 尝试顺序 (首次访问时从数据库加载)，全部 Key 熔断时抛出 CircuitOpen"""
+        if user_id not in self._pools: await self.reload(user_id)
+        return self._order(self._pools[user_id])
+
+    async def reload(self, user_id: str):
+        """重新从数据库同步 Key 列表 (后台增删 Key 后调用)，保留仍存在的 Key 的统计"""
+        rows = await db.run(db.get_user_upstream_keys, user_id)
+        old = self._pools.get(user_id, {})
+        self._pools[user_id] = {r["key"]: old.get(r["key"]) or KeyState(r["key"]) for r in rows}
+
+    def key_count(self, user_id: str) -> Optional[int]:
+        pool = self._pools.get(user_id)
+        return len(pool) if pool is not None else None
+
+    def _order(self, pool: Dict[str, KeyState]) -> List[str]:
+        now = time.monotonic()
+        usable = [s for s in pool.values() if s.breaker.available(now)]
+        if pool and not usable: raise CircuitOpen("upstream keys", min(s.breaker.retry_after() for s in pool.values()))
+        ready = [s for s in usable if s.cooldown_until <= now]
+        if not ready:
+            # 全部冷却中: 只用最早结束冷却的一个 Key 试探，而不是把所有 Key 再打一遍
+            cooling = sorted(usable, key=lambda s: s.cooldown_until)
+            return [cooling[0].key] if cooling else []
+        limit = settings.ADMISSION_UPSTREAM_KEY_CONCURRENCY
+        if limit > 0:
+            # 已达并发上限的 Key 暂不参与 (全部已满时仍按负载排序返回，避免误判为无 Key)
+            free = [s for s in ready if s.load < limit]
+            if free: ready = free
+        if settings.KEY_SCHEDULER_STRATEGY == "weighted":
+            def weight(s: KeyState) -> float:
+                latency = s.latency_ewma if s.latency_ewma is not None else 1.0
+                return s.success_rate / ((1 + s.load) * max(latency, 0.05))
+            # 加权随机排列 (Efraimidis-Spirakis)
+            ready.sort(key=lambda s: random.random() ** (1.0 / weight(s)), reverse=True)
+        else:
+            random.shuffle(ready)  # 同等条件下打散，避免总是命中同一个 Key
+            ready.sort(key=lambda s: (s.load, -round(s.success_rate, 1), s.latency_ewma or 0.0))
+        return [s.key for s in ready]
+
+    def _state(self, user_id: str, key: Optional[str]) -> Optional[KeyState]:
+        if not key: return None
+        return self._pools.get(user_id, {}).get(key)
+
+    def acquire(self, user_id: str, key: Optional[str]):
+        state = self._state(user_id, key)
+        if not state: return
+        state.inflight += 1
+        state.breaker.attempt()
+
+    def release(self, user_id: str, key: Optional[str]):
+        state = self._state(user_id, key)
+        if state: state.inflight = max(0, state.inflight - 1)
+
+    def report(self, user_id: str, key: Optional[str], status: Optional[int] = None, latency: Optional[float] = None, retry_after: Optional[float] = None):
+        """回报一次上游请求的结果。status 为 None 表示连接错误 / 超时"""
+        metrics.record_upstream(key, status)
+        state = self._state(user_id, key)
+        if not state: return
+        before = state.cooldown_until
+        self._record(state, status, latency, retry_after)
+        if self.on_cooldown is not None and state.cooldown_until != before:
+            self.on_cooldown(user_id, state.key, state.cooldown_until - time.monotonic())
+
+    def _record(self, state: KeyState, status: Optional[int], latency: Optional[float] = None, retry_after: Optional[float] = None):
+        now = time.monotonic()
+        state.last_status = status
+        # 熔断只统计连接错误 / 超时与 5xx；401 / 403 / 429 由冷却处理
+        if status is None or status >= 500: state.breaker.record(False)
+        elif status not in (401, 403, 429): state.breaker.record(True)
+        if status is not None and status < 500 and status not in (401, 403, 429):
+            # 2xx 以及客户端自身的 4xx 错误都说明 Key 本身可用
+            state.successes += 1
+            state.consecutive_failures = 0
+            state.cooldown_until = 0.0
+            if latency is not None:
+                a = settings.KEY_LATENCY_EWMA_ALPHA
+                state.latency_ewma = latency if state.latency_ewma is None else a * latency + (1 - a) * state.latency_ewma
+            return
+        state.failures += 1
+        state.consecutive_failures += 1
+        if status in (401, 403):
+            cooldown = settings.KEY_COOLDOWN_AUTH
+        elif status == 429:
+            cooldown = retry_after if retry_after else settings.KEY_COOLDOWN_RATE_LIMIT
+        else:
+            cooldown = settings.KEY_COOLDOWN_ERROR * (2 ** (state.consecutive_failures - 1))
+        state.cooldown_until = now + min(cooldown, settings.KEY_COOLDOWN_MAX)
+
+    def _by_fingerprint(self, user_id: str, fp: str) -> Optional[KeyState]:
+        for s in self._pools.get(user_id, {}).values():
+            if s.fingerprint == fp: return s
+        return None
+
+    def apply_cooldown(self, user_id: str, fp: str, remaining: float):
+        """应用其它 worker 广播的冷却状态 (Key 以 fingerprint 标识)，remaining <= 0 表示该 Key 已恢复"""
+        state = self._by_fingerprint(user_id, fp)
+        if not state: return
+        if remaining <= 0: state.cooldown_until = 0.0
+        else: state.cooldown_until = max(state.cooldown_until, time.monotonic() + min(remaining, settings.KEY_COOLDOWN_MAX))
+
+    def local_load(self) -> Dict[str, Dict[str, int]]:
+        """本 worker 各 Key 的并发数 (只含非零项，Key 以 fingerprint 标识)，定期广播给其它 worker"""
+        out = {}
+        for user_id, pool in self._pools.items():
+            busy = {s.fingerprint: s.inflight for s in pool.values() if s.inflight}
+            if busy: out[user_id] = busy
+        return out
+
+    def apply_remote_load(self, worker: str, load: Dict[str, Dict[str, int]], max_age: float):
+        if load or worker in self._remote: self._remote[worker] = (time.monotonic(), load)
+        self.expire_remote(max_age)
+
+    def expire_remote(self, max_age: float):
+        """丢弃超时未上报的 worker (已退出) 并重新汇总各 Key 的远端并发数"""
+        now = time.monotonic()
+        for worker in [w for w, (at, _) in self._remote.items() if now - at > max_age]: del self._remote[worker]
+        for pool in self._pools.values():
+            for s in pool.values(): s.remote_inflight = 0
+        for _, load in self._remote.values():
+            for user_id, keys in load.items():
+                pool = self._pools.get(user_id)
+                if not pool: continue
+                by_fp = {s.fingerprint: s for s in pool.values()}
+                for fp, n in keys.items():
+                    s = by_fp.get(fp)
+                    if s: s.remote_inflight += n
+
+    def snapshot(self, user_id: str) -> List[dict]:
+        now = time.monotonic()
+        return [s.snapshot(now) for s in self._pools.get(user_id, {}).values()]
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value: return None
+    try: return float(value)
+    except ValueError: return None
+
+scheduler = KeyScheduler()
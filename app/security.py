@@ -0,0 +1,128 @@
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, Optional
+import app.settings as settings
+import app.database as db
+
+class LoginGuard:
+    """登录 / 注册防护的内存状态，撞库时被拦截的请求不访问数据库:
+    - IP 封锁表 (带过期时间)，启动时从 blocked_ips 加载，变更在后台写回数据库
+    - 按 IP 的登录失败滑动窗口，窗口内失败次数过多时封锁该 IP
+    - 按 IP 的注册账号数，启动时从 users.reg_ip 加载，注册时在内存中检查并计数
+    - 后台定期清理过期的会话与封锁记录
+    """
+
+    def __init__(self):
+        self._blocked: Dict[str, float] = {}  # ip -> 封锁截止时间 (time.time())
+        self._failures: Dict[str, Deque[float]] = {}
+        self._registrations: Dict[str, int] = {}  # ip -> 已注册账号数
+        self._task: Optional[asyncio.Task] = None
+        self.on_block: Optional[Callable[[str, float], None]] = None  # 新增封锁时回调 (广播给其它 worker)
+        self.on_register: Optional[Callable[[str], None]] = None  # 注册成功时回调 (广播给其它 worker)
+        self.rejected = 0
+        self.blocks = 0
+        self.pruned_sessions = 0
+        self.pruned_blocks = 0
+
+    async def start(self):
+        now = time.time()
+        self._blocked = dict(await db.run(db.get_blocked_ips, now))
+        self._registrations = dict(await db.run(db.get_registration_counts))
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        if self._task is None: return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def is_blocked(self, ip: str) -> bool:
+        until = self._blocked.get(ip)
+        if until is None: return False
+        if until > time.time():
+            self.rejected += 1
+            return True
+        del self._blocked[ip]
+        return False
+
+    def block(self, ip: str, duration: float, reason: str):
+        self.apply_block(ip, duration)
+        self.blocks += 1
+        if self.on_block is not None: self.on_block(ip, duration)
+        asyncio.ensure_future(self._persist(ip, duration, reason))
+
+    def apply_block(self, ip: str, duration: float):
+        self._blocked[ip] = max(self._blocked.get(ip, 0.0), time.time() + duration)
+        self._failures.pop(ip, None)
+
+    async def _persist(self, ip: str, duration: float, reason: str):
+        try: await db.run(db.block_ip, ip, duration, reason)
+        except Exception: pass  # 写入失败时内存中的封锁仍然有效
+
+    def record_failure(self, ip: str) -> bool:
+        """记录一次登录失败，窗口内失败次数达到上限时封锁 IP 并返回 True"""
+        limit = settings.LOGIN_IP_MAX_FAILURES
+        if limit <= 0: return False
+        now = time.monotonic()
+        window = self._failures.get(ip)
+        if window is None:
+            if len(self._failures) >= settings.LOGIN_TRACK_MAX_IPS: self._expire_failures(now)
+            window = self._failures[ip] = deque()
+        while window and now - window[0] > settings.LOGIN_IP_WINDOW: window.popleft()
+        window.append(now)
+        if len(window) < limit: return False
+        self.block(ip, settings.LOGIN_BLOCK_SECONDS, "Too many login failures")
+        return True
+
+    def reserve_registration(self, ip: str) -> bool:
+        """注册前占用该 IP 的一个注册名额，达到 REGISTER_IP_MAX_ACCOUNTS 时返回 False。
+        先占用再写库，避免同一 IP 的并发注册同时通过检查"""
+        limit = settings.REGISTER_IP_MAX_ACCOUNTS
+        count = self._registrations.get(ip, 0)
+        if limit > 0 and count >= limit:
+            self.rejected += 1
+            return False
+        self._registrations[ip] = count + 1
+        return True
+
+    def release_registration(self, ip: str):
+        """注册失败 (用户名 / 邮箱已存在) 时归还名额"""
+        count = self._registrations.get(ip, 0) - 1
+        if count > 0: self._registrations[ip] = count
+        else: self._registrations.pop(ip, None)
+
+    def registered(self, ip: str):
+        """注册成功: 名额已在 reserve_registration 中计入，这里只通知其它 worker"""
+        if self.on_register is not None: self.on_register(ip)
+
+    def apply_registration(self, ip: str):
+        self._registrations[ip] = self._registrations.get(ip, 0) + 1
+
+    def _expire_failures(self, now: float):
+        horizon = now - settings.LOGIN_IP_WINDOW
+        for ip in [ip for ip, w in self._failures.items() if not w or w[-1] < horizon]: del self._failures[ip]
+        # 仍然超出上限 (大量不同 IP 同时失败) 时清空，避免内存无限增长
+        if len(self._failures) >= settings.LOGIN_TRACK_MAX_IPS: self._failures.clear()
+
+    async def prune(self):
+        now = time.time()
+        for ip in [ip for ip, until in self._blocked.items() if until <= now]: del self._blocked[ip]
+        self._expire_failures(time.monotonic())
+        sessions, blocks = await db.run(db.prune_expired, now)
+        self.pruned_sessions += sessions
+        self.pruned_blocks += blocks
+
+    async def _run(self):
+        while True:
+            try: await self.prune()
+            except Exception: pass
+            await asyncio.sleep(settings.SECURITY_PRUNE_INTERVAL)
+
+    def stats(self) -> dict:
+        return {
+            "blocked_ips": len(self._blocked), "tracked_ips": len(self._failures), "registration_ips": len(self._registrations), "rejected": self.rejected, "blocks": self.blocks,
+            "pruned_sessions": self.pruned_sessions, "pruned_blocks": self.pruned_blocks,
+        }
+
+login_guard = LoginGuard()
@@ -0,0 +1,170 @@
+import os
+
+# 运行参数统一从环境变量读取 (docker-compose 中通过 environment 覆盖)
+
+def _env_int(name: str, default: int) -> int:
+    try: return int(os.getenv(name, default))
+    except (TypeError, ValueError): return default
+
+def _env_float(name: str, default: float) -> float:
+    try: return float(os.getenv(name, default))
+    except (TypeError, ValueError): return default
+
+def _env_bool(name: str, default: bool) -> bool:
+    v = os.getenv(name)
+    if v is None: return default
+    return v.strip().lower() in ("1", "true", "yes", "on")
+
+# --- 上游连接池 ---
+UPSTREAM_MAX_CONNECTIONS = _env_int("UPSTREAM_MAX_CONNECTIONS", 100)
+UPSTREAM_MAX_KEEPALIVE = _env_int("UPSTREAM_MAX_KEEPALIVE", 20)
+UPSTREAM_KEEPALIVE_EXPIRY = _env_float("UPSTREAM_KEEPALIVE_EXPIRY", 60.0)
+UPSTREAM_CONNECT_TIMEOUT = _env_float("UPSTREAM_CONNECT_TIMEOUT", 10.0)
+UPSTREAM_READ_TIMEOUT = _env_float("UPSTREAM_READ_TIMEOUT", 120.0)
+UPSTREAM_POOL_TIMEOUT = _env_float("UPSTREAM_POOL_TIMEOUT", 10.0)
+UPSTREAM_MODELS_TIMEOUT = _env_float("UPSTREAM_MODELS_TIMEOUT", 5.0)
+# 流式请求: 首字节 (响应头与首行) 超时与 chunk 之间的空闲超时上限；非流式请求的整体生成时间仍受 UPSTREAM_READ_TIMEOUT 限制
+UPSTREAM_TTFB_TIMEOUT = _env_float("UPSTREAM_TTFB_TIMEOUT", 60.0)
+UPSTREAM_IDLE_TIMEOUT = _env_float("UPSTREAM_IDLE_TIMEOUT", 60.0)
+# HTTP/2 需要额外安装 h2 (pip install httpx[http2])，未安装时自动回退到 HTTP/1.1
+UPSTREAM_HTTP2 = _env_bool("UPSTREAM_HTTP2", False)
+
+# --- 数据库 ---
+DB_POOL_SIZE = _env_int("DB_POOL_SIZE", 4)
+
+# --- 鉴权缓存 (client key / session) ---
+AUTH_CACHE_SIZE = _env_int("AUTH_CACHE_SIZE", 10000)
+AUTH_CACHE_TTL = _env_float("AUTH_CACHE_TTL", 300.0)
+AUTH_CACHE_NEGATIVE_TTL = _env_float("AUTH_CACHE_NEGATIVE_TTL", 30.0)
+
+# --- 上游 Key 调度 ---
+# least_loaded: 优先选择在途请求最少、成功率最高的 Key; weighted: 按健康度加权随机
+KEY_SCHEDULER_STRATEGY = os.getenv("KEY_SCHEDULER_STRATEGY", "least_loaded")
+KEY_LATENCY_EWMA_ALPHA = _env_float("KEY_LATENCY_EWMA_ALPHA", 0.3)
+KEY_COOLDOWN_AUTH = _env_float("KEY_COOLDOWN_AUTH", 300.0)
+KEY_COOLDOWN_RATE_LIMIT = _env_float("KEY_COOLDOWN_RATE_LIMIT", 60.0)
+KEY_COOLDOWN_ERROR = _env_float("KEY_COOLDOWN_ERROR", 5.0)
+KEY_COOLDOWN_MAX = _env_float("KEY_COOLDOWN_MAX", 300.0)
+
+# --- 流式请求 ---
+# 对冲请求: 首个 Key 超过该毫秒数仍未返回首个 token 时并发尝试下一个 Key (0 为关闭)
+STREAM_HEDGE_DELAY_MS = _env_int("STREAM_HEDGE_DELAY_MS", 0)
+STREAM_HEDGE_MAX = _env_int("STREAM_HEDGE_MAX", 1)
+
+# --- 流式输出 ---
+# 合并窗口: 该毫秒数内到达的多个 token 合并为一个 SSE 帧 (0 为逐 token 发送)
+STREAM_COALESCE_MS = _env_float("STREAM_COALESCE_MS", 0.0)
+# 上游读取与客户端写出之间的缓冲上限 (行数)，客户端读得慢时暂停读取上游
+STREAM_BUFFER_CHUNKS = _env_int("STREAM_BUFFER_CHUNKS", 64)
+# 检查客户端是否已断开的间隔 (毫秒，0 为只依赖发送失败 / 取消检测)
+STREAM_DISCONNECT_CHECK_MS = _env_float("STREAM_DISCONNECT_CHECK_MS", 250.0)
+
+# --- 模型列表缓存 ---
+MODELS_CACHE_TTL = _env_float("MODELS_CACHE_TTL", 300.0)
+# 过期后仍可返回旧列表的时长 (期间后台刷新)
+MODELS_CACHE_STALE_TTL = _env_float("MODELS_CACHE_STALE_TTL", 3600.0)
+
+# --- 准入控制 (0 表示不限制) ---
+ADMISSION_GLOBAL_CONCURRENCY = _env_int("ADMISSION_GLOBAL_CONCURRENCY", 0)
+ADMISSION_USER_CONCURRENCY = _env_int("ADMISSION_USER_CONCURRENCY", 0)
+ADMISSION_CLIENT_KEY_CONCURRENCY = _env_int("ADMISSION_CLIENT_KEY_CONCURRENCY", 0)
+ADMISSION_UPSTREAM_KEY_CONCURRENCY = _env_int("ADMISSION_UPSTREAM_KEY_CONCURRENCY", 0)
+ADMISSION_USER_RPM = _env_int("ADMISSION_USER_RPM", 0)
+ADMISSION_USER_TPM = _env_int("ADMISSION_USER_TPM", 0)
+ADMISSION_CLIENT_KEY_RPM = _env_int("ADMISSION_CLIENT_KEY_RPM", 0)
+ADMISSION_CLIENT_KEY_TPM = _env_int("ADMISSION_CLIENT_KEY_TPM", 0)
+# 排队最长等待秒数与每个用户的最大排队数，超出后返回 429 + Retry-After
+ADMISSION_MAX_WAIT = _env_float("ADMISSION_MAX_WAIT", 30.0)
+ADMISSION_MAX_QUEUE_PER_USER = _env_int("ADMISSION_MAX_QUEUE_PER_USER", 100)
+
+# --- 响应缓存 (仅 temperature=0 的确定性请求) ---
+RESPONSE_CACHE_ENABLED = _env_bool("RESPONSE_CACHE_ENABLED", False)
+RESPONSE_CACHE_MAX_ENTRIES = _env_int("RESPONSE_CACHE_MAX_ENTRIES", 1000)
+RESPONSE_CACHE_TTL = _env_float("RESPONSE_CACHE_TTL", 3600.0)
+# 磁盘二级缓存 (data/response_cache/)，重启后仍可命中
+RESPONSE_CACHE_DISK = _env_bool("RESPONSE_CACHE_DISK", False)
+RESPONSE_CACHE_DISK_MAX_ENTRIES = _env_int("RESPONSE_CACHE_DISK_MAX_ENTRIES", 10000)
+
+# --- 监控指标 (/metrics, Prometheus 文本格式) ---
+METRICS_ENABLED = _env_bool("METRICS_ENABLED", True)
+# 设置后抓取 /metrics 需携带 Authorization: Bearer <token>
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# 每个指标最多保留的标签组合数 (模型名等来自客户端)，超出部分归入 "other"
+METRICS_MAX_SERIES = _env_int("METRICS_MAX_SERIES", 1000)
+METRICS_LOOP_LAG_INTERVAL = _env_float("METRICS_LOOP_LAG_INTERVAL", 1.0)
+
+# --- 用量统计 (内存缓冲 + 后台批量写入) ---
+USAGE_FLUSH_INTERVAL = _env_float("USAGE_FLUSH_INTERVAL", 5.0)
+# 缓冲达到该条数时立即触发写入
+USAGE_FLUSH_BATCH = _env_int("USAGE_FLUSH_BATCH", 500)
+# 数据库不可写时缓冲的最大条数，超出后丢弃新记录
+USAGE_MAX_BUFFER = _env_int("USAGE_MAX_BUFFER", 50000)
+USAGE_REQUEST_LOG = _env_bool("USAGE_REQUEST_LOG", True)
+# 逐请求日志的保留天数 (0 表示不清理)，按小时汇总的数据不受影响
+USAGE_LOG_RETENTION_DAYS = _env_int("USAGE_LOG_RETENTION_DAYS", 30)
+
+# --- 多 worker / 多节点共享状态 ---
+# local: 单进程 (默认)；redis: 通过 Redis 兼容服务的发布 / 订阅在 worker 之间同步 Key 冷却、并发数与缓存失效
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local").strip().lower()
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://127.0.0.1:6379/0")
+STATE_CHANNEL = os.getenv("STATE_CHANNEL", "ollama-proxy:state")
+# 各 worker 上报 Key 并发数的间隔 (秒)，超过 3 个间隔未上报的 worker 视为已退出
+STATE_SYNC_INTERVAL = _env_float("STATE_SYNC_INTERVAL", 1.0)
+
+# --- OpenAI 多模态请求 ---
+# 单张图片的最大字节数 (解码后)
+IMAGE_MAX_BYTES = _env_int("IMAGE_MAX_BYTES", 20 * 1024 * 1024)
+# 是否允许 image_url 使用 http(s) 地址 (由代理下载后转为 base64)；默认关闭以避免 SSRF，只接受 data: URL
+IMAGE_URL_FETCH = _env_bool("IMAGE_URL_FETCH", False)
+IMAGE_FETCH_TIMEOUT = _env_float("IMAGE_FETCH_TIMEOUT", 10.0)
+# TPM 准入估算时每张图片计入的 token 数
+IMAGE_TOKEN_ESTIMATE = _env_int("IMAGE_TOKEN_ESTIMATE", 768)
+
+# --- Embeddings (/v1/embeddings -> /api/embed) ---
+# 单次上游调用的最大输入条数，超出时拆分为多个分片并发发送
+EMBED_BATCH_SIZE = _env_int("EMBED_BATCH_SIZE", 64)
+# 单个请求同时发送的分片数
+EMBED_CONCURRENCY = _env_int("EMBED_CONCURRENCY", 4)
+# 小请求合并窗口 (毫秒)，窗口内同一用户同一模型的请求合并为一次上游调用 (0 为关闭)
+EMBED_COALESCE_MS = _env_float("EMBED_COALESCE_MS", 0.0)
+EMBED_MAX_INPUTS = _env_int("EMBED_MAX_INPUTS", 2048)
+
+# --- 登录防护 ---
+# 同一 IP 在窗口 (秒) 内登录失败达到该次数后封锁 (0 为关闭，仍保留按账号 5 次失败锁定)
+LOGIN_IP_MAX_FAILURES = _env_int("LOGIN_IP_MAX_FAILURES", 10)
+LOGIN_IP_WINDOW = _env_float("LOGIN_IP_WINDOW", 600.0)
+LOGIN_BLOCK_SECONDS = _env_float("LOGIN_BLOCK_SECONDS", 1800.0)
+# 同一 IP 最多注册的账号数 (0 为不限制)
+REGISTER_IP_MAX_ACCOUNTS = _env_int("REGISTER_IP_MAX_ACCOUNTS", 5)
+# 内存中最多跟踪的 IP 数
+LOGIN_TRACK_MAX_IPS = _env_int("LOGIN_TRACK_MAX_IPS", 100000)
+# 清理过期会话与封锁记录的间隔 (秒)
+SECURITY_PRUNE_INTERVAL = _env_float("SECURITY_PRUNE_INTERVAL", 3600.0)
+
+# --- 请求 / 响应压缩 ---
+# 上游请求体压缩: 空为关闭 (默认)，gzip 或 zstd (需安装 zstandard)；仅在确认上游接受 Content-Encoding 时开启
+UPSTREAM_COMPRESSION = os.getenv("UPSTREAM_COMPRESSION", "").strip().lower()
+# 小于该字节数的请求体不压缩
+UPSTREAM_COMPRESSION_MIN_BYTES = _env_int("UPSTREAM_COMPRESSION_MIN_BYTES", 16384)
+# 按客户端 Accept-Encoding 压缩非流式响应 (SSE / NDJSON 流不压缩)
+RESPONSE_COMPRESSION = _env_bool("RESPONSE_COMPRESSION", True)
+RESPONSE_COMPRESSION_MIN_BYTES = _env_int("RESPONSE_COMPRESSION_MIN_BYTES", 1024)
+
+# --- 自适应超时与熔断 ---
+# 按模型统计 TTFB / chunk 间隔，超时 = 分位数 x 倍数，限制在 [下限, 上限 (UPSTREAM_TTFB_TIMEOUT / UPSTREAM_IDLE_TIMEOUT)] 之间
+ADAPTIVE_TIMEOUT = _env_bool("ADAPTIVE_TIMEOUT", True)
+ADAPTIVE_TIMEOUT_PERCENTILE = _env_float("ADAPTIVE_TIMEOUT_PERCENTILE", 0.99)
+ADAPTIVE_TIMEOUT_MULTIPLIER = _env_float("ADAPTIVE_TIMEOUT_MULTIPLIER", 3.0)
+# 样本数不足时使用上限
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = _env_int("ADAPTIVE_TIMEOUT_MIN_SAMPLES", 20)
+ADAPTIVE_TIMEOUT_WINDOW = _env_int("ADAPTIVE_TIMEOUT_WINDOW", 200)
+UPSTREAM_TTFB_TIMEOUT_MIN = _env_float("UPSTREAM_TTFB_TIMEOUT_MIN", 10.0)
+UPSTREAM_IDLE_TIMEOUT_MIN = _env_float("UPSTREAM_IDLE_TIMEOUT_MIN", 10.0)
+# 按上游 Host 与按上游 Key 的熔断器: 连续失败 (连接错误 / 超时 / 5xx) 达到阈值后熔断，期间直接返回 503
+BREAKER_ENABLED = _env_bool("BREAKER_ENABLED", True)
+BREAKER_FAILURE_THRESHOLD = _env_int("BREAKER_FAILURE_THRESHOLD", 5)
+BREAKER_OPEN_SECONDS = _env_float("BREAKER_OPEN_SECONDS", 30.0)
+# 探测失败后熔断时长加倍，不超过该值
+BREAKER_OPEN_MAX_SECONDS = _env_float("BREAKER_OPEN_MAX_SECONDS", 300.0)
+# 半开状态下探测请求的最小间隔 (秒)
+BREAKER_PROBE_INTERVAL = _env_float("BREAKER_PROBE_INTERVAL", 5.0)
@@ -0,0 +1,239 @@
+import os
+import json
+import socket
+import asyncio
+import functools
+from typing import Callable, List, Optional
+from urllib.parse import urlparse
+import app.settings as settings
+import app.cache as cache
+from app.scheduler import scheduler
+from app.catalog import models_catalog
+from app.security import login_guard
+
+# 多 worker / 多节点共享状态: Key 冷却、各 worker 的 Key 并发数、缓存失效通过后端广播，
+# 每个 worker 在本地应用收到的事件，请求路径上不做任何网络调用
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+class LocalBackend:
+    """默认的单进程后端: 没有其它 worker，广播为空操作"""
+    shared = False
+
+    async def start(self, on_message: Callable[[bytes], None]): pass
+
+    async def close(self): pass
+
+    def publish(self, message: bytes): pass
+
+    def stats(self) -> dict:
+        return {"backend": "local"}
+
+class RespError(Exception):
+    pass
+
+def _encode(*args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for a in args:
+        if isinstance(a, str): a = a.encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(a), a))
+    return b"".join(out)
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+": return rest
+    if kind == b"-": raise RespError(rest.decode(errors="replace"))
+    if kind == b":": return int(rest)
+    if kind == b"$":
+        n = int(rest)
+        if n < 0: return None
+        return (await reader.readexactly(n + 2))[:-2]
+    if kind == b"*":
+        n = int(rest)
+        if n < 0: return None
+        return [await _read_reply(reader) for _ in range(n)]
+    raise RespError(f"unexpected reply {line!r}")
+
+class RespBackend:
+    """Redis 协议 (RESP) 的发布 / 订阅后端，兼容 Redis / Valkey / KeyDB 等，不依赖 redis-py。
+    一条连接批量 PUBLISH，一条连接 SUBSCRIBE，断线后自动重连"""
+    shared = True
+
+    def __init__(self, url: str, channel: str):
+        u = urlparse(url)
+        self.host = u.hostname or "127.0.0.1"
+        self.port = u.port or 6379
+        self.username = u.username
+        self.password = u.password
+        self.channel = channel
+        self._outbox: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.connected = False
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), settings.UPSTREAM_CONNECT_TIMEOUT)
+        if self.password:
+            writer.write(_encode("AUTH", self.username, self.password) if self.username else _encode("AUTH", self.password))
+            await writer.drain()
+            try: await _read_reply(reader)
+            except RespError:
+                writer.close()
+                raise
+        return reader, writer
+
+    async def start(self, on_message: Callable[[bytes], None]):
+        self._outbox = asyncio.Queue(maxsize=10000)
+        self._tasks = [asyncio.ensure_future(self._publisher()), asyncio.ensure_future(self._subscriber(on_message))]
+
+    async def close(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def publish(self, message: bytes):
+        # 后端不可用时不阻塞请求，队列满则丢弃 (状态会在下一次同步中恢复)
+        try: self._outbox.put_nowait(message)
+        except asyncio.QueueFull: self.dropped += 1
+
+    async def _publisher(self):
+        while True:
+            try:
+                reader, writer = await self._connect()
+                try:
+                    while True:
+                        batch = [await self._outbox.get()]
+                        while not self._outbox.empty() and len(batch) < 100: batch.append(self._outbox.get_nowait())
+                        writer.write(b"".join(_encode("PUBLISH", self.channel, m) for m in batch))
+                        await writer.drain()
+                        for _ in batch: await _read_reply(reader)
+                        self.published += len(batch)
+                finally: writer.close()
+            except Exception:
+                self.reconnects += 1
+                await asyncio.sleep(1)
+
+    async def _subscriber(self, on_message: Callable[[bytes], None]):
+        while True:
+            try:
+                reader, writer = await self._connect()
+                try:
+                    writer.write(_encode("SUBSCRIBE", self.channel))
+                    await writer.drain()
+                    self.connected = True
+                    while True:
+                        reply = await _read_reply(reader)
+                        if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                            self.received += 1
+                            on_message(reply[2])
+                finally:
+                    self.connected = False
+                    writer.close()
+            except Exception:
+                self.reconnects += 1
+                await asyncio.sleep(1)
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis", "connected": self.connected,
+            "published": self.published, "received": self.received, "dropped": self.dropped, "reconnects": self.reconnects,
+        }
+
+class SharedState:
+    """把本 worker 的状态变化广播出去，并应用其它 worker 的事件:
+    - cooldown: Key 进入 / 解除冷却
+    - load: 定期上报本 worker 各 Key 的并发数，用于全局负载均衡与按 Key 并发上限
+    - invalidate: 具名缓存 (client_keys / sessions / config) 失效
+    - keys: 用户增删了上游 Key，需要重新加载 Key 池
+    - block: 登录防护封锁了某个 IP
+    """
+
+    def __init__(self):
+        self.backend = LocalBackend()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sync_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        kind = settings.STATE_BACKEND
+        if kind == "redis": self.backend = RespBackend(settings.STATE_REDIS_URL, settings.STATE_CHANNEL)
+        elif kind != "local": raise RuntimeError(f"Unknown STATE_BACKEND: {kind}")
+        if not self.backend.shared: return
+        self._loop = asyncio.get_running_loop()
+        await self.backend.start(self._on_message)
+        scheduler.on_cooldown = self._cooldown_changed
+        login_guard.on_block = self._ip_blocked
+        login_guard.on_register = self._ip_registered
+        cache.invalidation_listeners.append(self._cache_invalidated)
+        self._sync_task = asyncio.ensure_future(self._sync_load())
+
+    async def close(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            self._sync_task = None
+        scheduler.on_cooldown = None
+        login_guard.on_block = None
+        login_guard.on_register = None
+        if self._cache_invalidated in cache.invalidation_listeners: cache.invalidation_listeners.remove(self._cache_invalidated)
+        await self.backend.close()
+
+    def _publish(self, kind: str, **data):
+        self.backend.publish(json.dumps({"t": kind, "w": WORKER_ID, **data}, separators=(",", ":")).encode())
+
+    def _cooldown_changed(self, user_id: str, key: str, remaining: float):
+        # 频道可能与其它服务共用: 只发送 Key 的 fingerprint，由各 worker 在本地 Key 池中还原
+        self._publish("cooldown", u=user_id, k=cache.fingerprint(key), r=round(remaining, 3))
+
+    def _ip_blocked(self, ip: str, duration: float):
+        self._publish("block", ip=ip, d=duration)
+
+    def _ip_registered(self, ip: str):
+        self._publish("register", ip=ip)
+
+    def _cache_invalidated(self, name: str, key):
+        # 数据库函数在线程池中执行，需切回事件循环线程再发布
+        # client key / session 令牌同样只发送 fingerprint
+        fp = None if key is None else cache.fingerprint(str(key))
+        self._loop.call_soon_threadsafe(functools.partial(self._publish, "invalidate", c=name, k=fp))
+
+    def keys_changed(self, user_id: str):
+        if self.backend.shared: self._publish("keys", u=user_id)
+
+    async def _sync_load(self):
+        interval = settings.STATE_SYNC_INTERVAL
+        while True:
+            self._publish("load", l=scheduler.local_load())
+            scheduler.expire_remote(interval * 3)
+            await asyncio.sleep(interval)
+
+    def _on_message(self, raw: bytes):
+        try: event = json.loads(raw)
+        except ValueError: return
+        if not isinstance(event, dict) or event.get("w") == WORKER_ID: return
+        try: self._apply(event)
+        except (KeyError, TypeError, ValueError): pass  # 忽略格式不符的事件 (如不同版本的 worker)
+
+    def _apply(self, event: dict):
+        kind = event.get("t")
+        if kind == "load": scheduler.apply_remote_load(event["w"], event.get("l") or {}, settings.STATE_SYNC_INTERVAL * 3)
+        elif kind == "cooldown": scheduler.apply_cooldown(event["u"], event["k"], float(event["r"]))
+        elif kind == "invalidate":
+            target = cache.named(event.get("c"))
+            if target is None: return
+            if event.get("k") is None: target.clear(broadcast=False)
+            else: target.invalidate_fingerprint(event["k"])
+        elif kind == "block": login_guard.apply_block(event["ip"], float(event["d"]))
+        elif kind == "register": login_guard.apply_registration(event["ip"])
+        elif kind == "keys":
+            models_catalog.invalidate_user(event["u"])
+            # 只重新加载已在本 worker 使用过的用户，其余用户首次请求时自然会从数据库加载
+            if scheduler.key_count(event["u"]) is not None: asyncio.ensure_future(scheduler.reload(event["u"]))
+
+    def stats(self) -> dict:
+        return {"worker": WORKER_ID, **self.backend.stats()}
+
+shared_state = SharedState()
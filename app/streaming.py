@@ -0,0 +1,192 @@
+import time
+import json
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import anyio
+import httpx
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+import app.settings as settings
+from app.transcode import StreamTranscoder, SSE_DONE
+from app.metrics import stream_aborts, stream_seconds, stream_tokens_per_second, stream_tokens_saved
+from app.timeouts import timeouts
+
+class StreamMetrics:
+    """流式请求统计: 客户端中途断开的次数以及因此少生成的上游 token (估算)"""
+
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.aborted = 0
+        self.upstream_errors = 0
+        self.tokens_relayed = 0
+        self.tokens_saved = 0
+        self._avg_completion: Dict[str, float] = {}
+
+    def expected_tokens(self, model: str) -> float:
+        return self._avg_completion.get(model, 0.0)
+
+    def record_completion(self, model: str, tokens: int):
+        avg = self._avg_completion.get(model)
+        self._avg_completion[model] = tokens if avg is None else 0.2 * tokens + 0.8 * avg
+
+    def snapshot(self) -> dict:
+        return {
+            "started": self.started, "completed": self.completed, "aborted": self.aborted,
+            "upstream_errors": self.upstream_errors,
+            "tokens_relayed": self.tokens_relayed, "tokens_saved_estimate": int(self.tokens_saved),
+        }
+
+metrics = StreamMetrics()
+
+_EOF = object()
+
+def _interruption(e: Exception) -> Tuple[str, str]:
+    """上游中途出错时告知客户端的 (错误信息, 错误类型)，chunk 间空闲超时单独标明"""
+    if isinstance(e, httpx.TimeoutException): return "Upstream stalled: no data within the idle timeout", "timeout"
+    return f"Upstream stream interrupted: {type(e).__name__}", "upstream_error"
+
+class RelayResponse(StreamingResponse):
+    """StreamingResponse 在客户端断开时可能根本不会启动生成器，这里保证上游连接一定被释放"""
+
+    def __init__(self, content, on_close: Callable[[], Awaitable[None]], **kwargs):
+        super().__init__(content, **kwargs)
+        self._on_close = on_close
+
+    async def __call__(self, scope, receive, send):
+        try: await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True): await self._on_close()
+
+async def _produce(first: str, lines: AsyncIterator[str], queue: asyncio.Queue, gap: List[float]):
+    # 队列有界: 客户端读得慢时这里阻塞，不再读取上游，由 TCP 流控把压力传回上游
+    # gap[0] 记录上游相邻两行之间的最长间隔，用于自适应空闲超时
+    try:
+        await queue.put(first)
+        last = time.monotonic()
+        async for line in lines:
+            now = time.monotonic()
+            if now - last > gap[0]: gap[0] = now - last
+            await queue.put(line)
+            last = time.monotonic()  # 不计入等待客户端读取的时间
+        await queue.put(_EOF)
+    except asyncio.CancelledError: raise
+    except Exception as e: await queue.put(e)
+
+async def relay(request: Optional[Request], transcoder: StreamTranscoder, first: str, lines: AsyncIterator[str], on_close: Callable[[], Awaitable[None]],
+                on_finish: Optional[Callable[[StreamTranscoder, int], None]] = None) -> AsyncIterator[bytes]:
+    """上游 NDJSON -> 客户端 SSE。检测到客户端断开 (is_disconnected / 发送失败 / 被取消) 时立即关闭上游流。
+    on_finish(transcoder, status) 在流结束时调用 (写入用量 / 响应缓存)，status: 200 完成，499 客户端断开，502 上游中断"""
+    model = transcoder.model
+    queue = asyncio.Queue(maxsize=settings.STREAM_BUFFER_CHUNKS)
+    gap = [0.0]
+    producer = asyncio.ensure_future(_produce(first, lines, queue, gap))
+    interval = settings.STREAM_DISCONNECT_CHECK_MS / 1000
+    started = time.monotonic()
+    next_check = started + interval
+    metrics.started += 1
+    finished = False
+    upstream_failed = False
+    try:
+        while True:
+            # 合并窗口中有待发内容时最多等到窗口结束，上游停顿 (如思考) 期间也按时发出
+            wait = transcoder.flush_in()
+            if wait is None: item = await queue.get()
+            else:
+                try: item = await asyncio.wait_for(queue.get(), wait)
+                except asyncio.TimeoutError:
+                    out = transcoder.flush()
+                    if out: yield out
+                    continue
+            if item is _EOF:
+                # 上游结束但没有 done 行: 把合并窗口中剩余内容发出去
+                tail = transcoder.flush()
+                if tail: yield tail
+                finished = True
+                break
+            if isinstance(item, Exception):
+                upstream_failed = True
+                # 响应头 (200) 已发出，用错误帧告知客户端流被截断
+                yield transcoder.flush() + transcoder.error_frame(*_interruption(item))
+                break
+            out = transcoder.feed(item)
+            if out: yield out
+            if transcoder.done:
+                finished = True
+                break
+            if request is not None and interval > 0 and time.monotonic() >= next_check:
+                if await request.is_disconnected(): break
+                next_check = time.monotonic() + interval
+    finally:
+        if on_finish is not None: on_finish(transcoder, 200 if finished else 502 if upstream_failed else 499)
+        producer.cancel()
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(producer, return_exceptions=True)
+            await on_close()
+        metrics.tokens_relayed += transcoder.tokens
+        if finished:
+            metrics.completed += 1
+            eval_count = (transcoder.last or {}).get("eval_count")
+            metrics.record_completion(model, eval_count if eval_count is not None else transcoder.tokens)
+            timeouts.observe_idle(model, gap[0])
+            elapsed = time.monotonic() - started
+            stream_seconds.observe(elapsed, model)
+            if elapsed > 0: stream_tokens_per_second.observe(transcoder.tokens / elapsed, model)
+        elif upstream_failed:
+            metrics.upstream_errors += 1
+        else:
+            saved = max(0.0, metrics.expected_tokens(model) - transcoder.tokens)
+            metrics.aborted += 1
+            metrics.tokens_saved += saved
+            stream_aborts.inc(model)
+            if saved: stream_tokens_saved.inc(model, amount=saved)
+
+async def replay(model: str, entry: dict, include_usage: bool = False) -> AsyncIterator[bytes]:
+    """把缓存的完整回复 (openai_compat.cache_entry 格式) 按 SSE 格式回放，include_usage 时附带 usage chunk"""
+    transcoder = StreamTranscoder(model, flush_ms=0)
+    yield transcoder.open()
+    if entry.get("reasoning"): yield transcoder.chunk({"reasoning_content": entry["reasoning"]})
+    if entry["content"]: yield transcoder.render(entry["content"])
+    if entry.get("tool_calls"): yield transcoder.chunk({"tool_calls": entry["tool_calls"]})
+    yield transcoder.chunk({}, entry.get("finish_reason") or "stop")
+    if include_usage: yield transcoder.usage_frame(entry["prompt_tokens"], entry["completion_tokens"])
+    yield SSE_DONE
+
+def _last_json_line(data: bytes) -> Optional[dict]:
+    line = data.rstrip().rsplit(b"\n", 1)[-1]
+    try: d = json.loads(line)
+    except ValueError: return None
+    return d if isinstance(d, dict) else None
+
+async def relay_raw(first: bytes, chunks: AsyncIterator[bytes], on_close: Callable[[], Awaitable[None]],
+                    on_finish: Optional[Callable[[Optional[dict], int], None]] = None, model: str = "") -> AsyncIterator[bytes]:
+    """原生接口透传: 上游字节块原样转发，不做逐行解码。结束时只解析最后一行 (done 行) 获取 token 统计，
+    on_finish(done 行或 None, status) 的 status 含义同 relay"""
+    metrics.started += 1
+    status = 499
+    prev, last = b"", first
+    gap = 0.0
+    try:
+        yield first
+        try:
+            received = time.monotonic()
+            async for chunk in chunks:
+                now = time.monotonic()
+                if now - received > gap: gap = now - received
+                yield chunk
+                prev, last = last, chunk
+                received = time.monotonic()
+            status = 200
+            if model: timeouts.observe_idle(model, gap)
+        except Exception as e:  # 上游中途断开 (客户端断开表现为 GeneratorExit / CancelledError，不会进入这里)
+            status = 502
+            # 与 Ollama 的错误格式一致，以独立的一行结尾告知客户端流被截断
+            yield (b"" if last.endswith(b"\n") else b"\n") + json.dumps({"error": _interruption(e)[0]}).encode() + b"\n"
+    finally:
+        if on_finish is not None: on_finish(_last_json_line(prev + last) if status == 200 else None, status)
+        with anyio.CancelScope(shield=True): await on_close()
+        if status == 200: metrics.completed += 1
+        elif status == 502: metrics.upstream_errors += 1
+        else:
+            metrics.aborted += 1
+            stream_aborts.inc(model)
@@ -0,0 +1,78 @@
+from array import array
+from typing import Dict, Optional
+import httpx
+import app.settings as settings
+
+class _Window:
+    """最近 ADAPTIVE_TIMEOUT_WINDOW 个样本的环形缓冲，分位数在新增若干样本后才重新计算"""
+    __slots__ = ("samples", "pos", "count", "stale", "value")
+
+    def __init__(self, size: int):
+        self.samples = array("d", [0.0]) * size
+        self.pos = 0
+        self.count = 0
+        self.stale = 0
+        self.value: Optional[float] = None
+
+    def add(self, seconds: float):
+        self.samples[self.pos] = seconds
+        self.pos = (self.pos + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+        self.stale += 1
+
+    def percentile(self, q: float) -> float:
+        if self.value is None or self.stale >= 16:
+            ordered = sorted(self.samples[:self.count])
+            self.value = ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            self.stale = 0
+        return self.value
+
+class AdaptiveTimeouts:
+    """按模型统计流式请求的首字节时间 (TTFB) 与最长 chunk 间隔，超时取 分位数 x 倍数，限制在 [下限, 上限] 之间。
+    样本不足时使用上限 (UPSTREAM_TTFB_TIMEOUT / UPSTREAM_IDLE_TIMEOUT)。连接超时始终为 UPSTREAM_CONNECT_TIMEOUT"""
+
+    def __init__(self):
+        self._ttfb: Dict[str, _Window] = {}
+        self._idle: Dict[str, _Window] = {}
+
+    def _observe(self, table: Dict[str, _Window], model: str, seconds: float):
+        window = table.get(model)
+        if window is None: window = table[model] = _Window(max(1, settings.ADAPTIVE_TIMEOUT_WINDOW))
+        window.add(seconds)
+
+    def observe_ttfb(self, model: str, seconds: float):
+        self._observe(self._ttfb, model, seconds)
+
+    def observe_idle(self, model: str, seconds: float):
+        self._observe(self._idle, model, seconds)
+
+    def _adaptive(self, window: Optional[_Window], lower: float, upper: float) -> float:
+        if not settings.ADAPTIVE_TIMEOUT or window is None or window.count < settings.ADAPTIVE_TIMEOUT_MIN_SAMPLES: return upper
+        value = window.percentile(settings.ADAPTIVE_TIMEOUT_PERCENTILE) * settings.ADAPTIVE_TIMEOUT_MULTIPLIER
+        return min(upper, max(lower, value))
+
+    def ttfb(self, model: str) -> float:
+        return self._adaptive(self._ttfb.get(model), settings.UPSTREAM_TTFB_TIMEOUT_MIN, settings.UPSTREAM_TTFB_TIMEOUT)
+
+    def idle(self, model: str) -> float:
+        return self._adaptive(self._idle.get(model), settings.UPSTREAM_IDLE_TIMEOUT_MIN, settings.UPSTREAM_IDLE_TIMEOUT)
+
+    def stream(self, model: str) -> httpx.Timeout:
+        """建立流式请求时使用的超时: 读取响应头受 TTFB 超时约束 (收到响应头后由调用方切换为空闲超时)"""
+        return httpx.Timeout(self.ttfb(model), connect=settings.UPSTREAM_CONNECT_TIMEOUT, pool=settings.UPSTREAM_POOL_TIMEOUT)
+
+    def stats(self) -> dict:
+        out = {}
+        for model in set(self._ttfb) | set(self._idle):
+            out[model] = {
+                "samples": self._ttfb[model].count if model in self._ttfb else 0,
+                "ttfb_timeout": round(self.ttfb(model), 2), "idle_timeout": round(self.idle(model), 2),
+            }
+        return out
+
+def use_idle_timeout(resp: httpx.Response, seconds: float):
+    """响应头已到达后把读超时换成 chunk 间的空闲超时: httpcore 在开始读取响应体时才取用 read 超时"""
+    timeout = resp.request.extensions.get("timeout") or {}
+    resp.request.extensions["timeout"] = {**timeout, "read": seconds}
+
+timeouts = AdaptiveTimeouts()
@@ -0,0 +1,151 @@
+import json
+import time
+import uuid
+from typing import List, Optional
+import app.settings as settings
+from app.openai_compat import finish_reason, openai_tool_calls
+
+# 可选的高速 JSON 库: 安装 orjson 后自动启用，否则使用标准库 (C 加速的字符串转义)
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _escape(s: str) -> bytes:
+        return orjson.dumps(s)
+except ImportError:
+    _loads = json.loads
+    _encode_basestring = json.encoder.encode_basestring
+
+    def _escape(s: str) -> bytes:
+        return _encode_basestring(s).encode()
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+class StreamTranscoder:
+    """Ollama NDJSON -> OpenAI SSE 转码器。
+
+    每个请求只渲染一次 chunk 的固定前缀 / 后缀，每个 token 只转义 delta 内容并拼接字节；
+    flush_ms > 0 时，窗口内的多个小 token 会合并成一个 SSE 帧发送。
+    首帧为 role delta，结束时发送带 finish_reason 的空 delta 帧；thinking / tool_calls 等少见的帧走通用渲染。
+    """
+
+    def __init__(self, model: str, flush_ms: Optional[float] = None, capture: bool = False, include_usage: bool = False):
+        self.model = model
+        self.id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.created = int(time.time())
+        envelope = {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": ""}, "finish_reason": None}],
+        }
+        rendered = json.dumps(envelope, ensure_ascii=False, separators=(",", ":")).encode()
+        marker = b'"content":""'
+        head, tail = rendered.split(marker, 1)
+        self._prefix = b"data: " + head + b'"content":'
+        self._suffix = tail + b"\n\n"
+        flush_ms = settings.STREAM_COALESCE_MS if flush_ms is None else flush_ms
+        self._window = flush_ms / 1000
+        self._pending = []
+        self._pending_since = 0.0
+        self.done = False
+        self.chunks = 0
+        self.tokens = 0
+        self.last: Optional[dict] = None  # 最后一行 (done) 的原始数据，包含 eval_count 等统计
+        self.captured = [] if capture else None  # 需要完整回复 (写入响应缓存) 时记录所有内容
+        self.reasoning = [] if capture else None
+        self.tool_calls: List[dict] = []
+        self.finish_reason: Optional[str] = None
+        self.include_usage = include_usage  # stream_options.include_usage: 结束前发送 usage chunk
+        self._opened = False
+
+    def render(self, content: str) -> bytes:
+        """渲染一个 content delta 帧"""
+        self.chunks += 1
+        frame = self._prefix + _escape(content) + self._suffix
+        return frame if self._opened else self.open() + frame
+
+    def chunk(self, delta: dict, finish: Optional[str] = None) -> bytes:
+        """通用渲染任意 delta 的帧 (role / reasoning_content / tool_calls / 结束帧)"""
+        self.chunks += 1
+        chunk = {
+            "id": self.id, "object": "chat.completion.chunk", "created": self.created, "model": self.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+        }
+        frame = b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode() + b"\n\n"
+        return frame if self._opened else self.open() + frame
+
+    def open(self) -> bytes:
+        """首帧 (role delta)，每个流只发送一次"""
+        if self._opened: return b""
+        self._opened = True
+        return self.chunk({"role": "assistant", "content": ""})
+
+    def usage_frame(self, prompt_tokens: int, completion_tokens: int) -> bytes:
+        """OpenAI 流式 usage chunk (choices 为空)，每个请求只渲染一次"""
+        chunk = {
+            "id": self.id, "object": "chat.completion.chunk", "created": self.created, "model": self.model, "choices": [],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        }
+        return b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode() + b"\n\n"
+
+    def error_frame(self, message: str, error_type: str = "upstream_error") -> bytes:
+        """上游中途出错时发送的 OpenAI 格式错误帧 (不再发送 [DONE])，客户端据此区分中断与正常结束"""
+        chunk = {"error": {"message": message, "type": error_type, "code": 502}}
+        return b"data: " + json.dumps(chunk, ensure_ascii=False, separators=(",", ":")).encode() + b"\n\n"
+
+    def feed(self, line) -> bytes:
+        """输入一行上游 NDJSON，返回需要发送给客户端的字节 (可能为空)"""
+        if not line: return b""
+        try: d = _loads(line)
+        except ValueError: return b""
+        if not isinstance(d, dict): return b""
+        if d.get("done"):
+            self.done = True
+            self.last = d
+            self.finish_reason = finish_reason(d.get("done_reason"), bool(self.tool_calls))
+            out = self.flush() + self.chunk({}, self.finish_reason)
+            if self.include_usage: out += self.usage_frame(d.get("prompt_eval_count", 0), d.get("eval_count", self.tokens))
+            return out + SSE_DONE
+        self.tokens += 1
+        msg = d.get("message") or {}
+        c = msg.get("content") or ""
+        thinking, calls = msg.get("thinking"), msg.get("tool_calls")
+        if thinking or calls: return self._rare(c, thinking, calls)
+        if self.captured is not None and c: self.captured.append(c)
+        if not self._window: return self.render(c)
+        if not c: return b""
+        now = time.monotonic()
+        if not self._pending: self._pending_since = now
+        self._pending.append(c)
+        if now - self._pending_since >= self._window: return self.flush()
+        return b""
+
+    def _rare(self, c: str, thinking: Optional[str], calls: Optional[list]) -> bytes:
+        # 先发出合并窗口中的内容，保证帧顺序
+        out = self.flush()
+        if thinking:
+            if self.reasoning is not None: self.reasoning.append(thinking)
+            out += self.chunk({"reasoning_content": thinking})
+        if c:
+            if self.captured is not None: self.captured.append(c)
+            out += self.render(c)
+        if calls:
+            converted = openai_tool_calls(calls, len(self.tool_calls))
+            self.tool_calls.extend(converted)
+            out += self.chunk({"tool_calls": converted})
+        return out
+
+    def flush_in(self) -> Optional[float]:
+        """合并窗口中有待发内容时返回距窗口结束的秒数，否则返回 None"""
+        if not self._pending: return None
+        return max(0.0, self._pending_since + self._window - time.monotonic())
+
+    def flush(self) -> bytes:
+        """发送合并窗口中尚未发出的内容"""
+        if not self._pending: return b""
+        content = "".join(self._pending)
+        self._pending.clear()
+        return self.render(content)
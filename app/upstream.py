@@ -0,0 +1,132 @@
+import json
+import httpx
+from typing import Optional, Union
+import app.settings as settings
+import app.metrics as metrics
+import app.breaker as breaker
+from app.compression import compress, upstream_encoding
+
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+# 全局共享的上游客户端: 由 lifespan 创建 / 关闭，所有请求复用同一个 keep-alive 连接池
+_client: Optional[httpx.AsyncClient] = None
+_http2_enabled = False
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+class _BreakerTransport(httpx.AsyncBaseTransport):
+    """在传输层记录每次上游请求的结果到对应 Host 的熔断器 (连接错误 / 超时 / 502-504 为失败)。
+    流式响应读取过程中的超时不在这里，由 Key 的健康统计处理。
+    等待连接池超时 (PoolTimeout) 是本进程连接数不足，请求并未发出，不计入 Host 的结果"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = breaker.host_of(request.url)
+        try: resp = await self._transport.handle_async_request(request)
+        except httpx.PoolTimeout: raise
+        except httpx.TransportError:
+            breaker.hosts.record(host, False)
+            raise
+        breaker.hosts.record(host, resp.status_code not in (502, 503, 504))
+        return resp
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def _build_client() -> httpx.AsyncClient:
+    global _http2_enabled
+    limits = httpx.Limits(
+        max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(
+        settings.UPSTREAM_READ_TIMEOUT,
+        connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+        pool=settings.UPSTREAM_POOL_TIMEOUT,
+    )
+    _http2_enabled = settings.UPSTREAM_HTTP2 and _http2_available()
+    client = httpx.AsyncClient(limits=limits, timeout=timeout, verify=False, http2=_http2_enabled)
+    # httpx 没有公开的传输层钩子: 包装默认传输层及环境变量代理对应的传输层 (显式传入 transport 会使其忽略 HTTPS_PROXY 等设置)
+    client._transport = _BreakerTransport(client._transport)
+    client._mounts = {pattern: t if t is None else _BreakerTransport(t) for pattern, t in client._mounts.items()}
+    return client
+
+async def start() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed: _client = _build_client()
+    return _client
+
+async def close():
+    global _client
+    if _client is not None and not _client.is_closed: await _client.aclose()
+    _client = None
+
+def get_client() -> httpx.AsyncClient:
+    """获取共享客户端 (未经 lifespan 启动时惰性创建)"""
+    global _client
+    if _client is None or _client.is_closed: _client = _build_client()
+    return _client
+
+def pool_stats() -> dict:
+    """连接池占用情况，用于调整 UPSTREAM_MAX_* 参数"""
+    stats = {
+        "started": _client is not None and not _client.is_closed,
+        "http2": _http2_enabled,
+        "max_connections": settings.UPSTREAM_MAX_CONNECTIONS,
+        "max_keepalive": settings.UPSTREAM_MAX_KEEPALIVE,
+        "connections": 0, "active": 0, "idle": 0, "queued_requests": 0,
+    }
+    if not stats["started"]: return stats
+    # httpcore 未公开统计接口，这里读取连接池内部状态，失败时只返回配置值
+    try:
+        pool = _client._transport._transport._pool
+        conns = pool.connections
+        idle = sum(1 for c in conns if c.is_idle())
+        stats["connections"] = len(conns)
+        stats["idle"] = idle
+        stats["active"] = len(conns) - idle
+        stats["queued_requests"] = sum(1 for r in pool._requests if r.is_queued())
+    except Exception: pass
+    return stats
+
+def headers(key: Optional[str]) -> dict:
+    """上游请求头 (带该 Key 的 Authorization)"""
+    out = {"Content-Type": "application/json"}
+    if key: out["Authorization"] = f"Bearer {key}"
+    return out
+
+class RequestBody:
+    """序列化 (及可选压缩) 一次的上游请求体: 故障转移 / 对冲的每次尝试复用同一份字节，不再逐次 json.dumps"""
+    __slots__ = ("content", "headers", "size")
+
+    def __init__(self, content: bytes, headers: dict, size: int):
+        self.content = content
+        self.headers = headers
+        self.size = size  # 压缩前的字节数
+
+    def sent(self):
+        """记录一次发送的字节数"""
+        metrics.upstream_request_bytes.inc(self.headers.get("Content-Encoding", "identity"), amount=len(self.content))
+
+def prepare_body(payload: Union[dict, bytes]) -> RequestBody:
+    data = payload if isinstance(payload, bytes) else _dumps(payload)
+    headers = {"Content-Type": "application/json"}
+    encoding = upstream_encoding()
+    if encoding is not None and len(data) >= settings.UPSTREAM_COMPRESSION_MIN_BYTES:
+        compressed = compress(data, encoding)
+        if len(compressed) < len(data):
+            headers["Content-Encoding"] = encoding
+            return RequestBody(compressed, headers, len(data))
+    return RequestBody(data, headers, len(data))
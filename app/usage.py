@@ -0,0 +1,71 @@
+import time
+import asyncio
+from typing import List, Optional
+import app.settings as settings
+import app.database as db
+
+class UsageRecorder:
+    """请求用量先写入内存缓冲，由后台任务定时 (或缓冲满时) 批量写入数据库，请求路径上没有数据库写入"""
+
+    def __init__(self):
+        self._buffer: List[tuple] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+        self.recorded = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+    def record(self, user_id: str, client_key: Optional[str], upstream_key: Optional[str], model: str, status: int,
+               prompt_tokens: int = 0, completion_tokens: int = 0, duration: float = 0.0, stream: bool = False):
+        if len(self._buffer) >= settings.USAGE_MAX_BUFFER:
+            self.dropped += 1
+            return
+        self._buffer.append((time.time(), user_id, client_key or "", upstream_key or "", model, int(stream), status,
+                             int(prompt_tokens or 0), int(completion_tokens or 0), int(duration * 1000)))
+        self.recorded += 1
+        if len(self._buffer) >= settings.USAGE_FLUSH_BATCH and self._wakeup is not None: self._wakeup.set()
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """停止后台任务并写入剩余记录"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try: await asyncio.wait_for(self._wakeup.wait(), settings.USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError: pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if self._lock is None: self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._buffer: return
+            batch, self._buffer = self._buffer, []
+            try: await db.run(db.record_usage_batch, batch, settings.USAGE_REQUEST_LOG)
+            except Exception:
+                # 写入失败时放回缓冲，下次重试
+                self.flush_errors += 1
+                self._buffer[:0] = batch[:max(0, settings.USAGE_MAX_BUFFER - len(self._buffer))]
+                return
+            self.flushed += len(batch)
+            now = time.time()
+            if settings.USAGE_LOG_RETENTION_DAYS > 0 and now - self._last_prune > 3600:
+                self._last_prune = now
+                try: await db.run(db.prune_request_log, now - settings.USAGE_LOG_RETENTION_DAYS * 86400)
+                except Exception: pass
+
+    def stats(self) -> dict:
+        return {"buffered": len(self._buffer), "recorded": self.recorded, "flushed": self.flushed, "dropped": self.dropped, "flush_errors": self.flush_errors}
+
+recorder = UsageRecorder()
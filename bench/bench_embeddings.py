@@ -0,0 +1,116 @@
+"""Embeddings 吞吐压测: 对比关闭 / 开启小请求合并 (EMBED_COALESCE_MS) 时 /v1/embeddings 的吞吐与延迟。
+
+每种模式各启动一次本地模拟上游 (bench/mock_ollama.py) 与代理，并发发送单条输入的小请求，
+输出 requests/sec、延迟 p50/p95/p99、上游调用次数以及代理进程的 CPU 时间，结果写入 JSON 文件。
+
+用法 (在项目根目录执行):
+    python bench/bench_embeddings.py --concurrency 50 --requests 40 --coalesce-ms 0,5 --latency-ms 30
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+import httpx
+
+from bench_proxy import ROOT, proc_cpu_seconds, setup_proxy, spawn, summarize_ms, wait_ready
+
+async def run_mode(args, coalesce_ms: float, port_offset: int) -> dict:
+    mock_url = f"http://127.0.0.1:{args.mock_port + port_offset}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port + port_offset}"
+    workdir = tempfile.mkdtemp(prefix="ollama-proxy-bench-embed-")
+    mock_log, proxy_log = os.path.join(workdir, "mock.log"), os.path.join(workdir, "proxy.log")
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""),
+               EMBED_COALESCE_MS=str(coalesce_ms), EMBED_BATCH_SIZE=str(args.batch_size))
+    mock = spawn([sys.executable, os.path.join(ROOT, "bench", "mock_ollama.py"), "--port", str(args.mock_port + port_offset),
+                  "--latency-ms", str(args.latency_ms), "--embed-dim", str(args.dim)], ROOT, mock_log)
+    proxy = spawn([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.proxy_port + port_offset),
+                   "--log-level", "warning", "--no-access-log"], workdir, proxy_log, env)
+    try:
+        await wait_ready(f"{mock_url}/_stats", mock, mock_log)
+        await wait_ready(f"{proxy_url}/login", proxy, proxy_log)
+        client_key = await setup_proxy(proxy_url, mock_url, args.keys, 0)
+        latency: List[float] = []
+        errors = {}
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=proxy_url, headers={"Authorization": f"Bearer {client_key}"}, limits=limits, timeout=60) as client:
+            async def worker(w: int):
+                for i in range(args.requests):
+                    text = f"document {w}-{i} " + "lorem ipsum " * 10
+                    started = time.perf_counter()
+                    try: resp = await client.post("/v1/embeddings", json={"model": args.model, "input": text})
+                    except httpx.HTTPError as e:
+                        errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                        continue
+                    if resp.status_code != 200:
+                        errors[str(resp.status_code)] = errors.get(str(resp.status_code), 0) + 1
+                        continue
+                    latency.append(time.perf_counter() - started)
+
+            before = (await client.get(f"{mock_url}/_stats")).json()
+            cpu_before = proc_cpu_seconds(proxy.pid)
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(w) for w in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+            cpu = proc_cpu_seconds(proxy.pid) - cpu_before
+            after = (await client.get(f"{mock_url}/_stats")).json()
+        return {
+            "coalesce_ms": coalesce_ms, "concurrency": args.concurrency, "requests": args.concurrency * args.requests,
+            "ok": len(latency), "errors": errors,
+            "elapsed_s": round(elapsed, 3),
+            "requests_per_s": round(len(latency) / elapsed, 2) if elapsed else None,
+            "latency_ms": summarize_ms(latency),
+            "upstream_calls": after["embed"] - before["embed"],
+            "proxy_cpu_s": round(cpu, 3),
+        }
+    finally:
+        for p in (proxy, mock):
+            p.terminate()
+            try: p.wait(timeout=10)
+            except subprocess.TimeoutExpired: p.kill()
+
+async def main_async(args) -> dict:
+    results = []
+    for i, coalesce_ms in enumerate(args.coalesce_ms):
+        r = await run_mode(args, coalesce_ms, i * 2)
+        print(f"coalesce={r['coalesce_ms']:<5}ms c={r['concurrency']:<4} ok={r['ok']:<6} err={sum(r['errors'].values()):<4} "
+              f"rps={r['requests_per_s']:<9} latency p50/p95/p99={r['latency_ms']['p50']}/{r['latency_ms']['p95']}/{r['latency_ms']['p99']}ms "
+              f"upstream_calls={r['upstream_calls']:<6} cpu={r['proxy_cpu_s']}s")
+        results.append(r)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Embeddings throughput benchmark, with and without request coalescing")
+    parser.add_argument("--coalesce-ms", type=lambda s: [float(x) for x in s.split(",")], default=[0, 5], help="逗号分隔的合并窗口列表 (毫秒)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=40, help="每个并发客户端发送的请求数")
+    parser.add_argument("--batch-size", type=int, default=64, help="EMBED_BATCH_SIZE")
+    parser.add_argument("--model", default="embeddinggemma")
+    parser.add_argument("--dim", type=int, default=768, help="模拟上游返回的向量维度")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="模拟上游每次调用的延迟")
+    parser.add_argument("--keys", type=int, default=2, help="上游 Key 数")
+    parser.add_argument("--mock-port", type=int, default=18201)
+    parser.add_argument("--proxy-port", type=int, default=18202)
+    parser.add_argument("--output", default=None, help="结果 JSON 路径，默认 bench/results/embeddings-<时间>.json")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    output = args.output or os.path.join(ROOT, "bench", "results", time.strftime("embeddings-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""上游请求体微基准: 对比旧路径 (每次尝试 httpx json= 重新 json.dumps) 与 prepare_body 序列化一次后复用，
+以及开启 gzip / zstd (需安装 zstandard) 请求体压缩后的上游字节数与 CPU 时间；另外给出非流式响应 gzip 后的大小。
+场景为 10–200 条消息的 agent 对话 (system 提示词、工具调用与工具输出)。
+
+用法 (在项目根目录执行):
+    python bench/bench_payload.py [--messages 10,25,50,100,200] [--attempts 3]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app.settings as settings  # noqa: E402
+import app.upstream as upstream  # noqa: E402
+from app.compression import ZSTD_AVAILABLE, compress  # noqa: E402
+from app.openai_compat import ChatCompletionRequest, build_payload, completion_body  # noqa: E402
+
+TOOLS = [{"type": "function", "function": {"name": "read_file", "description": "Read a file from the workspace",
+                                           "parameters": {"type": "object", "properties": {"path": {"type": "string"}}, "required": ["path"]}}}]
+SOURCE = "def handler(request):\n    # 处理请求并返回结果\n    data = request.json()\n    return {'status': 'ok', 'items': data.get('items', [])}\n"
+
+def make_request(messages: int) -> ChatCompletionRequest:
+    msgs = [{"role": "system", "content": "You are a coding agent. Follow the repository conventions. " * 30}]
+    for i in range(messages - 1):
+        kind = i % 4
+        if kind == 0: msgs.append({"role": "user", "content": f"step {i}: 请检查 src/module_{i}.py 并修复其中的问题"})
+        elif kind == 1:
+            msgs.append({"role": "assistant", "content": "", "tool_calls": [
+                {"id": f"call_{i}", "type": "function", "function": {"name": "read_file", "arguments": json.dumps({"path": f"src/module_{i}.py"})}}]})
+        elif kind == 2: msgs.append({"role": "tool", "tool_call_id": f"call_{i - 1}", "content": SOURCE * 8})
+        else: msgs.append({"role": "assistant", "content": f"已修改 module_{i}.py: 增加了输入校验并补充了错误处理。" * 3})
+    return ChatCompletionRequest.model_validate({"model": "qwen3-coder:480b", "messages": msgs, "tools": TOOLS, "stream": True})
+
+def best_of(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t = time.process_time()
+        fn()
+        elapsed = time.process_time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def prepared(payload: dict, encoding: str, attempts: int):
+    settings.UPSTREAM_COMPRESSION = encoding
+    body = upstream.prepare_body(payload)
+    return body, [body.content for _ in range(attempts)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream request body serialization / compression micro-benchmark")
+    parser.add_argument("--messages", type=lambda s: [int(x) for x in s.split(",")], default=[10, 25, 50, 100, 200])
+    parser.add_argument("--attempts", type=int, default=3, help="每个请求的上游尝试次数 (故障转移 / 对冲)")
+    parser.add_argument("--response-tokens", type=int, default=800, help="非流式响应的回复长度 (字)")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    settings.UPSTREAM_COMPRESSION_MIN_BYTES = 0
+    encodings = ["", "gzip"] + (["zstd"] if ZSTD_AVAILABLE else [])
+    loop = asyncio.new_event_loop()
+    header = f"{'messages':>8} {'legacy_kb':>9} {'legacy_ms':>9}"
+    for enc in encodings: header += f" {(enc or 'plain') + '_kb':>9} {(enc or 'plain') + '_ms':>9}"
+    print(header + f" {'resp_kb':>7} {'resp_gzip_kb':>12}")
+    for n in args.messages:
+        payload = loop.run_until_complete(build_payload(make_request(n)))
+        # 旧路径: httpx 的 json= 在每次尝试时都用 json.dumps (默认分隔符、ASCII 转义) 重新编码
+        legacy_bytes = len(json.dumps(payload).encode()) * args.attempts
+        legacy = best_of(lambda: [json.dumps(payload).encode() for _ in range(args.attempts)], args.repeat)
+        row = f"{n:>8} {legacy_bytes / 1024:>9.1f} {legacy * 1000:>9.3f}"
+        for enc in encodings:
+            body, _ = prepared(payload, enc, args.attempts)
+            cost = best_of(lambda: prepared(payload, enc, args.attempts), args.repeat)
+            row += f" {len(body.content) * args.attempts / 1024:>9.1f} {cost * 1000:>9.3f}"
+        content = "".join("修改说明: 增加输入校验。"[i % 12] for i in range(args.response_tokens))
+        response = json.dumps(completion_body("qwen3-coder:480b", {"content": content, "finish_reason": "stop", "prompt_tokens": 1000, "completion_tokens": args.response_tokens})).encode()
+        row += f" {len(response) / 1024:>7.1f} {len(compress(response, 'gzip')) / 1024:>12.1f}"
+        print(row)
+    loop.close()
+    print(f"(kb 为 {args.attempts} 次尝试发送的总字节数，ms 为序列化 + 压缩的进程 CPU 时间)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""端到端压测: 启动本地模拟上游 (bench/mock_ollama.py) 与代理，按并发数压测流式 / 非流式对话。
+
+全程离线运行，每次运行使用临时数据目录。输出每个场景的 requests/sec、TTFB 与 token 间隔的 p50/p95/p99、
+代理进程每个 token 的 CPU 时间与 RSS，结果写入 JSON 文件便于对比不同版本。
+
+用法 (在项目根目录执行):
+    python bench/bench_proxy.py --concurrency 1,10,50 --requests 20 --tokens 200 --token-rate 200
+    python bench/bench_proxy.py --mode stream --bad-keys 1 --output bench/results/baseline.json
+    python bench/bench_proxy.py --api native --mode stream   # Ollama 原生接口透传，对比转码开销
+
+依赖 Linux 的 /proc 读取代理进程的 CPU 与内存。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize_ms(values: List[float]) -> dict:
+    return {k: round(v * 1000, 2) if v is not None else None for k, v in
+            (("p50", percentile(values, 0.5)), ("p95", percentile(values, 0.95)), ("p99", percentile(values, 0.99)))}
+
+def proc_cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f: fields = f.read().rsplit(")", 1)[1].split()
+    # utime / stime 是 ")" 之后的第 12、13 个字段
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+def proc_rss_kb(pid: int) -> Dict[str, int]:
+    out = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, value = line.split(":", 1)
+                out[name] = int(value.split()[0])
+    return {"rss_kb": out.get("VmRSS", 0), "peak_rss_kb": out.get("VmHWM", 0)}
+
+def spawn(args: List[str], cwd: str, log_path: str, env: Optional[dict] = None) -> subprocess.Popen:
+    # 输出写入文件而不是管道，避免日志过多时子进程阻塞
+    with open(log_path, "wb") as log: return subprocess.Popen(args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(url: str, proc: subprocess.Popen, log_path: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                with open(log_path, errors="replace") as f: raise RuntimeError(f"{url} exited:\n{f.read()}")
+            try:
+                await client.get(url, timeout=1.0)
+                return
+            except httpx.HTTPError: await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+async def setup_proxy(base: str, mock: str, good_keys: int, bad_keys: int) -> str:
+    """用默认管理员账号配置上游地址与 Key，返回新建的 Client Key"""
+    headers = {"X-Forwarded-For": "127.0.0.1"}
+    async with httpx.AsyncClient(base_url=base, headers=headers) as client:
+        r = await client.post("/login", data={"username": "admin", "password": "admin"})
+        r.raise_for_status()
+        await client.post("/admin/config", data={"ollama_host": f"{mock}/api/chat"})
+        # 失效的 Key 排在前面，用于测量 Key 切换的开销
+        for i in range(bad_keys): await client.post("/admin/upstream_keys", data={"key": f"bench-status-401-{i}", "remarks": f"bad {i}"})
+        for i in range(good_keys): await client.post("/admin/upstream_keys", data={"key": f"bench-key-{i}", "remarks": f"good {i}"})
+        r = await client.post("/admin/keys", data={"name": "bench"})
+        r.raise_for_status()
+        return r.json()["key"]
+
+class Recorder:
+    def __init__(self):
+        self.ttfb: List[float] = []
+        self.gaps: List[float] = []
+        self.latency: List[float] = []
+        self.tokens = 0
+        self.ok = 0
+        self.errors: Dict[str, int] = {}
+
+    def error(self, reason: str):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+ROUTES = {"openai": "/v1/chat/completions", "native": "/api/chat"}
+
+def is_token(api: str, line: str) -> bool:
+    if api == "native": return bool(line) and '"done": true' not in line and '"done":true' not in line
+    return line.startswith("data: ") and line != "data: [DONE]"
+
+async def one_stream(client: httpx.AsyncClient, api: str, body: dict, rec: Recorder):
+    started = time.perf_counter()
+    last = None
+    try:
+        async with client.stream("POST", ROUTES[api], json=body) as resp:
+            if resp.status_code != 200:
+                await resp.aread()
+                return rec.error(str(resp.status_code))
+            async for line in resp.aiter_lines():
+                if not is_token(api, line): continue
+                now = time.perf_counter()
+                if last is None: rec.ttfb.append(now - started)
+                else: rec.gaps.append(now - last)
+                last = now
+                rec.tokens += 1
+    except httpx.HTTPError as e: return rec.error(type(e).__name__)
+    rec.latency.append(time.perf_counter() - started)
+    rec.ok += 1
+
+async def one_request(client: httpx.AsyncClient, api: str, body: dict, rec: Recorder):
+    started = time.perf_counter()
+    try: resp = await client.post(ROUTES[api], json=body)
+    except httpx.HTTPError as e: return rec.error(type(e).__name__)
+    if resp.status_code != 200: return rec.error(str(resp.status_code))
+    elapsed = time.perf_counter() - started
+    rec.ttfb.append(elapsed)
+    rec.latency.append(elapsed)
+    data = resp.json()
+    rec.tokens += data.get("eval_count", 0) if api == "native" else data.get("usage", {}).get("completion_tokens", 0)
+    rec.ok += 1
+
+async def run_scenario(base: str, client_key: str, pid: int, api: str, mode: str, concurrency: int, requests: int, model: str) -> dict:
+    rec = Recorder()
+    body = {"model": model, "messages": [{"role": "user", "content": "benchmark prompt " * 20}], "stream": mode == "stream"}
+    fn = one_stream if mode == "stream" else one_request
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, headers={"Authorization": f"Bearer {client_key}"}, limits=limits, timeout=300) as client:
+        async def worker():
+            for _ in range(requests): await fn(client, api, body, rec)
+
+        cpu_before = proc_cpu_seconds(pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        cpu = proc_cpu_seconds(pid) - cpu_before
+    return {
+        "api": api, "mode": mode, "concurrency": concurrency, "requests": concurrency * requests,
+        "ok": rec.ok, "errors": rec.errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(rec.ok / elapsed, 2) if elapsed else None,
+        "tokens": rec.tokens,
+        "tokens_per_s": round(rec.tokens / elapsed, 1) if elapsed else None,
+        "ttfb_ms": summarize_ms(rec.ttfb),
+        "inter_token_ms": summarize_ms(rec.gaps),
+        "latency_ms": summarize_ms(rec.latency),
+        "proxy_cpu_s": round(cpu, 3),
+        "proxy_cpu_us_per_token": round(cpu / rec.tokens * 1e6, 2) if rec.tokens else None,
+        **proc_rss_kb(pid),
+    }
+
+def print_row(r: dict):
+    print(f"{r['api']:>6} {r['mode']:>9} c={r['concurrency']:<4} ok={r['ok']:<5} err={sum(r['errors'].values()):<4} "
+          f"rps={r['requests_per_s']:<8} tok/s={r['tokens_per_s']:<9} "
+          f"ttfb p50/p95/p99={r['ttfb_ms']['p50']}/{r['ttfb_ms']['p95']}/{r['ttfb_ms']['p99']}ms "
+          f"itl p50/p99={r['inter_token_ms']['p50']}/{r['inter_token_ms']['p99']}ms "
+          f"cpu/token={r['proxy_cpu_us_per_token']}us rss={r['rss_kb'] // 1024}MB")
+
+async def main_async(args) -> dict:
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    workdir = tempfile.mkdtemp(prefix="ollama-proxy-bench-")
+    mock_log, proxy_log = os.path.join(workdir, "mock.log"), os.path.join(workdir, "proxy.log")
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    mock = spawn([sys.executable, os.path.join(ROOT, "bench", "mock_ollama.py"), "--port", str(args.mock_port),
+                  "--tokens", str(args.tokens), "--token-rate", str(args.token_rate),
+                  "--latency-ms", str(args.latency_ms), "--error-rate", str(args.error_rate)], ROOT, mock_log)
+    proxy = spawn([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.proxy_port),
+                   "--log-level", "warning", "--no-access-log"], workdir, proxy_log, env)
+    try:
+        await wait_ready(f"{mock_url}/_stats", mock, mock_log)
+        await wait_ready(f"{proxy_url}/login", proxy, proxy_log)
+        client_key = await setup_proxy(proxy_url, mock_url, args.keys, args.bad_keys)
+        modes = ["stream", "nonstream"] if args.mode == "both" else [args.mode]
+        results = []
+        for mode in modes:
+            for concurrency in args.concurrency:
+                r = await run_scenario(proxy_url, client_key, proxy.pid, args.api, mode, concurrency, args.requests, args.model)
+                print_row(r)
+                results.append(r)
+        return {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+            "results": results,
+        }
+    finally:
+        for p in (proxy, mock):
+            p.terminate()
+            try: p.wait(timeout=10)
+            except subprocess.TimeoutExpired: p.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Ollama proxy load test against a local mock upstream")
+    parser.add_argument("--api", choices=list(ROUTES), default="openai", help="openai: /v1/chat/completions (转码)，native: /api/chat (原样透传)")
+    parser.add_argument("--mode", choices=["stream", "nonstream", "both"], default="both")
+    parser.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 10, 50], help="逗号分隔的并发数列表")
+    parser.add_argument("--requests", type=int, default=20, help="每个并发客户端发送的请求数")
+    parser.add_argument("--model", default="gpt-oss:120b")
+    parser.add_argument("--tokens", type=int, default=200, help="模拟上游每个回复的 token 数")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="模拟上游每个流每秒 token 数，0 为不限速")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="模拟上游首 token 延迟")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游随机返回 503 的比例")
+    parser.add_argument("--keys", type=int, default=2, help="可用的上游 Key 数")
+    parser.add_argument("--bad-keys", type=int, default=0, help="返回 401 的上游 Key 数 (排在可用 Key 之前)")
+    parser.add_argument("--mock-port", type=int, default=18101)
+    parser.add_argument("--proxy-port", type=int, default=18102)
+    parser.add_argument("--output", default=None, help="结果 JSON 路径，默认 bench/results/proxy-<时间>.json")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    output = args.output or os.path.join(ROOT, "bench", "results", time.strftime("proxy-%Y%m%d-%H%M%S.json"))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {output}")
+
+if __name__ == "__main__":
+    main()
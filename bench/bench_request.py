@@ -0,0 +1,59 @@
+"""OpenAI 请求解析微基准: 对比 json.loads + model_validate (FastAPI 默认路径)、model_validate_json
+与代理使用的 parse_request (安装 orjson 时用其解析)，以及转换为 Ollama 请求体 (build_payload) 的耗时，
+场景为长对话与带 base64 图片的多模态消息。
+
+用法 (在项目根目录执行):
+    python bench/bench_request.py [--messages 10,100,1000] [--images 0,4] [--image-kb 512]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.openai_compat import ChatCompletionRequest, build_payload, parse_request  # noqa: E402
+
+def make_body(messages: int, images: int, image_kb: int) -> bytes:
+    msgs = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i} " + "lorem ipsum dolor sit amet " * 20} for i in range(messages)]
+    if images:
+        data = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+        parts = [{"type": "text", "text": "describe these images"}]
+        parts += [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}} for _ in range(images)]
+        msgs.append({"role": "user", "content": parts})
+    return json.dumps({"model": "qwen3-vl:235b", "messages": msgs, "stream": True}).encode()
+
+def best_of(fn, repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI request parsing micro-benchmark")
+    parser.add_argument("--messages", type=lambda s: [int(x) for x in s.split(",")], default=[10, 100, 1000])
+    parser.add_argument("--images", type=lambda s: [int(x) for x in s.split(",")], default=[0, 4])
+    parser.add_argument("--image-kb", type=int, default=512, help="每张图片的原始大小 (KB)")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    print(f"{'messages':>8} {'images':>6} {'body_kb':>8} {'loads+validate_ms':>18} {'validate_json_ms':>17} {'parse_request_ms':>17} {'build_payload_ms':>17}")
+    for n in args.messages:
+        for k in args.images:
+            body = make_body(n, k, args.image_kb)
+            legacy = best_of(lambda: ChatCompletionRequest.model_validate(json.loads(body)), args.repeat)
+            from_json = best_of(lambda: ChatCompletionRequest.model_validate_json(body), args.repeat)
+            proxy = best_of(lambda: parse_request(body), args.repeat)
+            req = ChatCompletionRequest.model_validate_json(body)
+            build = best_of(lambda: loop.run_until_complete(build_payload(req)), args.repeat)
+            print(f"{n:>8} {k:>6} {len(body) // 1024:>8} {legacy * 1000:>18.3f} {from_json * 1000:>17.3f} {proxy * 1000:>17.3f} {build * 1000:>17.3f}")
+    loop.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""SSE 转码微基准: 对比旧版逐行 json.loads/json.dumps 与 StreamTranscoder。
+
+用法 (在项目根目录执行):
+    python bench/bench_transcode.py [--tokens 20000] [--coalesce-ms 0]
+
+输出每种实现的 tokens/sec、每个 chunk 的输出字节数，以及 tracemalloc 统计的每个 chunk 瞬时分配峰值。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.transcode import StreamTranscoder  # noqa: E402
+
+def make_lines(n: int, model: str = "gpt-oss:120b"):
+    words = ["Hello", " world", ",", " 你好", " the", " quick", " brown", " fox", "\n", ' "quoted"']
+    lines = [json.dumps({"model": model, "created_at": "2025-01-01T00:00:00Z", "message": {"role": "assistant", "content": words[i % len(words)]}, "done": False}) for i in range(n)]
+    lines.append(json.dumps({"model": model, "message": {"role": "assistant", "content": ""}, "done": True, "prompt_eval_count": 10, "eval_count": n}))
+    return lines
+
+def legacy(lines, model):
+    """user-007 之前 _chat_logic 中 stream_gen 的实现 (产出 str，由 StreamingResponse 再编码)"""
+    for line in lines:
+        if not line: continue
+        try:
+            d = json.loads(line)
+            if d.get("done"): yield "data: [DONE]\n\n".encode(); break
+            c = d.get("message", {}).get("content", "")
+            yield f"data: {json.dumps({'id':'chatcmpl-1','object':'chat.completion.chunk','created':int(time.time()),'model':model,'choices':[{'index':0,'delta':{'content':c},'finish_reason':None}]})}\n\n".encode()
+        except: pass
+
+def transcoded(lines, model, coalesce_ms):
+    tc = StreamTranscoder(model, flush_ms=coalesce_ms)
+    for line in lines:
+        out = tc.feed(line)
+        if out: yield out
+        if tc.done: break
+
+def run_speed(fn, lines, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out_bytes = 0
+        frames = 0
+        for chunk in fn(lines):
+            out_bytes += len(chunk)
+            frames += 1
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out_bytes, frames
+
+def run_alloc(fn, lines, sample=2000):
+    """逐 chunk 统计瞬时分配峰值 (peak - 当前占用)，取平均"""
+    lines = lines[:sample] + lines[-1:]
+    tracemalloc.start()
+    gen = fn(lines)
+    total = 0
+    n = 0
+    while True:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        try: chunk = next(gen)
+        except StopIteration: break
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - base
+        n += 1
+        del chunk
+    tracemalloc.stop()
+    return total / max(n, 1)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--coalesce-ms", type=float, default=0.0)
+    parser.add_argument("--model", default="gpt-oss:120b")
+    args = parser.parse_args()
+    lines = make_lines(args.tokens, args.model)
+    impls = [
+        ("legacy", lambda ls: legacy(ls, args.model)),
+        ("transcoder", lambda ls: transcoded(ls, args.model, args.coalesce_ms)),
+    ]
+    results = {}
+    for name, fn in impls:
+        elapsed, out_bytes, frames = run_speed(fn, lines)
+        alloc = run_alloc(fn, lines)
+        results[name] = {
+            "tokens_per_sec": round(args.tokens / elapsed),
+            "frames": frames,
+            "bytes_per_frame": round(out_bytes / max(frames, 1), 1),
+            "alloc_bytes_per_chunk": round(alloc, 1),
+        }
+    print(json.dumps({"tokens": args.tokens, "coalesce_ms": args.coalesce_ms, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""极简的 Redis 协议 (RESP) 替身，只实现 PING / AUTH / SUBSCRIBE / UNSUBSCRIBE / PUBLISH / QUIT。
+
+用于在没有 Redis 的机器上离线验证多 worker 模式 (STATE_BACKEND=redis)，不适合生产环境。
+
+用法:
+    python bench/mini_redis.py --port 16379
+    STATE_BACKEND=redis STATE_REDIS_URL=redis://127.0.0.1:16379/0 uvicorn app.main:app --workers 4
+"""
+import argparse
+import asyncio
+from typing import Dict, Set
+
+def encode(value) -> bytes:
+    if isinstance(value, int): return b":%d\r\n" % value
+    if isinstance(value, str): value = value.encode()
+    if isinstance(value, bytes): return b"$%d\r\n%s\r\n" % (len(value), value)
+    return b"*%d\r\n" % len(value) + b"".join(encode(v) for v in value)
+
+async def read_command(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    if not line.startswith(b"*"): return line.strip().split()  # inline 命令 (如 redis-cli 的 PING)
+    args = []
+    for _ in range(int(line[1:-2])):
+        size = int((await reader.readuntil(b"\r\n"))[1:-2])
+        args.append((await reader.readexactly(size + 2))[:-2])
+    return args
+
+class Broker:
+    def __init__(self):
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed: Set[bytes] = set()
+        try:
+            while True:
+                args = await read_command(reader)
+                if not args: continue
+                cmd = args[0].upper()
+                if cmd == b"PING": writer.write(b"+PONG\r\n")
+                elif cmd in (b"AUTH", b"SELECT"): writer.write(b"+OK\r\n")
+                elif cmd == b"SUBSCRIBE":
+                    for ch in args[1:]:
+                        subscribed.add(ch)
+                        self.channels.setdefault(ch, set()).add(writer)
+                        writer.write(encode([b"subscribe", ch, len(subscribed)]))
+                elif cmd == b"UNSUBSCRIBE":
+                    for ch in args[1:] or list(subscribed):
+                        subscribed.discard(ch)
+                        self.channels.get(ch, set()).discard(writer)
+                        writer.write(encode([b"unsubscribe", ch, len(subscribed)]))
+                elif cmd == b"PUBLISH" and len(args) == 3:
+                    receivers = self.channels.get(args[1], set())
+                    frame = encode([b"message", args[1], args[2]])
+                    for w in receivers: w.write(frame)
+                    writer.write(encode(len(receivers)))
+                elif cmd == b"QUIT":
+                    writer.write(b"+OK\r\n")
+                    break
+                else: writer.write(b"-ERR unknown command '%s'\r\n" % cmd)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError): pass
+        finally:
+            for ch in subscribed: self.channels.get(ch, set()).discard(writer)
+            writer.close()
+
+async def serve(host: str, port: int):
+    server = await asyncio.start_server(Broker().handle, host, port)
+    async with server: await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimal RESP pub/sub server for local testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=16379)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
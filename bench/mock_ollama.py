@@ -0,0 +1,167 @@
+"""本地模拟 Ollama 上游，用于离线压测 (不访问 Ollama Cloud)。
+
+支持 /api/chat、/api/generate (NDJSON 流式与非流式)、/api/embed、/api/tags 与 /api/show。请求带 think 时先输出 thinking，
+带 tools 时最后调用第一个工具，options.num_predict 限制回复长度。可配置首 token 延迟、token 速率、回复长度和错误注入:
+    - Key 中包含 status-401 / status-403 / status-429 / status-500 时固定返回对应状态码 (用于验证 Key 切换)
+    - Key 中包含 hang 时不返回响应 (模拟上游挂起)，包含 stall 时流式响应输出两个 token 后停止 (模拟中途卡住)
+    - --error-rate 按比例随机返回 503
+请求体带 Content-Encoding: gzip / zstd 时先解压，/_stats 中的 bytes_in 为收到的请求体字节数 (压缩后)。
+
+用法:
+    python bench/mock_ollama.py --port 18001 --tokens 200 --token-rate 100 --latency-ms 50
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import json
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+MODELS = ["gpt-oss:120b", "gpt-oss:20b", "deepseek-v3.1:671b", "qwen3-coder:480b"]
+WORDS = ["Hello", " world", ",", " 你好", " the", " quick", " brown", " fox", " jumps", "\n"]
+
+def _injected_status(request: Request, error_rate: float):
+    auth = request.headers.get("authorization", "")
+    for code in (401, 403, 429, 500):
+        if f"status-{code}" in auth: return code
+    if error_rate > 0 and random.random() < error_rate: return 503
+    return None
+
+async def read_json(request: Request, stats: dict) -> dict:
+    data = await request.body()
+    stats["bytes_in"] += len(data)
+    encoding = request.headers.get("content-encoding", "")
+    if encoding == "gzip": data = gzip.decompress(data)
+    elif encoding == "zstd":
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data, max_output_size=256 * 1024 * 1024)
+    return json.loads(data)
+
+def embedding(text: str, dim: int) -> list:
+    """由文本哈希生成的确定性向量，便于校验输出顺序"""
+    digest = hashlib.sha256(text.encode()).digest()
+    return [round(digest[i % len(digest)] / 255, 4) for i in range(dim)]
+
+def create_app(tokens: int = 100, token_rate: float = 0.0, latency_ms: float = 0.0, error_rate: float = 0.0, embed_dim: int = 16) -> Starlette:
+    """token_rate 为每个流每秒输出的 token 数 (0 表示不限速)，latency_ms 为首 token (或 embed 响应) 前的等待"""
+    interval = 1 / token_rate if token_rate > 0 else 0.0
+    stats = {"chat": 0, "generate": 0, "tags": 0, "show": 0, "embed": 0, "embed_inputs": 0, "images": 0, "errors": 0, "bytes_in": 0, "started": time.time()}
+
+    def message(text: str, generate: bool) -> dict:
+        return {"response": text} if generate else {"message": {"role": "assistant", "content": text}}
+
+    def token_line(model: str, i: int, generate: bool) -> bytes:
+        return (json.dumps({"model": model, "created_at": "2025-01-01T00:00:00Z", **message(WORDS[i % len(WORDS)], generate), "done": False}, ensure_ascii=False) + "\n").encode()
+
+    def done_line(model: str, prompt_tokens: int, generate: bool, n: int) -> bytes:
+        return (json.dumps({"model": model, **message("", generate), "done": True, "done_reason": "stop" if n == tokens else "length",
+                            "prompt_eval_count": prompt_tokens, "eval_count": n}) + "\n").encode()
+
+    def extras(body: dict) -> dict:
+        out = {}
+        if body.get("think"): out["thinking"] = "Let me think."
+        if body.get("tools"):
+            name = ((body["tools"][0] or {}).get("function") or {}).get("name", "tool")
+            out["tool_calls"] = [{"function": {"name": name, "arguments": {"city": "Paris"}}}]
+        return out
+
+    async def chat(request: Request):
+        generate = request.url.path == "/api/generate"
+        stats["generate" if generate else "chat"] += 1
+        status = _injected_status(request, error_rate)
+        if status is not None:
+            stats["errors"] += 1
+            return JSONResponse({"error": f"injected {status}"}, status_code=status)
+        body = await read_json(request, stats)
+        auth = request.headers.get("authorization", "")
+        if "hang" in auth: await asyncio.sleep(3600)
+        stall = "stall" in auth
+        model = body.get("model", MODELS[0])
+        prompt = (body.get("prompt") or "") if generate else "".join(m.get("content") or "" for m in body.get("messages", []))
+        prompt_tokens = len(prompt) // 4 + 1
+        stats["images"] += sum(len(m.get("images") or []) for m in body.get("messages", []))
+        n = min(tokens, (body.get("options") or {}).get("num_predict") or tokens)
+        extra = {} if generate else extras(body)
+        if latency_ms > 0: await asyncio.sleep(latency_ms / 1000)
+        if body.get("stream", True):
+            lines = [token_line(model, i, generate) for i in range(len(WORDS))]
+
+            async def gen():
+                if "thinking" in extra: yield (json.dumps({"model": model, "message": {"role": "assistant", "content": "", "thinking": extra["thinking"]}, "done": False}) + "\n").encode()
+                for i in range(n):
+                    if interval: await asyncio.sleep(interval)
+                    if stall and i == 2: await asyncio.sleep(3600)
+                    yield lines[i % len(lines)]
+                if "tool_calls" in extra: yield (json.dumps({"model": model, "message": {"role": "assistant", "content": "", "tool_calls": extra["tool_calls"]}, "done": False}) + "\n").encode()
+                yield done_line(model, prompt_tokens, generate, n)
+            return StreamingResponse(gen(), media_type="application/x-ndjson")
+        if interval: await asyncio.sleep(interval * n)
+        content = "".join(WORDS[i % len(WORDS)] for i in range(n))
+        msg = message(content, generate)
+        if extra: msg["message"].update(extra)
+        return JSONResponse({"model": model, **msg, "done": True, "done_reason": "stop" if n == tokens else "length",
+                             "prompt_eval_count": prompt_tokens, "eval_count": n})
+
+    async def tags(request: Request):
+        stats["tags"] += 1
+        status = _injected_status(request, error_rate)
+        if status is not None:
+            stats["errors"] += 1
+            return JSONResponse({"error": f"injected {status}"}, status_code=status)
+        return JSONResponse({"models": [{"name": m, "model": m} for m in MODELS]})
+
+    async def embed(request: Request):
+        stats["embed"] += 1
+        status = _injected_status(request, error_rate)
+        if status is not None:
+            stats["errors"] += 1
+            return JSONResponse({"error": f"injected {status}"}, status_code=status)
+        body = await read_json(request, stats)
+        inputs = body.get("input") or []
+        if isinstance(inputs, str): inputs = [inputs]
+        stats["embed_inputs"] += len(inputs)
+        if latency_ms > 0: await asyncio.sleep(latency_ms / 1000)
+        dim = body.get("dimensions") or embed_dim
+        return JSONResponse({"model": body.get("model"), "embeddings": [embedding(t, dim) for t in inputs],
+                             "prompt_eval_count": sum(len(t) // 4 + 1 for t in inputs)})
+
+    async def show(request: Request):
+        stats["show"] += 1
+        body = await read_json(request, stats)
+        return JSONResponse({"modelfile": "", "details": {"family": "mock", "parameter_size": "1B"}, "model_info": {"general.name": body.get("model")}})
+
+    async def mock_stats(request: Request):
+        return JSONResponse(stats)
+
+    return Starlette(routes=[
+        Route("/api/chat", chat, methods=["POST"]),
+        Route("/api/generate", chat, methods=["POST"]),
+        Route("/api/embed", embed, methods=["POST"]),
+        Route("/api/tags", tags),
+        Route("/api/show", show, methods=["POST"]),
+        Route("/_stats", mock_stats),
+    ])
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Ollama upstream")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18001)
+    parser.add_argument("--tokens", type=int, default=100, help="每个回复的 token 数")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="每个流每秒 token 数，0 为不限速")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="首 token 前的延迟")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 503 的比例")
+    parser.add_argument("--embed-dim", type=int, default=16, help="/api/embed 返回的向量维度")
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(args.tokens, args.token_rate, args.latency_ms, args.error_rate, args.embed_dim)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
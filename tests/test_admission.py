@@ -0,0 +1,140 @@
+import asyncio
+import pytest
+import app.settings as settings
+from app.admission import AdmissionController, AdmissionRejected, TokenBucket
+
+LIMITS = ("ADMISSION_GLOBAL_CONCURRENCY", "ADMISSION_USER_CONCURRENCY", "ADMISSION_CLIENT_KEY_CONCURRENCY", "ADMISSION_UPSTREAM_KEY_CONCURRENCY",
+          "ADMISSION_USER_RPM", "ADMISSION_USER_TPM", "ADMISSION_CLIENT_KEY_RPM", "ADMISSION_CLIENT_KEY_TPM")
+
+@pytest.fixture(autouse=True)
+def no_limits(monkeypatch):
+    for name in LIMITS: monkeypatch.setattr(settings, name, 0)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT", 5.0)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE_PER_USER", 100)
+
+def test_token_bucket_refill():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 1) == 0
+    # 超过容量的请求只需等桶满
+    assert bucket.wait_time(1000, now + 1) == pytest.approx(59.0)
+
+def test_concurrency_limit_queues_until_release(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_USER_CONCURRENCY", 1)
+
+    async def run():
+        controller = AdmissionController()
+        first = await controller.admit("u")
+        second = asyncio.ensure_future(controller.admit("u"))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        assert controller.stats()["queue_depth"] == 1
+        first.release()
+        ticket = await asyncio.wait_for(second, 1)
+        assert controller.stats()["inflight"] == 1
+        ticket.release()
+        ticket.release()  # 重复 release 不会重复扣减
+        assert controller.stats()["inflight"] == 0
+
+    asyncio.run(run())
+
+def test_user_limit_follows_upstream_key_count(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_UPSTREAM_KEY_CONCURRENCY", 2)
+    controller = AdmissionController(key_count=lambda user_id: 3)
+    assert controller._user_limit("u") == 6
+    monkeypatch.setattr(settings, "ADMISSION_USER_CONCURRENCY", 4)
+    assert controller._user_limit("u") == 4
+    assert AdmissionController(key_count=lambda user_id: None)._user_limit("u") == 4
+
+def test_queue_full_and_wait_timeout(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_USER_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_QUEUE_PER_USER", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT", 0.05)
+
+    async def run():
+        controller = AdmissionController()
+        await controller.admit("u")
+        waiting = asyncio.ensure_future(controller.admit("u"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.admit("u")
+        assert full.value.reason == "queue full"
+        with pytest.raises(AdmissionRejected) as timeout:
+            await waiting
+        assert timeout.value.reason == "wait timeout"
+        assert timeout.value.retry_after >= 1
+        assert controller.stats()["queue_depth"] == 0
+        assert controller.rejected == 2
+
+    asyncio.run(run())
+
+def test_cancelled_waiter_leaves_queue(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_USER_CONCURRENCY", 1)
+
+    async def run():
+        controller = AdmissionController()
+        first = await controller.admit("u")
+        waiting = asyncio.ensure_future(controller.admit("u"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.stats()["queue_depth"] == 0
+        first.release()
+        assert controller.stats()["inflight"] == 0
+
+    asyncio.run(run())
+
+def test_fair_queue_rotates_between_users(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_GLOBAL_CONCURRENCY", 1)
+
+    async def run():
+        controller = AdmissionController()
+        holder = await controller.admit("x")
+        order = []
+
+        async def request(user_id: str):
+            ticket = await controller.admit(user_id)
+            order.append(user_id)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        # a 先排入 3 个请求，b 随后排入 1 个: b 不必等 a 的请求全部完成
+        tasks = [asyncio.ensure_future(request(u)) for u in ("a", "a", "a", "b")]
+        await asyncio.sleep(0.01)
+        holder.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        assert order == ["a", "b", "a", "a"]
+
+    asyncio.run(run())
+
+def test_rate_limit_rejects_with_retry_after(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_USER_RPM", 1)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT", 0.05)
+
+    async def run():
+        controller = AdmissionController()
+        (await controller.admit("u")).release()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit("u")
+        # 1 RPM: 下一个令牌约 60 秒后补充
+        assert 55 <= rejected.value.retry_after <= 60
+        # 其它用户不受影响
+        (await controller.admit("v")).release()
+
+    asyncio.run(run())
+
+def test_tokens_per_minute_charges_request_size(monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_CLIENT_KEY_TPM", 1000)
+    monkeypatch.setattr(settings, "ADMISSION_MAX_WAIT", 0.05)
+
+    async def run():
+        controller = AdmissionController()
+        (await controller.admit("u", "k1", 800)).release()
+        with pytest.raises(AdmissionRejected):
+            await controller.admit("u", "k1", 800)
+        (await controller.admit("u", "k2", 800)).release()
+
+    asyncio.run(run())
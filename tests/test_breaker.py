@@ -0,0 +1,79 @@
+import pytest
+import app.settings as settings
+from app.breaker import CircuitBreaker, CircuitOpen, HostBreakers, host_of
+
+@pytest.fixture(autouse=True)
+def breaker_settings(monkeypatch):
+    monkeypatch.setattr(settings, "BREAKER_ENABLED", True)
+    monkeypatch.setattr(settings, "BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(settings, "BREAKER_OPEN_SECONDS", 10.0)
+    monkeypatch.setattr(settings, "BREAKER_OPEN_MAX_SECONDS", 25.0)
+    monkeypatch.setattr(settings, "BREAKER_PROBE_INTERVAL", 2.0)
+
+def test_opens_after_consecutive_failures(clock):
+    b = CircuitBreaker("k")
+    b.record(False)
+    b.record(False)
+    b.record(True)  # 成功会清零连续失败计数
+    b.record(False)
+    b.record(False)
+    assert b.state == "closed" and b.allow()
+    b.record(False)
+    assert b.state == "open" and b.trips == 1
+    assert not b.allow() and b.rejected == 1
+    assert b.snapshot()["retry_after"] == 10
+
+def test_half_open_allows_one_probe_per_interval(clock):
+    b = CircuitBreaker("k")
+    for _ in range(3): b.record(False)
+    clock.now += 10
+    assert b.available()
+    assert b.allow()
+    assert b.state == "half_open"
+    # 探测进行中时其它请求继续被拒绝
+    assert not b.allow()
+    clock.now += 2
+    assert b.allow()
+
+def test_probe_success_closes(clock):
+    b = CircuitBreaker("k")
+    for _ in range(3): b.record(False)
+    clock.now += 10
+    assert b.allow()
+    b.record(True)
+    assert b.state == "closed" and b.consecutive_failures == 0
+    # 再次熔断时从初始时长开始
+    for _ in range(3): b.record(False)
+    assert b.open_until == clock.now + 10
+
+def test_probe_failure_reopens_with_backoff(clock):
+    b = CircuitBreaker("k")
+    for _ in range(3): b.record(False)
+    durations = []
+    for _ in range(3):
+        clock.now = b.open_until
+        assert b.allow()
+        b.record(False)
+        assert b.state == "open"
+        durations.append(b.open_until - clock.now)
+    assert durations == [20.0, 25.0, 25.0]
+
+def test_disabled_never_rejects(clock, monkeypatch):
+    monkeypatch.setattr(settings, "BREAKER_ENABLED", False)
+    b = CircuitBreaker("k")
+    for _ in range(10): b.record(False)
+    assert b.allow()
+
+def test_host_breakers(clock):
+    hosts = HostBreakers()
+    url = "https://Ollama.com:443/api/chat"
+    assert host_of(url) == host_of("https://ollama.com/api/tags") == "ollama.com"
+    hosts.check(url)
+    # 未登记的 Host (如图片下载地址) 不建熔断器
+    hosts.record("example.com", False)
+    assert list(hosts.snapshot()) == ["ollama.com"]
+    for _ in range(3): hosts.record("ollama.com", False)
+    with pytest.raises(CircuitOpen) as exc:
+        hosts.check(url)
+    assert exc.value.target == "ollama.com"
+    assert exc.value.retry_after == 10
@@ -0,0 +1,68 @@
+import asyncio
+from app.openai_compat import ChatCompletionRequest, build_payload
+from app.response_cache import ResponseCache
+
+BASE = {"model": "m", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+TOOLS = [{"type": "function", "function": {"name": "read_file", "parameters": {"type": "object", "properties": {}}}}]
+
+def key(user_id: str = "u", **fields) -> str:
+    req = ChatCompletionRequest.model_validate({**BASE, **fields})
+    return ResponseCache.key_for(user_id, asyncio.run(build_payload(req)))
+
+def test_key_ignores_stream_and_key_order():
+    assert key() == key(stream=True) == key(stream=False)
+    a = {"model": "m", "messages": [], "options": {"temperature": 0, "seed": 1}}
+    b = {"options": {"seed": 1, "temperature": 0}, "messages": [], "model": "m"}
+    assert ResponseCache.key_for("u", a) == ResponseCache.key_for("u", b)
+
+def test_key_covers_everything_that_changes_the_output():
+    base = key()
+    variants = [
+        key("other"),
+        key(model="m2"),
+        key(messages=[{"role": "user", "content": "hello"}]),
+        key(seed=1),
+        key(max_tokens=10),
+        key(tools=TOOLS),
+        key(response_format={"type": "json_object"}),
+        key(reasoning_effort="high"),
+    ]
+    assert base not in variants
+    assert len(set(variants)) == len(variants)
+    # tool_choice="none" 时不会把工具交给模型，与不带工具的请求相同
+    assert key(tools=TOOLS, tool_choice="none") == base
+
+def test_join_coalesces_identical_requests():
+    async def run():
+        cache = ResponseCache(10, 60)
+        fill, _ = cache.join("k")
+        again, future = cache.join("k")
+        assert again is None
+        fill.complete({"content": "x"})
+        assert await future == {"content": "x"}
+        assert await cache.get("k") == {"content": "x"}
+        # 失败时等待者收到 None，且不写入缓存
+        fill, _ = cache.join("j")
+        _, future = cache.join("j")
+        fill.abort()
+        assert await future is None
+        assert await cache.get("j") is None
+        assert cache.coalesced == 2
+
+    asyncio.run(run())
+
+def test_refresh_writes_even_with_a_leader_in_flight():
+    async def run():
+        cache = ResponseCache(10, 60)
+        leader, _ = cache.join("k")
+        refresh, pending = cache.join("k", refresh=True)
+        assert refresh is not None and pending is None
+        refresh.complete({"content": "new"})
+        assert await cache.get("k") == {"content": "new"}
+        # 领头请求仍在执行，新到的请求继续等待它
+        _, pending = cache.join("k")
+        leader.complete({"content": "old"})
+        assert await pending == {"content": "old"}
+        assert cache.join("k")[0] is not None
+
+    asyncio.run(run())
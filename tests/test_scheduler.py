@@ -0,0 +1,125 @@
+import pytest
+import app.settings as settings
+from app.breaker import CircuitOpen
+from app.cache import fingerprint
+from app.scheduler import KeyScheduler, KeyState, parse_retry_after
+
+@pytest.fixture(autouse=True)
+def scheduler_settings(monkeypatch):
+    monkeypatch.setattr(settings, "KEY_SCHEDULER_STRATEGY", "least_loaded")
+    monkeypatch.setattr(settings, "KEY_COOLDOWN_AUTH", 300.0)
+    monkeypatch.setattr(settings, "KEY_COOLDOWN_RATE_LIMIT", 60.0)
+    monkeypatch.setattr(settings, "KEY_COOLDOWN_ERROR", 5.0)
+    monkeypatch.setattr(settings, "KEY_COOLDOWN_MAX", 300.0)
+    monkeypatch.setattr(settings, "ADMISSION_UPSTREAM_KEY_CONCURRENCY", 0)
+    monkeypatch.setattr(settings, "BREAKER_ENABLED", True)
+    monkeypatch.setattr(settings, "BREAKER_FAILURE_THRESHOLD", 5)
+    monkeypatch.setattr(settings, "BREAKER_OPEN_SECONDS", 30.0)
+
+def make(*keys: str) -> KeyScheduler:
+    s = KeyScheduler()
+    s._pools["u"] = {k: KeyState(k) for k in keys}
+    return s
+
+def order(s: KeyScheduler):
+    return s._order(s._pools["u"])
+
+def cooldown(s: KeyScheduler, key: str, now: float) -> float:
+    return s._pools["u"][key].cooldown_until - now
+
+def test_cooldown_by_status(clock):
+    s = make("a")
+    s.report("u", "a", 401)
+    assert cooldown(s, "a", clock.now) == 300
+    s.report("u", "a", 429, retry_after=12)
+    assert cooldown(s, "a", clock.now) == 12
+    s.report("u", "a", 429)
+    assert cooldown(s, "a", clock.now) == 60
+    s.report("u", "a", 200, latency=0.5)
+    assert cooldown(s, "a", clock.now) <= 0
+    # 连接错误 / 5xx: 按连续失败次数指数退避，不超过 KEY_COOLDOWN_MAX
+    seen = []
+    for _ in range(8):
+        s.report("u", "a", None if len(seen) % 2 else 502)
+        seen.append(cooldown(s, "a", clock.now))
+    assert seen == [5, 10, 20, 40, 80, 160, 300, 300]
+
+def test_client_errors_count_as_success(clock):
+    s = make("a")
+    s.report("u", "a", 500)
+    s.report("u", "a", 400, latency=0.2)
+    state = s._pools["u"]["a"]
+    assert (state.successes, state.failures, state.consecutive_failures) == (1, 1, 0)
+    assert state.cooldown_until == 0 and state.latency_ewma == pytest.approx(0.2)
+
+def test_order_skips_cooling_and_prefers_idle_keys(clock):
+    s = make("a", "b", "c")
+    s.report("u", "a", 429)
+    s.acquire("u", "b")
+    assert order(s) == ["c", "b"]
+    s.release("u", "b")
+    s.release("u", "b")  # 多余的 release 不会变成负数
+    assert s._pools["u"]["b"].inflight == 0
+
+def test_all_cooling_returns_earliest_key_only(clock):
+    s = make("a", "b")
+    s.report("u", "a", 401)
+    s.report("u", "b", 429, retry_after=5)
+    assert order(s) == ["b"]
+    clock.now += 5
+    assert sorted(order(s)) == ["b"]
+    clock.now += 300
+    assert sorted(order(s)) == ["a", "b"]
+
+def test_per_key_concurrency_limit(clock, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_UPSTREAM_KEY_CONCURRENCY", 1)
+    s = make("a", "b")
+    s.acquire("u", "a")
+    assert order(s) == ["b"]
+    # 全部已满时仍按负载返回，而不是当作没有可用 Key
+    s.acquire("u", "b")
+    s.acquire("u", "b")
+    assert order(s) == ["a", "b"]
+
+def test_open_breakers_raise_circuit_open(clock):
+    s = make("a", "b")
+    for key in ("a", "b"):
+        for _ in range(5): s.report("u", key, 503)
+    with pytest.raises(CircuitOpen) as exc:
+        order(s)
+    assert exc.value.retry_after == 30
+    # 401 / 429 只触发冷却，不计入熔断
+    s = make("a")
+    for _ in range(10): s.report("u", "a", 429)
+    assert s._pools["u"]["a"].breaker.state == "closed"
+
+def test_cooldown_callback_and_remote_cooldown(clock):
+    s = make("a", "b")
+    events = []
+    s.on_cooldown = lambda user_id, key, remaining: events.append((user_id, key, remaining))
+    s.report("u", "a", 429, retry_after=7)
+    s.report("u", "a", 429, retry_after=7)  # 截止时间不变时不重复回调
+    assert events == [("u", "a", 7)]
+    s.apply_cooldown("u", fingerprint("b"), 30)
+    assert cooldown(s, "b", clock.now) == 30
+    s.apply_cooldown("u", fingerprint("b"), 0)
+    assert cooldown(s, "b", clock.now) <= 0
+    s.apply_cooldown("u", "unknown", 30)
+    s.apply_cooldown("other", fingerprint("b"), 30)
+
+def test_remote_load_is_merged_and_expired(clock):
+    s = make("a", "b")
+    s.acquire("u", "a")
+    assert s.local_load() == {"u": {fingerprint("a"): 1}}
+    s.apply_remote_load("w2", {"u": {fingerprint("b"): 3}}, 10)
+    assert s._pools["u"]["b"].load == 3
+    assert order(s) == ["a", "b"]
+    clock.now += 11
+    s.expire_remote(10)
+    assert s._pools["u"]["b"].load == 0
+
+def test_parse_retry_after():
+    assert parse_retry_after("12") == 12
+    assert parse_retry_after("1.5") == 1.5
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,101 @@
+import asyncio
+import httpx
+import pytest
+import app.settings as settings
+import app.breaker as breaker
+import app.upstream as upstream
+from app.breaker import HostBreakers
+from app.scheduler import KeyState, scheduler
+
+URL = "http://upstream.test/api/chat"
+
+class FailingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, exc_type):
+        self.exc_type = exc_type
+        self.calls = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        raise self.exc_type("failed", request=request)
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    # app.main 导入时会在当前目录创建 data/
+    monkeypatch.chdir(tmp_path)
+    import app.main as main
+    monkeypatch.setattr(settings, "BREAKER_ENABLED", True)
+    monkeypatch.setattr(settings, "BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(settings, "STREAM_HEDGE_DELAY_MS", 0)
+    monkeypatch.setattr(breaker, "hosts", HostBreakers())
+    breaker.hosts.get(URL)
+    monkeypatch.setitem(scheduler._pools, "u", {k: KeyState(k) for k in ("a", "b")})
+    return main
+
+def use_transport(monkeypatch, transport: httpx.AsyncBaseTransport):
+    monkeypatch.setattr(upstream, "_client", httpx.AsyncClient(transport=upstream._BreakerTransport(transport)))
+
+def open_stream(main):
+    return asyncio.run(main._open_first_stream(URL, upstream.prepare_body({"model": "m"}), ["a", "b"], "u", "m"))
+
+def test_pool_timeout_trips_neither_breaker(main, monkeypatch):
+    transport = FailingTransport(httpx.PoolTimeout)
+    use_transport(monkeypatch, transport)
+    for _ in range(5):
+        with pytest.raises(httpx.PoolTimeout):
+            open_stream(main)
+    # 连接池已满时不再换 Key 重试
+    assert transport.calls == 5
+    assert breaker.hosts.get(URL).state == "closed"
+    for state in scheduler._pools["u"].values():
+        assert (state.failures, state.breaker.consecutive_failures, state.cooldown_until) == (0, 0, 0.0)
+
+def test_connect_errors_trip_host_breaker(main, monkeypatch):
+    use_transport(monkeypatch, FailingTransport(httpx.ConnectError))
+    with pytest.raises(main.HTTPException) as exc:
+        open_stream(main)
+    assert exc.value.status_code == 502
+    assert [s.failures for s in scheduler._pools["u"].values()] == [1, 1]
+    assert breaker.hosts.get(URL).consecutive_failures == 2
+
+class Ticket:
+    client_key = None
+
+def chat(main, monkeypatch, statuses: dict, keys=("a", "b", "c")):
+    """按 Key 返回固定状态码的上游，返回 (响应, 各 Key 被请求的次数)"""
+    calls = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        key = request.headers["Authorization"].split()[-1]
+        calls[key] = calls.get(key, 0) + 1
+        status = statuses.get(key, 200)
+        if status != 200: return httpx.Response(status, json={"error": f"{key} failed"})
+        return httpx.Response(200, json={"message": {"role": "assistant", "content": "ok"}, "done": True, "prompt_eval_count": 1, "eval_count": 1})
+
+    use_transport(monkeypatch, httpx.MockTransport(handler))
+    monkeypatch.setitem(scheduler._pools, "u", {k: KeyState(k) for k in keys})
+    req = main.ChatCompletionRequest.model_validate({"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+    resp = asyncio.run(main._dispatch_chat(req, "u", None, URL, [{"key": k} for k in keys], upstream.prepare_body({"model": "m"}), Ticket(), None))
+    return resp, calls
+
+def failures(key: str) -> int:
+    return scheduler._pools["u"][key].failures
+
+def test_request_caused_500_retries_once_and_returns_upstream_error(main, monkeypatch):
+    resp, calls = chat(main, monkeypatch, {"a": 500, "b": 500, "c": 500})
+    assert resp.status_code == 500
+    assert sum(calls.values()) == 2
+    # 同一请求在两个 Key 上都失败才计入，不会波及其余 Key
+    assert sorted(failures(k) for k in "abc") == [0, 1, 1]
+
+def test_single_500_is_not_counted_when_retry_succeeds(main, monkeypatch):
+    resp, calls = chat(main, monkeypatch, {"a": 500}, keys=("a", "b"))
+    assert isinstance(resp, dict) and resp["choices"][0]["message"]["content"] == "ok"
+    assert failures("a") == 0 and failures("b") == 0
+    resp, calls = chat(main, monkeypatch, {"a": 500}, keys=("a",))
+    assert resp.status_code == 500 and failures("a") == 0
+
+def test_gateway_errors_fail_over_and_count(main, monkeypatch):
+    resp, calls = chat(main, monkeypatch, {"a": 502, "b": 503})
+    assert isinstance(resp, dict)
+    assert calls == {"a": 1, "b": 1, "c": 1}
+    assert (failures("a"), failures("b"), failures("c")) == (1, 1, 0)